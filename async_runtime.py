@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import telegram
+from telegram.error import (TelegramError, Unauthorized, BadRequest, InvalidToken, Conflict, RetryAfter,
+                            ChatMigrated, NetworkError, TimedOut)
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import asyncio
+import itertools
+import json
+import logging
+import ssl
+import threading
+import time
+
+from message_queue import (TokenBucket, PRIORITY_GAME, GLOBAL_RATE, GLOBAL_BURST, PRIVATE_CHAT_RATE,
+                           PRIVATE_CHAT_BURST, GROUP_CHAT_RATE, GROUP_CHAT_BURST, MAX_RETRIES, API_REQUESTS,
+                           API_ERRORS, API_SECONDS)
+
+BOT_API_URL = "https://api.telegram.org"
+
+# Upper bound on concurrent Bot API requests; this, not the number of chats, decides how many sockets are open.
+MAX_CONNECTIONS = 16
+REQUEST_TIMEOUT = 30
+# Threads that resolve send futures, so their callbacks (hand edits, starting a game) never block the loop.
+CALLBACK_WORKERS = 4
+
+ERROR_LOGGER = logging.getLogger("error_logger")
+
+
+class AsyncBotClient:
+    def __init__(self, token, base_url=BOT_API_URL, max_connections=MAX_CONNECTIONS):
+        url = urlsplit(base_url)
+        self.__host = url.hostname
+        self.__ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.__port = url.port or (443 if self.__ssl else 80)
+        self.__path = "%s/bot%s/" % (url.path.rstrip("/"), token)
+        self.__max_connections = max_connections
+        # Idle keep-alive connections as (reader, writer).
+        self.__idle = []
+        self.__available = None
+
+    async def __connect(self):
+        if self.__idle:
+            return self.__idle.pop()
+        return await asyncio.open_connection(self.__host, self.__port, ssl=self.__ssl)
+
+    def __release(self, connection, reusable):
+        if connection is not None:
+            if reusable:
+                self.__idle.append(connection)
+            else:
+                connection[1].close()
+        self.__available.release()
+
+    async def call(self, method, params):
+        body = json.dumps(params, separators=(",", ":")).encode("utf-8")
+        request = ("POST %s%s HTTP/1.1\r\n"
+                   "Host: %s\r\n"
+                   "Content-Type: application/json\r\n"
+                   "Content-Length: %d\r\n"
+                   "Connection: keep-alive\r\n\r\n" % (self.__path, method, self.__host, len(body))).encode("latin-1")
+
+        if self.__available is None:
+            self.__available = asyncio.Semaphore(self.__max_connections)
+        await self.__available.acquire()
+
+        connection = None
+        reusable = False
+        try:
+            connection = await self.__connect()
+            reader, writer = connection
+            writer.write(request + body)
+            await writer.drain()
+            status, headers, data = await asyncio.wait_for(self.__read_response(reader), REQUEST_TIMEOUT)
+            reusable = headers.get("connection", "").lower() != "close"
+        except asyncio.TimeoutError:
+            raise TimedOut()
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            raise NetworkError("Bot API connection failed: %s" % e)
+        finally:
+            self.__release(connection, reusable)
+
+        try:
+            response = json.loads(data.decode("utf-8"))
+        except ValueError:
+            raise NetworkError("Invalid Bot API response (HTTP %d)" % status)
+
+        if response.get("ok"):
+            return response.get("result")
+        raise self.__make_error(status, response)
+
+    async def __read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b"", None)
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            data = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                data += chunk[:-2]
+        else:
+            data = await reader.readexactly(int(headers.get("content-length", 0)))
+        return status, headers, data
+
+    def __make_error(self, status, response):
+        description = response.get("description", "Unknown Bot API error")
+        parameters = response.get("parameters") or {}
+        if "retry_after" in parameters:
+            return RetryAfter(parameters["retry_after"])
+        if "migrate_to_chat_id" in parameters:
+            return ChatMigrated(parameters["migrate_to_chat_id"])
+        if status in (401, 403):
+            return Unauthorized(description)
+        if status == 400:
+            return BadRequest(description)
+        if status == 404:
+            return InvalidToken()
+        if status == 409:
+            return Conflict(description)
+        if status >= 500:
+            return NetworkError(description)
+        return TelegramError(description)
+
+
+class AsyncRuntime:
+    # An asyncio stand-in for MessageQueue that also processes incoming updates. Every chat is an actor that
+    # sends its messages in order; one event loop thread serves every chat, however many there are.
+    def __init__(self, client, dispatcher=None, bot=None):
+        self.__client = client
+        self.__dispatcher = dispatcher
+        self.__bot = bot
+        self.__loop = None
+        self.__thread = None
+        self.__callbacks = None
+        self.__seq = itertools.count()
+        self.__global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        # Waiters for a global send slot, as (priority, seq, asyncio future).
+        self.__slots = None
+        # These are dicts of (chat ID, deque of (method, kwargs, priority, future)) and (chat ID, TokenBucket).
+        self.__chat_queues = {}
+        self.__chat_buckets = {}
+        # Counted from the submitting thread so a message is pending from the moment submit() returns.
+        self.__num_pending = 0
+        self.__pending_lock = threading.Lock()
+
+    def start(self):
+        if self.__loop is not None:
+            return
+        self.__loop = asyncio.new_event_loop()
+        self.__callbacks = ThreadPoolExecutor(CALLBACK_WORKERS, thread_name_prefix="async_callbacks")
+        started = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, args=(started,), name="async_runtime", daemon=True)
+        self.__thread.start()
+        started.wait()
+
+    def __run(self, started):
+        asyncio.set_event_loop(self.__loop)
+        self.__slots = asyncio.PriorityQueue()
+        pacer = self.__loop.create_task(self.__pace())
+        self.__loop.call_soon(started.set)
+        self.__loop.run_forever()
+        pacer.cancel()
+        self.__loop.run_until_complete(asyncio.gather(pacer, return_exceptions=True))
+        self.__loop.close()
+
+    def stop(self, timeout=None):
+        if self.__loop is None:
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # Let queued messages go out before shutting down.
+        while self.get_num_pending() and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.05)
+        # Callbacks may still queue follow-up messages, which go out like the rest.
+        self.__callbacks.shutdown()
+        while self.get_num_pending() and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.05)
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop = None
+
+    def submit(self, method, chat_id, priority=PRIORITY_GAME, **kwargs):
+        if self.__loop is None:
+            self.start()
+
+        kwargs["chat_id"] = chat_id
+        future = Future()
+        with self.__pending_lock:
+            self.__num_pending += 1
+        self.__loop.call_soon_threadsafe(self.__enqueue, method, chat_id, priority, kwargs, future)
+        return future
+
+    def send(self, chat_id, text, parse_mode=None, priority=PRIORITY_GAME, **kwargs):
+        return self.submit("send_message", chat_id, priority=priority, text=text, parse_mode=parse_mode, **kwargs)
+
+    def get_num_pending(self):
+        return self.__num_pending
+
+    def put(self, update):
+        # Same interface as the dispatcher's update queue, so the webhook server can feed the runtime directly.
+        self.__loop.call_soon_threadsafe(self.__process_update, update)
+
+    def __process_update(self, update):
+        # Handlers are wrapped in run_async, so this only hands the update to the dispatcher's worker threads.
+        try:
+            self.__dispatcher.process_update(update)
+        except Exception as e:
+            ERROR_LOGGER.warning("Failed to process update %s: %s", update, e)
+
+    def __enqueue(self, method, chat_id, priority, kwargs, future):
+        queue = self.__chat_queues.get(chat_id)
+        if queue is None:
+            queue = self.__chat_queues[chat_id] = deque()
+            self.__loop.create_task(self.__run_chat(chat_id, queue))
+        queue.append((method, kwargs, priority, future))
+
+    def __get_chat_bucket(self, chat_id):
+        bucket = self.__chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            self.__chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def __pace(self):
+        # Hands out global send slots in priority order at Telegram's overall rate.
+        while True:
+            priority, seq, waiter = await self.__slots.get()
+            wait = self.__global_bucket.get_wait(time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.__global_bucket.consume(time.monotonic())
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def __run_chat(self, chat_id, queue):
+        bucket = self.__get_chat_bucket(chat_id)
+        while queue:
+            method, kwargs, priority, future = queue[0]
+            for attempt in range(MAX_RETRIES + 1):
+                wait = bucket.get_wait(time.monotonic())
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                waiter = self.__loop.create_future()
+                self.__slots.put_nowait((priority, next(self.__seq), waiter))
+                await waiter
+                bucket.consume(time.monotonic())
+
+                try:
+                    result = await self.__call(method, kwargs)
+                except BadRequest as e:
+                    # A NetworkError too, but the same request will be rejected again.
+                    self.__fail(method, kwargs, future, e)
+                except (RetryAfter, NetworkError) as e:
+                    if attempt == MAX_RETRIES:
+                        self.__fail(method, kwargs, future, e)
+                    else:
+                        await asyncio.sleep(e.retry_after if isinstance(e, RetryAfter) else 2 ** attempt)
+                        continue
+                except Exception as e:
+                    self.__fail(method, kwargs, future, e)
+                else:
+                    self.__callbacks.submit(future.set_result, self.__to_result(result))
+                break
+
+            queue.popleft()
+            with self.__pending_lock:
+                self.__num_pending -= 1
+
+        del self.__chat_queues[chat_id]
+        if bucket.is_full(time.monotonic()):
+            self.__chat_buckets.pop(chat_id, None)
+
+    async def __call(self, method, kwargs):
+        start = time.perf_counter()
+        API_REQUESTS.inc(method)
+        try:
+            return await self.__client.call(self.__to_api_method(method), self.__to_params(kwargs))
+        except Exception as e:
+            API_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, method)
+
+    def __to_api_method(self, method):
+        # send_message -> sendMessage
+        first, *rest = method.split("_")
+        return first + "".join(word.capitalize() for word in rest)
+
+    def __to_params(self, kwargs):
+        params = {}
+        for key, value in kwargs.items():
+            if value is None:
+                continue
+            params[key] = value.to_dict() if hasattr(value, "to_dict") else value
+        return params
+
+    def __to_result(self, result):
+        if self.__bot is not None and isinstance(result, dict) and "message_id" in result:
+            return telegram.Message.de_json(result, self.__bot)
+        return result
+
+    def __fail(self, method, kwargs, future, e):
+        ERROR_LOGGER.warning("Failed to %s to %s: %s", method, kwargs.get("chat_id"), e)
+        self.__callbacks.submit(future.set_exception, e)
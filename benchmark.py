@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+from __future__ import unicode_literals
+
+import telegram
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import argparse
+import datetime
+import itertools
+import json
+import random
+import threading
+import time
+
+import async_runtime
+import message_queue
+import telegram_interaction
+from async_runtime import AsyncBotClient, AsyncRuntime
+
+FAKE_TOKEN = "123456:benchmark"
+
+
+class FakeBot:
+    # Stands in for telegram.Bot: counts every call and pretends each one took `latency` seconds.
+    def __init__(self, latency=0):
+        self.__latency = latency
+        self.__lock = threading.Lock()
+        self.__message_ids = itertools.count(1)
+        self.calls = defaultdict(int)
+
+    def __call(self, method, chat_id):
+        if self.__latency:
+            time.sleep(self.__latency)
+        with self.__lock:
+            self.calls[method] += 1
+        return SimpleNamespace(message_id=next(self.__message_ids), chat_id=chat_id)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.__call("send_message", chat_id)
+
+    def edit_message_text(self, chat_id, text, **kwargs):
+        return self.__call("edit_message_text", chat_id)
+
+    def edit_message_reply_markup(self, chat_id, **kwargs):
+        return self.__call("edit_message_reply_markup", chat_id)
+
+    def answer_callback_query(self, callback_query_id, **kwargs):
+        return self.__call("answer_callback_query", None)
+
+
+class FakeBotApiServer:
+    # A local HTTP server that answers Bot API requests the way Telegram would, for the async runtime.
+    def __init__(self, latency=0):
+        self.calls = defaultdict(int)
+        lock = threading.Lock()
+        message_ids = itertools.count(1)
+        calls = self.calls
+
+        class FakeBotApiRequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                params = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if latency:
+                    time.sleep(latency)
+                method = self.path.rsplit("/", 1)[-1]
+                with lock:
+                    calls[method] += 1
+                result = {"message_id": next(message_ids), "date": 0,
+                          "chat": {"id": params.get("chat_id", 0), "type": "private"}}
+                body = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                # Headers and body go out in one write; split writes stall on delayed ACKs and skew the numbers.
+                self.wfile.write(("HTTP/1.1 200 OK\r\n"
+                                  "Content-Type: application/json\r\n"
+                                  "Content-Length: %d\r\n\r\n" % len(body)).encode("latin-1") + body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotApiRequestHandler)
+        self.__httpd.daemon_threads = True
+        threading.Thread(target=self.__httpd.serve_forever, daemon=True).start()
+
+    def get_url(self):
+        return "http://127.0.0.1:%d" % self.__httpd.server_address[1]
+
+    def stop(self):
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
+
+
+class Recorder:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # This is a dict of (command, list of handler latencies in seconds).
+        self.latencies = defaultdict(list)
+        self.rounds = 0
+
+    def record(self, command, seconds):
+        with self.__lock:
+            self.latencies[command].append(seconds)
+
+    def add_round(self):
+        with self.__lock:
+            self.rounds += 1
+
+
+def make_update(update_id, chat_id, user_id, text):
+    chat_type = telegram.Chat.PRIVATE if chat_id == user_id else telegram.Chat.GROUP
+    message = telegram.Message(update_id, telegram.User(user_id, "player%d" % user_id, False),
+                               datetime.datetime.now(), telegram.Chat(chat_id, chat_type), text=text)
+    return telegram.Update(update_id, message=message)
+
+
+class SimulatedChat:
+    def __init__(self, chat_id, user_ids, max_rounds, recorder):
+        self.__chat_id = chat_id
+        self.__user_ids = user_ids
+        self.__max_rounds = max_rounds
+        self.__recorder = recorder
+        self.__update_ids = itertools.count(1)
+
+    def __command(self, command, chat_id, user_id, *args):
+        update = make_update(next(self.__update_ids), chat_id, user_id, "/%s %s" % (command, " ".join(args)))
+        context = SimpleNamespace(args=list(args), bot_data={})
+        handler = getattr(telegram_interaction, command + "_handler")
+
+        start = time.perf_counter()
+        handler(update, context)
+        self.__recorder.record(command, time.perf_counter() - start)
+
+    def run(self):
+        registry = telegram_interaction.REGISTRY
+        self.__command("newgame", self.__chat_id, self.__user_ids[0])
+        for user_id in self.__user_ids:
+            self.__command("join", self.__chat_id, user_id)
+        self.__command("startgame", self.__chat_id, self.__user_ids[0])
+
+        # The game is created once the readiness pings come back.
+        while registry.get_game(self.__chat_id) is None:
+            time.sleep(0.001)
+
+        for i in range(self.__max_rounds):
+            game = registry.get_game(self.__chat_id)
+            if game is None:
+                return
+            judge = game.get_current_turn_player()
+            num_cards = game.get_current_pick()
+            for user_id, player in list(game.get_players().items()):
+                if player is not judge:
+                    # Players submit from their private chat with the bot.
+                    self.__command("play", user_id, user_id, *[str(c) for c in range(num_cards)])
+            judge_id = next(user_id for user_id, player in game.get_players().items() if player is judge)
+            self.__command("choose", self.__chat_id, judge_id, "0")
+            self.__recorder.add_round()
+
+        game = registry.get_game(self.__chat_id)
+        if game is not None:
+            self.__command("endgame", self.__chat_id, self.__user_ids[0])
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plays simulated games against a fake Telegram Bot API.")
+    parser.add_argument("--chats", type=int, default=100, help="number of concurrent chats")
+    parser.add_argument("--players", type=int, default=5, help="players per chat")
+    parser.add_argument("--rounds", type=int, default=20, help="maximum rounds per game")
+    parser.add_argument("--threads", type=int, default=8, help="threads driving the chats")
+    parser.add_argument("--latency", type=float, default=0, help="simulated Bot API latency in milliseconds")
+    parser.add_argument("--transport", choices=["queue", "async"], default="queue",
+                        help="send through the threaded MessageQueue or the asyncio runtime")
+    parser.add_argument("--rate-limits", action="store_true", help="keep Telegram's rate limits in place")
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    # Games seed themselves from their chat, so each chat plays the same cards whatever order the threads run in.
+    telegram_interaction.GAME_SEED = str(options.seed)
+    if not options.rate_limits:
+        for name in ["GLOBAL_RATE", "GLOBAL_BURST", "PRIVATE_CHAT_RATE", "PRIVATE_CHAT_BURST",
+                     "GROUP_CHAT_RATE", "GROUP_CHAT_BURST"]:
+            setattr(message_queue, name, float("inf"))
+            setattr(async_runtime, name, float("inf"))
+
+    latency = options.latency / 1000
+    server = None
+    if options.transport == "async":
+        server = FakeBotApiServer(latency)
+        # The bot is only used to turn results into Messages, which hand edits need.
+        outbox = AsyncRuntime(AsyncBotClient(FAKE_TOKEN, server.get_url()), bot=telegram.Bot(FAKE_TOKEN))
+        calls = server.calls
+    else:
+        bot = FakeBot(latency)
+        outbox = message_queue.MessageQueue(bot)
+        calls = bot.calls
+    telegram_interaction.init_app(outbox, log_to_files=False)
+    outbox.start()
+
+    recorder = Recorder()
+    chats = [SimulatedChat(-(i + 1), [1000 * (i + 1) + p for p in range(options.players)], options.rounds, recorder)
+             for i in range(options.chats)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(options.threads) as executor:
+        for future in [executor.submit(chat.run) for chat in chats]:
+            future.result()
+    handled = time.perf_counter() - start
+    outbox.stop()
+    drained = time.perf_counter() - start
+    if server is not None:
+        server.stop()
+
+    all_latencies = [l for latencies in recorder.latencies.values() for l in latencies]
+    num_messages = sum(calls.values())
+    print("Chats: %d, players per chat: %d, rounds played: %d" % (options.chats, options.players, recorder.rounds))
+    print("Updates handled: %d in %.2fs (%.0f updates/sec)" % (len(all_latencies), handled,
+                                                              len(all_latencies) / handled))
+    print("Messages sent: %d in %.2fs (%.1f per round)" % (num_messages, drained,
+                                                          num_messages / max(1, recorder.rounds)))
+    for method, count in sorted(calls.items()):
+        print("  %s: %d" % (method, count))
+    print("Handler latency (ms):")
+    print("  %-12s %8s %8s %8s %8s" % ("command", "count", "p50", "p99", "max"))
+    for command, latencies in sorted(recorder.latencies.items()) + [("all", all_latencies)]:
+        print("  %-12s %8d %8.3f %8.3f %8.3f" % (command, len(latencies), percentile(latencies, 50) * 1000,
+                                                percentile(latencies, 99) * 1000, max(latencies) * 1000))
+
+
+if __name__ == "__main__":
+    main()
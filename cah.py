@@ -2,25 +2,63 @@
 from __future__ import unicode_literals
 
 import telegram
-from telegram.error import Unauthorized, TelegramError
 
-from collections import defaultdict
+from array import array
+from collections import namedtuple
 
+import html
 import random
 
-from deck_enums import DECK_FILENAMES
+from card_corpus import get_corpus, CARD_ID_TYPECODE, MAX_PICK
 
-with open("api_key.txt", 'r', encoding="utf-8") as f:
-    TOKEN = f.read().rstrip()
+# Games never talk to Telegram themselves; they queue these up for the caller to send.
+OutgoingMessage = namedtuple("OutgoingMessage", ["chat_id", "text", "parse_mode", "reply_markup"], defaults=[None])
 
-bot = telegram.Bot(token=TOKEN)
+# Games with at least this many players run in large lobby mode: rounds close on a deadline instead of waiting
+# for everyone, the judge only sees a sample of the submissions and players aren't messaged individually.
+LARGE_LOBBY_SIZE = 10
+MAX_CANDIDATES = 30
+
+# Telegram rejects messages longer than this.
+MAX_MESSAGE_LENGTH = 4096
+
+KEYBOARD_ROW_SIZE = 5
+
+# A draw pile dealing from a shared list of cards copies the cards it has left, two bytes each, once it has swapped
+# more than this many. Each swap is a dict entry of about a hundred bytes.
+MAX_SWAPS = 16
+
+HAND_SIZE = 10
+
+
+def make_keyboard(buttons):
+    # Buttons is a list of (label, callback data).
+    rows = []
+    for i in range(0, len(buttons), KEYBOARD_ROW_SIZE):
+        rows.append([telegram.InlineKeyboardButton(label, callback_data=data)
+                     for label, data in buttons[i:i + KEYBOARD_ROW_SIZE]])
+    return telegram.InlineKeyboardMarkup(rows)
+
+
+def get_min_white_cards(num_players):
+    # Every hand is dealt in full, and everyone but the judge draws back up before the round's cards are discarded.
+    return num_players * HAND_SIZE + (num_players - 1) * MAX_PICK
 
 
 class Player:
+    # Tens of thousands of idle games can be open at once, so players, decks and games keep no per-instance dict
+    # and hold card IDs in arrays rather than lists.
+    __slots__ = ("__hand", "__name", "__score", "__free_slots", "__rendered_cards", "__rendered_slots")
+
     def __init__(self, name, hand):
-        self.__hand = hand
+        self.__hand = array(CARD_ID_TYPECODE, hand)
         self.__name = name
         self.__score = 0
+        # Slots emptied by the last play, refilled in order so the rest of the hand keeps its numbers.
+        self.__free_slots = []
+        # The card IDs and text of each slot as last rendered, so only changed slots are rendered again.
+        self.__rendered_cards = array(CARD_ID_TYPECODE)
+        self.__rendered_slots = []
 
     def get_hand(self):
         return self.__hand
@@ -37,67 +75,193 @@ class Player:
         cards = [self.__hand[id] for id in ids]
         for id in ids_sorted:
             del self.__hand[id]
+        self.__free_slots = sorted(ids_sorted + self.__free_slots)
         return cards
 
-    def get_formatted_hand(self):
-        text = "<b>Your current hand:</b>\n\n"
-        for i in range(len(self.__hand)):
-            text += "(" + str(i) + ") " + str(self.__hand[i]) + "\n\n"
-        return text
+    def get_formatted_hand(self, corpus):
+        for i, card in enumerate(self.__hand):
+            if i == len(self.__rendered_cards):
+                self.__rendered_cards.append(card)
+                self.__rendered_slots.append("(%s) %s\n\n" % (i, html.escape(corpus.get_white_card(card))))
+            elif self.__rendered_cards[i] != card:
+                self.__rendered_cards[i] = card
+                self.__rendered_slots[i] = "(%s) %s\n\n" % (i, html.escape(corpus.get_white_card(card)))
+        del self.__rendered_cards[len(self.__hand):]
+        del self.__rendered_slots[len(self.__hand):]
+        return "<b>Your current hand:</b>\n\n" + "".join(self.__rendered_slots)
 
     def add_card(self, c):
-        self.__hand.append(c)
+        # Lowest slot first: refilling in ascending order puts every card back where one was removed.
+        if self.__free_slots:
+            self.__hand.insert(self.__free_slots.pop(0), c)
+        else:
+            self.__hand.append(c)
 
     def insert_card(self, c, i):
         self.__hand.insert(i, c)
 
     def set_hand(self, hand):
-        self.__hand = hand
+        self.__hand = array(CARD_ID_TYPECODE, hand)
+        self.__free_slots = []
 
     def increment_score(self):
         self.__score += 1
 
+    def to_snapshot(self):
+        return {"name": self.__name, "score": self.__score, "hand": list(self.__hand)}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        player = cls(snapshot["name"], snapshot["hand"])
+        player.__score = snapshot["score"]
+        return player
+
+
+class DrawPile:
+    # Deals the cards of source in random order without shuffling them up front. It's a Fisher-Yates shuffle run one
+    # step per draw. A shared source, which other games may be dealing from too, is never changed: the pile only
+    # remembers the positions it has swapped, until there are enough of them that a copy of the undealt cards is
+    # smaller. An unshared source belongs to the pile and is dealt from in place.
+    __slots__ = ("__source", "__remaining", "__swaps")
+
+    def __init__(self, source, shared=False):
+        self.__source = source
+        # Cards at positions below this haven't been dealt yet.
+        self.__remaining = len(source)
+        # While the source is shared this is a dict of (position, card moved there from the end of the pile),
+        # otherwise None.
+        self.__swaps = {} if shared else None
+
+    def __len__(self):
+        return self.__remaining
+
+    def draw(self, rng):
+        if self.__remaining <= 0:
+            raise IndexError("draw from an empty pile")
+        last = self.__remaining - 1
+        i = rng.randint(0, last)
+        swaps = self.__swaps
+        if swaps is None:
+            card = self.__source[i]
+            self.__source[i] = self.__source[last]
+            self.__source.pop()
+        else:
+            card = swaps.get(i, self.__source[i])
+            if i != last:
+                swaps[i] = swaps.get(last, self.__source[last])
+            swaps.pop(last, None)
+            if len(swaps) > MAX_SWAPS:
+                self.__copy_source(last)
+        self.__remaining = last
+        return card
+
+    def __copy_source(self, remaining):
+        cards = array(CARD_ID_TYPECODE, self.__source[:remaining])
+        for i, card in self.__swaps.items():
+            cards[i] = card
+        self.__source = cards
+        self.__swaps = None
+
+    def to_snapshot(self):
+        # Shared sources are the deck's starting cards, so snapshots don't need to store them.
+        if self.__swaps is None:
+            return {"source": list(self.__source), "remaining": self.__remaining, "swaps": []}
+        return {"source": None, "remaining": self.__remaining, "swaps": list(self.__swaps.items())}
+
+    @classmethod
+    def from_snapshot(cls, snapshot, shared_source):
+        if snapshot["source"] is None:
+            pile = cls(shared_source, True)
+            pile.__remaining = snapshot["remaining"]
+            pile.__swaps = {i: card for i, card in snapshot["swaps"]}
+            if len(pile.__swaps) > MAX_SWAPS:
+                pile.__copy_source(pile.__remaining)
+            return pile
+
+        # Piles saved before unshared sources were dealt in place may still have swaps.
+        pile = cls(array(CARD_ID_TYPECODE, snapshot["source"][:snapshot["remaining"]]))
+        for i, card in snapshot["swaps"]:
+            pile.__source[i] = card
+        return pile
+
+
+class CardBitset:
+    # Discarded cards, one bit per card ID. A card is never discarded twice before the pile is rebuilt from them.
+    __slots__ = ("__bits", "__count")
+
+    def __init__(self, num_cards):
+        self.__bits = bytearray((num_cards + 7) // 8)
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def add(self, card):
+        mask = 1 << (card & 7)
+        if not self.__bits[card >> 3] & mask:
+            self.__bits[card >> 3] |= mask
+            self.__count += 1
+
+    def pop_all(self):
+        # Returns every card in the set, in ID order, and empties it.
+        cards = array(CARD_ID_TYPECODE)
+        for i, byte in enumerate(self.__bits):
+            if byte:
+                cards.extend(i * 8 + bit for bit in range(8) if byte >> bit & 1)
+                self.__bits[i] = 0
+        self.__count = 0
+        return cards
+
+    def to_snapshot(self):
+        return self.__bits.hex()
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        bitset = cls(0)
+        bitset.__bits = bytearray.fromhex(snapshot)
+        bitset.__count = sum(bin(byte).count("1") for byte in bitset.__bits)
+        return bitset
+
 
 class Deck:
-    def __init__(self, decks_to_use):
-        self.__white_cards = []
-        self.__black_cards = []
-        self.__white_cards_played = []
-        self.__black_cards_played = []
-        self.__HAND_SIZE = 10
-        for d in decks_to_use:
-            self.__white_cards += open("./static_responses/white_cards/%s" % DECK_FILENAMES[d], encoding="utf-8").read().splitlines()
-            bcs = open("./static_responses/black_cards/%s" % DECK_FILENAMES[d], encoding="utf-8").read().splitlines()
-            for bc in bcs:
-                bc_split = bc.split("|")
-                # Black cards are tuples of (num cards to submit, text).
-                self.__black_cards.append((int(bc_split[0]), bc_split[1]))
-        random.shuffle(self.__white_cards)
-        random.shuffle(self.__black_cards)
+    __slots__ = ("__corpus", "__rng", "__decks", "__white_cards", "__black_cards", "__white_cards_played",
+                 "__black_cards_played")
+
+    __HAND_SIZE = HAND_SIZE
+
+    def __init__(self, decks_to_use, corpus=None, rng=random):
+        self.__corpus = get_corpus() if corpus is None else corpus
+        # Games pass their own random.Random so their deals can be replayed.
+        self.__rng = rng
+        self.__decks = list(decks_to_use)
+        # Cards are indices into the shared corpus rather than the card text itself. A card in several of the decks
+        # is only dealt once. The piles deal straight from the corpus' cached list of the decks' cards, so starting
+        # a game copies and shuffles nothing.
+        white_cards, black_cards = self.__corpus.get_card_ids(self.__decks)
+        self.__white_cards = DrawPile(white_cards, True)
+        self.__black_cards = DrawPile(black_cards, True)
+        self.__white_cards_played = CardBitset(self.__corpus.get_num_white_cards())
+        self.__black_cards_played = CardBitset(self.__corpus.get_num_black_cards())
 
     def reshuffle(self):
         if len(self.__white_cards) <= 0 < len(self.__white_cards_played):
-            random.shuffle(self.__white_cards_played)
-            self.__white_cards += self.__white_cards_played
-            self.__white_cards_played.clear()
+            self.__white_cards = DrawPile(self.__white_cards_played.pop_all())
 
         if len(self.__black_cards) <= 0 < len(self.__black_cards_played):
-            random.shuffle(self.__black_cards_played)
-            self.__black_cards += self.__black_cards_played
-            self.__black_cards_played.clear()
+            self.__black_cards = DrawPile(self.__black_cards_played.pop_all())
 
     def draw_white_card(self):
         if len(self.__white_cards) <= 0:
             self.reshuffle()
-        return self.__white_cards.pop()
+        return self.__white_cards.draw(self.__rng)
 
     def draw_black_card(self):
         if len(self.__black_cards) <= 0:
             self.reshuffle()
-        # If, after reshuffling, it's still empty, add a special card.
+        # If, after reshuffling, it's still empty, deal a special card.
         if len(self.__black_cards) <= 0:
-            self.__black_cards.append((1, "The void is a lonely place to live. What do you shout into the abyss?"))
-        return self.__black_cards.pop()
+            return self.__corpus.get_void_black_card_id()
+        return self.__black_cards.draw(self.__rng)
 
     def draw_hand(self):
         hand = []
@@ -106,42 +270,235 @@ class Deck:
         return hand
 
     def discard_white_cards(self, cards):
-        self.__white_cards_played += cards
+        for card in cards:
+            self.__white_cards_played.add(card)
 
     def discard_black_card(self, card):
-        self.__black_cards_played.append(card)
+        self.__black_cards_played.add(card)
 
     def get_hand_size(self):
         return self.__HAND_SIZE
 
+    def get_corpus(self):
+        return self.__corpus
+
+    def to_snapshot(self):
+        return {"decks": self.__decks,
+                "white_pile": self.__white_cards.to_snapshot(),
+                "black_pile": self.__black_cards.to_snapshot(),
+                "white_discards": self.__white_cards_played.to_snapshot(),
+                "black_discards": self.__black_cards_played.to_snapshot()}
+
+    @classmethod
+    def from_snapshot(cls, snapshot, corpus=None, rng=random):
+        if "white_cards" in snapshot:
+            return cls.__from_list_snapshot(snapshot, corpus, rng)
+
+        deck = cls(snapshot["decks"], corpus, rng)
+        white_cards, black_cards = deck.__corpus.get_card_ids(deck.__decks)
+        deck.__white_cards = DrawPile.from_snapshot(snapshot["white_pile"], white_cards)
+        deck.__black_cards = DrawPile.from_snapshot(snapshot["black_pile"], black_cards)
+        deck.__white_cards_played = CardBitset.from_snapshot(snapshot["white_discards"])
+        deck.__black_cards_played = CardBitset.from_snapshot(snapshot["black_discards"])
+        return deck
+
+    @classmethod
+    def __from_list_snapshot(cls, snapshot, corpus, rng):
+        # Games saved before the piles were lazy stored every card in a list.
+        deck = cls([], corpus, rng)
+        deck.__white_cards = DrawPile(array(CARD_ID_TYPECODE, snapshot["white_cards"]))
+        deck.__black_cards = DrawPile(array(CARD_ID_TYPECODE, snapshot["black_cards"]))
+        deck.discard_white_cards(snapshot["white_cards_played"])
+        for card in snapshot["black_cards_played"]:
+            deck.discard_black_card(card)
+        return deck
+
+
+def get_saved_player_ids(saved):
+    # Returns the Telegram IDs of everyone in a game saved with Game.to_log, or as a snapshot by older versions,
+    # without rebuilding it.
+    if "events" in saved:
+        players = saved["snapshot"]["players"] if "snapshot" in saved else saved["players"]
+    else:
+        players = saved["players"]
+    return [telegram_id for telegram_id, p in players]
+
 
 class Game:
-    def __init__(self, chat_id, players, decks_to_use):
+    __slots__ = ("__outbox", "__turn", "__players", "__deck", "__chat_id", "__corpus", "__current_black_card",
+                 "__cards_submitted_this_round", "__submission_slots", "__num_complete_submissions",
+                 "__randomized_ids", "__choosing", "__round", "__large_lobby", "__turn_order", "__rng", "__log")
+
+    # Whoever gets to 7 black cards won first wins!
+    __WIN_NUM = 7
+
+    def __init__(self, chat_id, players, decks_to_use, corpus=None, seed=None):
+        # Every shuffle and deal comes from this game's own generator, so the same seed, players, decks and moves
+        # always play out the same way.
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.__rng = random.Random(seed)
+        # Everything needed to rebuild the game: how it started, then every move that changed it, in order. Players
+        # can't join a running game, so the players it started with are its joins.
+        self.__log = {"seed": seed, "chat_id": chat_id, "decks": list(decks_to_use),
+                      "players": [[telegram_id, name] for telegram_id, name in players.items()], "events": []}
+
+        self.__outbox = []
         self.__turn = 0
         # Players is a dict of (Telegram ID, name).
         self.__players = {}
-        self.__deck = Deck(decks_to_use)
+        self.__deck = Deck(decks_to_use, corpus, self.__rng)
         self.__chat_id = chat_id
+        self.__corpus = self.__deck.get_corpus()
         self.__current_black_card = self.__deck.draw_black_card()
-        # This is a dict of (Telegram ID, list of cards submitted).
-        self.__cards_submitted_this_round = defaultdict(list)
+        # This is a dict of (Telegram ID, list of card indices submitted).
+        self.__cards_submitted_this_round = {}
+        # Telegram IDs in the order they first submitted this round; randomized IDs index into this.
+        self.__submission_slots = []
+        # How many players have submitted every card the black card asks for.
+        self.__num_complete_submissions = 0
         self.__randomized_ids = []
-        # Whoever gets to 7 black cards won first wins!
-        self.__WIN_NUM = 7
-
-        player_keys = list(players.keys())
-        random.shuffle(player_keys)
-        for id in player_keys:
+        # Set once submissions for the round are closed and the judge is picking.
+        self.__choosing = False
+        self.__round = 0
+        self.__large_lobby = len(players) >= LARGE_LOBBY_SIZE
+
+        self.__turn_order = list(players.keys())
+        self.__rng.shuffle(self.__turn_order)
+        for id in self.__turn_order:
             self.__players[id] = Player(players[id], self.__deck.draw_hand())
-            self.send_message(self.__chat_id, "%s has been added to the game.\n" % players[id])
+            if not self.__large_lobby:
+                self.send_message(self.__chat_id, "%s has been added to the game.\n" % html.escape(players[id]))
+        if self.__large_lobby:
+            self.send_paginated(self.__chat_id, "<b>Players added to the game:</b>\n\n",
+                                [html.escape(players[id]) + "\n" for id in self.__turn_order])
 
         self.send_state()
 
-    def send_message(self, chat_id, text):
-        try:
-            bot.send_message(chat_id=chat_id, text=text, parse_mode=telegram.ParseMode.HTML)
-        except TelegramError as e:
-            raise e
+    def to_snapshot(self):
+        # Everything is stored as card indices, so a snapshot is only valid against the same corpus.
+        return {"chat_id": self.__chat_id,
+                "turn": self.__turn,
+                "players": [[telegram_id, p.to_snapshot()] for telegram_id, p in self.__players.items()],
+                "deck": self.__deck.to_snapshot(),
+                "current_black_card": self.__current_black_card,
+                "cards_submitted_this_round": [[telegram_id, list(self.__cards_submitted_this_round[telegram_id])]
+                                               for telegram_id in self.__submission_slots],
+                "randomized_ids": list(self.__randomized_ids),
+                "choosing": self.__choosing,
+                "round": self.__round,
+                "large_lobby": self.__large_lobby}
+
+    @classmethod
+    def from_snapshot(cls, snapshot, corpus=None, seed=None):
+        # Rebuilds a game without dealing cards or messaging anyone. Its log starts from the snapshot.
+        game = cls.__new__(cls)
+        if seed is None:
+            seed = random.getrandbits(64)
+        game.__rng = random.Random(seed)
+        game.__log = {"seed": seed, "snapshot": snapshot, "events": []}
+        game.__outbox = []
+        game.__turn = snapshot["turn"]
+        game.__players = {telegram_id: Player.from_snapshot(p) for telegram_id, p in snapshot["players"]}
+        game.__turn_order = list(game.__players.keys())
+        game.__deck = Deck.from_snapshot(snapshot["deck"], corpus, game.__rng)
+        game.__chat_id = snapshot["chat_id"]
+        game.__corpus = game.__deck.get_corpus()
+        game.__current_black_card = snapshot["current_black_card"]
+        game.__cards_submitted_this_round = {}
+        game.__submission_slots = []
+        for telegram_id, cards in snapshot["cards_submitted_this_round"]:
+            game.__cards_submitted_this_round[telegram_id] = array(CARD_ID_TYPECODE, cards)
+            game.__submission_slots.append(telegram_id)
+        game.__num_complete_submissions = sum(1 for telegram_id in game.__submission_slots
+                                              if game.player_submitted_correct_num_cards(telegram_id))
+        game.__randomized_ids = list(snapshot["randomized_ids"])
+        game.__choosing = snapshot.get("choosing", game.__num_complete_submissions == len(game.__players) - 1)
+        game.__round = snapshot.get("round", 0)
+        game.__large_lobby = snapshot.get("large_lobby", False)
+        return game
+
+    def to_log(self):
+        # Returns the game's seed, starting point and every move since, which is all from_log needs to rebuild
+        # it. The log is only ever appended to; copy it before keeping it past the next move.
+        return self.__log
+
+    @classmethod
+    def from_log(cls, log, corpus=None):
+        # Rebuilds a game from to_log, dropping the messages the replay would have sent.
+        game = None
+        for game, event, messages in cls.replay(log, corpus):
+            pass
+        return game
+
+    @classmethod
+    def replay(cls, log, corpus=None):
+        # Rebuilds a game from to_log one move at a time, yielding (game, event, messages the move sent). The first
+        # event is None, for the messages sent as the game began. Raises ValueError if the game plays out
+        # differently, which means the log was recorded against other cards.
+        if "snapshot" in log:
+            game = cls.from_snapshot(log["snapshot"], corpus, log["seed"])
+        else:
+            game = cls(log["chat_id"], {telegram_id: name for telegram_id, name in log["players"]}, log["decks"],
+                       corpus, log["seed"])
+        yield game, None, game.pop_messages()
+
+        for event in log["events"]:
+            game.apply(event)
+            yield game, event, game.pop_messages()
+        if len(game.__log["events"]) != len(log["events"]):
+            raise ValueError("Replaying the log for %s rejected %d moves" % (game.__chat_id, len(log["events"]) -
+                                                                            len(game.__log["events"])))
+
+    @classmethod
+    def from_saved(cls, saved, corpus=None):
+        # Games saved before logs were kept are snapshots.
+        return cls.from_log(saved, corpus) if "events" in saved else cls.from_snapshot(saved, corpus)
+
+    def apply(self, event):
+        # Makes the move recorded by an event in the log.
+        if event[0] == "play":
+            self.play(event[1], event[2])
+        elif event[0] == "close":
+            self.close_submissions()
+        elif event[0] == "choose":
+            self.choose(event[1], event[2])
+        elif event[0] == "choose_randomly":
+            self.choose_randomly()
+        elif event[0] == "next_turn":
+            self.next_turn()
+        else:
+            raise ValueError("Unknown event %s" % event[0])
+
+    def __record(self, *event):
+        self.__log["events"].append(list(event))
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        self.__outbox.append(OutgoingMessage(chat_id, text, telegram.ParseMode.HTML, reply_markup))
+
+    def pop_messages(self):
+        # Returns every message queued since the last call, in the order they should be sent.
+        messages = self.__outbox
+        self.__outbox = []
+        return messages
+
+    def send_paginated(self, chat_id, header, entries, reply_markup=None):
+        # Splits entries over as many messages as needed to stay under Telegram's length limit. The keyboard, if
+        # any, goes on the last one.
+        text = header
+        for entry in entries:
+            if len(text) + len(entry) > MAX_MESSAGE_LENGTH and text != header:
+                self.send_message(chat_id, text)
+                text = ""
+            text += entry
+        if text:
+            self.send_message(chat_id, text, reply_markup)
+
+    def is_large_lobby(self):
+        return self.__large_lobby
+
+    def get_round(self):
+        return self.__round
 
     def get_players(self):
         return self.__players
@@ -149,27 +506,36 @@ class Game:
     def get_deck(self):
         return self.__deck
 
+    def get_corpus(self):
+        return self.__corpus
+
     def get_current_black_card(self):
-        return self.__current_black_card
+        return self.__corpus.get_black_card(self.__current_black_card)
+
+    def get_current_pick(self):
+        return self.__corpus.get_black_card_pick(self.__current_black_card)
 
     def get_current_turn_player(self):
-        return self.__players[list(self.__players.keys())[self.__turn]]
+        return self.__players[self.__turn_order[self.__turn]]
 
     def draw(self, player):
         while len(player.get_hand()) < self.__deck.get_hand_size():
             player.add_card(self.__deck.draw_white_card())
 
     def send_state(self):
-        current_black_card_text = "<b>Current Black Card:</b>\n\n%s" % self.__current_black_card[1]
-        for telegram_id in self.__players.keys():
-            self.send_message(chat_id=telegram_id, text=current_black_card_text)
-
-        text = "<b>Current Turn:</b> <a href='tg://user?id=%s'>%s</a>\n\n" % (list(self.__players.keys())[self.__turn],
-                                                                              self.get_current_turn_player().get_name())
+        current_black_card_text = "<b>Current Black Card:</b>\n\n%s" % html.escape(self.get_current_black_card()[1])
+        # Large lobbies only get the group message so a round start doesn't fan out to every player.
+        if not self.__large_lobby:
+            for telegram_id in self.__players.keys():
+                self.send_message(chat_id=telegram_id, text=current_black_card_text)
+
+        text = "<b>Current Turn:</b> <a href='tg://user?id=%s'>%s</a>\n\n" % (self.__turn_order[self.__turn],
+                                                                              html.escape(self.get_current_turn_player().get_name()))
         text += current_black_card_text
         self.send_message(chat_id=self.__chat_id, text=text)
 
     def next_turn(self):
+        self.__record("next_turn")
         for telegram_id, white_cards in self.__cards_submitted_this_round.items():
             self.__deck.discard_white_cards(white_cards)
 
@@ -177,9 +543,13 @@ class Game:
 
         self.__current_black_card = self.__deck.draw_black_card()
 
-        self.__cards_submitted_this_round = defaultdict(list)
+        self.__cards_submitted_this_round = {}
+        self.__submission_slots = []
+        self.__num_complete_submissions = 0
 
         self.__randomized_ids = []
+        self.__choosing = False
+        self.__round += 1
 
         self.__turn = (self.__turn + 1) % len(self.__players)
 
@@ -192,26 +562,52 @@ class Game:
         return False
 
     def send_white_card_options(self):
-        text = "<b>Current Black Card:</b>\n\n%s\n\n" % self.__current_black_card[1]
+        text = "<b>Current Black Card:</b>\n\n%s\n\n" % html.escape(self.get_current_black_card()[1])
         text += "<b>White Cards Submitted:</b>\n\n"
 
-        count = 0
-        for id in self.__randomized_ids:
-            key = list(self.__cards_submitted_this_round.keys())[id]
-            white_cards = self.__cards_submitted_this_round[key]
-            text += "(%s) %s\n\n" % (count, "\n".join(white_cards))
-            count += 1
-        self.send_message(self.__chat_id, text)
+        entries = []
+        for count, id in enumerate(self.__randomized_ids):
+            white_cards = self.__cards_submitted_this_round[self.__submission_slots[id]]
+            entries.append("(%s) %s\n\n" % (count, "\n".join(html.escape(self.__corpus.get_white_card(c)) for c in white_cards)))
+        # The round is part of the callback data so a stale button can't pick from a later round.
+        keyboard = make_keyboard([(str(count), "choose:%s:%s:%s" % (self.__chat_id, self.__round, count))
+                                  for count in range(len(entries))])
+        self.send_paginated(self.__chat_id, text, entries, keyboard)
 
     def player_submitted_correct_num_cards(self, telegram_id):
-        return len(self.__cards_submitted_this_round[telegram_id]) == self.__current_black_card[0]
+        return len(self.__cards_submitted_this_round.get(telegram_id, ())) == self.get_current_pick()
 
     def check_if_ready_for_choice(self):
-        return len(self.__cards_submitted_this_round.keys()) == len(self.__players) - 1 and \
-                all(len(cards) == self.__current_black_card[0] for cards in self.__cards_submitted_this_round.values())
+        return self.__choosing
+
+    def get_num_submissions(self):
+        # Counts every player who has played at least one card this round.
+        return len(self.__submission_slots)
+
+    def close_submissions(self):
+        # Returns False if nobody submitted in time, in which case the round should be skipped.
+        if self.__choosing:
+            return len(self.__randomized_ids) > 0
+        self.__record("close")
+        return self.__close_submissions()
+
+    def __close_submissions(self):
+        self.__choosing = True
+        self.__randomized_ids = [id for id, telegram_id in enumerate(self.__submission_slots)
+                                 if self.player_submitted_correct_num_cards(telegram_id)]
+        self.__rng.shuffle(self.__randomized_ids)
+        if self.__large_lobby:
+            del self.__randomized_ids[MAX_CANDIDATES:]
+
+        if len(self.__randomized_ids) == 0:
+            self.send_message(self.__chat_id, "Nobody submitted their white cards in time, skipping this round!")
+            return False
+
+        self.send_white_card_options()
+        return True
 
     def play(self, telegram_id, card_ids):
-        player = self.__players[telegram_id]
+        player = self.__players.get(telegram_id)
 
         if player is None:
             self.send_message(self.__chat_id, "You don't seem to exist!")
@@ -221,32 +617,56 @@ class Game:
             self.send_message(self.__chat_id, "You can't play a white card on your turn!")
             return
 
-        if len(self.__cards_submitted_this_round[telegram_id]) == self.__current_black_card[0]:
+        if self.__choosing:
+            self.send_message(self.__chat_id, "Submissions for this round are closed!")
+            return
+
+        if self.player_submitted_correct_num_cards(telegram_id):
             self.send_message(self.__chat_id, "You've already played all your white cards for this round!")
             return
 
+        num_cards_left = self.get_current_pick() - len(self.__cards_submitted_this_round.get(telegram_id, ()))
+        if len(card_ids) > num_cards_left:
+            self.send_message(self.__chat_id, "You only have %s white card(s) left to play this round!" % num_cards_left)
+            return
+
         cards = player.remove_cards(card_ids)
-        self.__cards_submitted_this_round[telegram_id] += cards
-        for card in cards:
-            self.send_message(telegram_id, "You submitted: %s" % card)
+        self.__record("play", telegram_id, list(card_ids))
+        if telegram_id not in self.__cards_submitted_this_round:
+            self.__cards_submitted_this_round[telegram_id] = array(CARD_ID_TYPECODE)
+            self.__submission_slots.append(telegram_id)
+        self.__cards_submitted_this_round[telegram_id].extend(cards)
+        if self.player_submitted_correct_num_cards(telegram_id):
+            self.__num_complete_submissions += 1
+        if self.__large_lobby:
+            self.send_message(telegram_id, "You submitted: %s" % " / ".join(html.escape(self.__corpus.get_white_card(c)) for c in cards))
+        else:
+            for card in cards:
+                self.send_message(telegram_id, "You submitted: %s" % html.escape(self.__corpus.get_white_card(card)))
 
         # Draw back to 10 cards.
         self.draw(player)
 
         # Check to see that the correct number of cards have been submitted and everyone has submitted for this round.
-        if self.check_if_ready_for_choice():
-            self.__randomized_ids = [*range(len(self.__players) - 1)]
-            random.shuffle(self.__randomized_ids)
-            self.send_white_card_options()
+        if self.__num_complete_submissions == len(self.__players) - 1:
+            self.__close_submissions()
 
     def send_scoreboard(self):
-        text = "<b>Scoreboard:</b>\n\n"
-        for p in self.__players.values():
-            text += "%s: %s\n" % (p.get_name(), p.get_score())
-        self.send_message(self.__chat_id, text)
+        players = self.__players.values()
+        if self.__large_lobby:
+            players = sorted(players, key=lambda p: p.get_score(), reverse=True)
+        self.send_paginated(self.__chat_id, "<b>Scoreboard:</b>\n\n",
+                            ["%s: %s\n" % (html.escape(p.get_name()), p.get_score()) for p in players])
 
     def choose(self, telegram_id, i):
-        player = self.__players[telegram_id]
+        if not self.__can_choose(telegram_id, i):
+            return False
+        self.__record("choose", telegram_id, i)
+        self.__choose(i)
+        return True
+
+    def __can_choose(self, telegram_id, i):
+        player = self.__players.get(telegram_id)
 
         if player is None:
             self.send_message(self.__chat_id, "You don't seem to exist!")
@@ -256,19 +676,28 @@ class Game:
             self.send_message(self.__chat_id, "It's not your turn to choose a winning white card!")
             return False
 
-        if len(self.__cards_submitted_this_round.keys()) < len(self.__players) - 1:
+        if not self.check_if_ready_for_choice():
             self.send_message(self.__chat_id, "Not all white cards have been submitted yet!")
             return False
 
-        if i < 0 or i > len(self.__randomized_ids):
+        if i < 0 or i >= len(self.__randomized_ids):
             self.send_message(self.__chat_id,
-                              "That (%s) is not a valid number from 0-%s!" % (i, len(self.__randomized_ids)))
+                              "That (%s) is not a valid number from 0-%s!" % (i, len(self.__randomized_ids) - 1))
+            return False
+        return True
 
-        key = list(self.__cards_submitted_this_round.keys())[self.__randomized_ids[i]]
-        player_chosen = self.__players[key]
+    def __choose(self, i):
+        player_chosen = self.__players[self.__submission_slots[self.__randomized_ids[i]]]
         player_chosen.increment_score()
 
-        self.send_message(self.__chat_id, "That card belonged to %s!" % player_chosen.get_name())
+        self.send_message(self.__chat_id, "That card belonged to %s!" % html.escape(player_chosen.get_name()))
         self.send_scoreboard()
 
-        return True
\ No newline at end of file
+    def choose_randomly(self):
+        # Used when the judge runs out of time. Returns False if there was nothing to choose from.
+        if not self.__choosing or len(self.__randomized_ids) == 0:
+            return False
+        self.__record("choose_randomly")
+        self.send_message(self.__chat_id, "The judge took too long, so a card was picked at random!")
+        self.__choose(self.__rng.randrange(len(self.__randomized_ids)))
+        return True
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+from __future__ import unicode_literals
+
+from array import array
+
+import collections
+import hashlib
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+
+CARDS_PATH = "./static_responses"
+# Lists the built-in decks as {"id", "name", "file"}. IDs are what players type into /ad, so they must never change.
+MANIFEST_FILENAME = "decks.json"
+# Built from the deck files by running this module. Deck files that don't match it are parsed instead.
+PACK_PATH = os.environ.get("DECK_PACK_PATH", "%s/decks.pack" % CARDS_PATH)
+
+VOID_BLACK_CARD = (1, "The void is a lonely place to live. What do you shout into the abyss?")
+
+# Games keep card IDs in arrays of this type (unsigned 16 bit), so the corpus can hold at most 65536 of each colour.
+CARD_ID_TYPECODE = "H"
+MAX_CARDS = 1 << 16
+
+# No black card asks for more white cards than this.
+MAX_PICK = 3
+
+# How many deck combinations to remember the card IDs of.
+UNION_CACHE_SIZE = 128
+
+# A pack is the header, a deck table, white and black card offsets into the text, white and black canonical card
+# IDs, black card picks, then the white and black card text as UTF-8. Everything is little-endian.
+PACK_MAGIC = b"CAHPACK2"
+# Magic, SHA-1 of the deck files, corpus fingerprint, number of decks, white cards and black cards (void included).
+PACK_HEADER = struct.Struct("<8s20s40sIII")
+# Deck, then the start and end of its white and black card IDs.
+PACK_DECK = struct.Struct("<IIIII")
+OFFSET_TYPECODE = "I"
+
+INFO_LOGGER = logging.getLogger("info_logger")
+ERROR_LOGGER = logging.getLogger("error_logger")
+
+
+def read_deck_list(path=CARDS_PATH):
+    # Returns a list of (deck ID, name, filename). Deck files that aren't in the manifest are picked up too, after
+    # every listed deck, so dropping in a new pair of files is enough to add a deck.
+    with open("%s/%s" % (path, MANIFEST_FILENAME), encoding="utf-8") as f:
+        decks = [(int(d["id"]), d["name"], d["file"]) for d in json.load(f)]
+
+    listed = {filename for d, name, filename in decks}
+    next_id = max([d for d, name, filename in decks], default=-1) + 1
+    for filename in sorted(os.listdir("%s/white_cards" % path)):
+        if filename.endswith(".txt") and filename not in listed and \
+                os.path.isfile("%s/black_cards/%s" % (path, filename)):
+            name = filename[:-len(".txt")].replace("_", " ").title()
+            INFO_LOGGER.info("Found deck %s that isn't in %s; it's deck %d.", filename, MANIFEST_FILENAME, next_id)
+            decks.append((next_id, name, filename))
+            next_id += 1
+    return decks
+
+
+def read_deck_files(path=CARDS_PATH):
+    # Returns (list of (deck ID, name, filename), dict of (deck ID, (white card file, black card file)), SHA-1 of
+    # every file) without parsing any cards.
+    deck_list = read_deck_list(path)
+    files = {}
+    source_hash = hashlib.sha1()
+    for d, name, filename in deck_list:
+        with open("%s/white_cards/%s" % (path, filename), "rb") as f:
+            white = f.read()
+        with open("%s/black_cards/%s" % (path, filename), "rb") as f:
+            black = f.read()
+        files[d] = (white, black)
+        source_hash.update(b"%d|%s|%d|%d\n" % (d, filename.encode("utf-8"), len(white), len(black)))
+        source_hash.update(white)
+        source_hash.update(black)
+    return deck_list, files, source_hash.digest()
+
+
+def make_offsets(texts):
+    offsets = array(OFFSET_TYPECODE, [0])
+    offsets.extend(itertools.accumulate(len(t) for t in texts))
+    return offsets
+
+
+def make_canonical_ids(cards):
+    # Maps every card to the first card with the same text, so a card printed in several decks is only dealt once.
+    first_ids = {}
+    return array(CARD_ID_TYPECODE, (first_ids.setdefault(card, i) for i, card in enumerate(cards)))
+
+
+class DeckUnions:
+    # Works out which cards a combination of decks plays with, each card once, and remembers the most recently
+    # used combinations. The corpus gives each deck's cards as canonical IDs.
+    def __init__(self, corpus, size=UNION_CACHE_SIZE):
+        self.__corpus = corpus
+        self.__size = size
+        self.__lock = threading.Lock()
+        # This is a dict of (frozenset of decks, (white card IDs, black card IDs)), least recently used first.
+        self.__unions = collections.OrderedDict()
+
+    def get(self, decks):
+        # Returns (white card IDs, black card IDs) as sorted arrays. They're shared, so callers copy them.
+        key = frozenset(decks)
+        with self.__lock:
+            union = self.__unions.get(key)
+            if union is not None:
+                self.__unions.move_to_end(key)
+                return union
+
+        white_ids = set()
+        black_ids = set()
+        for d in key:
+            white_ids.update(self.__corpus.get_canonical_white_ids(d))
+            black_ids.update(self.__corpus.get_canonical_black_ids(d))
+        union = (array(CARD_ID_TYPECODE, sorted(white_ids)), array(CARD_ID_TYPECODE, sorted(black_ids)))
+
+        with self.__lock:
+            self.__unions[key] = union
+            if len(self.__unions) > self.__size:
+                self.__unions.popitem(last=False)
+        return union
+
+
+class CardCorpus:
+    def __init__(self, path=CARDS_PATH, pack_path=PACK_PATH):
+        # Every card is stored exactly once, as UTF-8 in one block of text per colour; games only ever hold
+        # indices into these. Card i's text runs from offsets[i] to offsets[i + 1], and is only decoded when a
+        # message needs it.
+        self.__white_text = b""
+        self.__white_offsets = None
+        self.__black_text = b""
+        self.__black_offsets = None
+        # Where each colour's text starts; both colours share one block when loaded from a pack.
+        self.__white_base = 0
+        self.__black_base = 0
+        # The number of white cards each black card asks for, parallel to the black card offsets.
+        self.__black_card_picks = bytearray()
+        # These are dicts of (deck, range of card indices).
+        self.__deck_white_ids = {}
+        self.__deck_black_ids = {}
+        # The index of the first card with the same text as each card, parallel to the offsets.
+        self.__white_canonical_ids = None
+        self.__black_canonical_ids = None
+        # These are dicts of (card text, canonical ID), only built once something asks for a card by its text.
+        self.__white_index = None
+        self.__black_index = None
+        self.__index_lock = threading.Lock()
+        self.__unions = DeckUnions(self)
+
+        deck_list, files, self.__source_hash = read_deck_files(path)
+        # This is a dict of (deck, name), in the order decks are listed.
+        self.__deck_names = {d: name for d, name, filename in deck_list}
+        if pack_path is None or not self.__load_pack(pack_path):
+            self.__load_text(files)
+
+        # The void card isn't part of any deck; it's only drawn when every black card is gone.
+        self.__void_black_card_id = self.get_num_black_cards() - 1
+
+        if self.get_num_white_cards() > MAX_CARDS or self.get_num_black_cards() > MAX_CARDS:
+            raise ValueError("Too many cards for %s card IDs" % CARD_ID_TYPECODE)
+
+    def __load_text(self, files):
+        white_cards = []
+        black_cards = []
+        for d, (white, black) in files.items():
+            start = len(white_cards)
+            for wc in white.decode("utf-8").splitlines():
+                white_cards.append(wc.encode("utf-8"))
+            self.__deck_white_ids[d] = range(start, len(white_cards))
+
+            start = len(black_cards)
+            for bc in black.decode("utf-8").splitlines():
+                bc_split = bc.split("|")
+                self.__black_card_picks.append(int(bc_split[0]))
+                black_cards.append(bc_split[1].encode("utf-8"))
+            self.__deck_black_ids[d] = range(start, len(black_cards))
+
+        self.__black_card_picks.append(VOID_BLACK_CARD[0])
+        black_cards.append(VOID_BLACK_CARD[1].encode("utf-8"))
+
+        self.__white_text = b"".join(white_cards)
+        self.__white_offsets = make_offsets(white_cards)
+        self.__black_text = b"".join(black_cards)
+        self.__black_offsets = make_offsets(black_cards)
+        self.__white_canonical_ids = make_canonical_ids(white_cards)
+        self.__black_canonical_ids = make_canonical_ids(zip(self.__black_card_picks, black_cards))
+
+        # Saved games refer to cards by index, so they're tagged with this to detect edits to the deck files.
+        fingerprint = hashlib.sha1()
+        for wc in white_cards:
+            fingerprint.update(wc + b"\n")
+        for pick, bc in zip(self.__black_card_picks, black_cards):
+            fingerprint.update(b"%d|%s\n" % (pick, bc))
+        self.__fingerprint = fingerprint.hexdigest()
+
+        self.__memory_size = (len(self.__white_text) + len(self.__black_text) + len(self.__black_card_picks) +
+                              self.__white_offsets.itemsize * (len(self.__white_offsets) +
+                                                               len(self.__black_offsets)) +
+                              self.__white_canonical_ids.itemsize * (len(self.__white_canonical_ids) +
+                                                                     len(self.__black_canonical_ids)))
+
+    def __load_pack(self, pack_path):
+        # Maps the pack instead of reading it, so every process using it shares the same pages. Returns False if
+        # there's no usable pack.
+        try:
+            with open(pack_path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            INFO_LOGGER.info("No deck pack at %s; parsing the deck files instead.", pack_path)
+            return False
+
+        try:
+            magic, source_hash, fingerprint, num_decks, num_white, num_black = PACK_HEADER.unpack_from(data)
+            if magic != PACK_MAGIC:
+                raise ValueError("not a deck pack, or one built by another version")
+            if source_hash != self.__source_hash:
+                INFO_LOGGER.info("The deck files changed since %s was built; parsing them instead.", pack_path)
+                data.close()
+                return False
+
+            pos = PACK_HEADER.size
+            for i in range(num_decks):
+                d, white_start, white_end, black_start, black_end = PACK_DECK.unpack_from(data, pos)
+                self.__deck_white_ids[d] = range(white_start, white_end)
+                self.__deck_black_ids[d] = range(black_start, black_end)
+                pos += PACK_DECK.size
+
+            view = memoryview(data)
+            white_offsets = view[pos:pos + 4 * (num_white + 1)].cast(OFFSET_TYPECODE)
+            pos += 4 * (num_white + 1)
+            black_offsets = view[pos:pos + 4 * (num_black + 1)].cast(OFFSET_TYPECODE)
+            pos += 4 * (num_black + 1)
+            white_canonical_ids = view[pos:pos + 2 * num_white].cast(CARD_ID_TYPECODE)
+            pos += 2 * num_white
+            black_canonical_ids = view[pos:pos + 2 * num_black].cast(CARD_ID_TYPECODE)
+            pos += 2 * num_black
+            black_card_picks = view[pos:pos + num_black]
+            pos += num_black
+            if sys.byteorder != "little":
+                white_offsets = array(OFFSET_TYPECODE, white_offsets)
+                white_offsets.byteswap()
+                black_offsets = array(OFFSET_TYPECODE, black_offsets)
+                black_offsets.byteswap()
+                white_canonical_ids = array(CARD_ID_TYPECODE, white_canonical_ids)
+                white_canonical_ids.byteswap()
+                black_canonical_ids = array(CARD_ID_TYPECODE, black_canonical_ids)
+                black_canonical_ids.byteswap()
+            if pos + white_offsets[-1] + black_offsets[-1] != len(data):
+                raise ValueError("truncated")
+        except (struct.error, ValueError, TypeError) as e:
+            ERROR_LOGGER.warning("Ignoring broken deck pack %s: %s", pack_path, e)
+            self.__deck_white_ids = {}
+            self.__deck_black_ids = {}
+            return False
+
+        self.__white_offsets = white_offsets
+        self.__black_offsets = black_offsets
+        self.__white_canonical_ids = white_canonical_ids
+        self.__black_canonical_ids = black_canonical_ids
+        self.__black_card_picks = black_card_picks
+        self.__white_text = data
+        self.__black_text = data
+        self.__white_base = pos
+        self.__black_base = pos + white_offsets[-1]
+        self.__fingerprint = fingerprint.decode("ascii")
+        # All of it is shared with every other process that maps the pack.
+        self.__memory_size = len(data)
+        return True
+
+    def save_pack(self, pack_path=PACK_PATH):
+        num_white = self.get_num_white_cards()
+        num_black = self.get_num_black_cards()
+        white_offsets = array(OFFSET_TYPECODE, self.__white_offsets)
+        black_offsets = array(OFFSET_TYPECODE, self.__black_offsets)
+        white_canonical_ids = array(CARD_ID_TYPECODE, self.__white_canonical_ids)
+        black_canonical_ids = array(CARD_ID_TYPECODE, self.__black_canonical_ids)
+        if sys.byteorder != "little":
+            for a in (white_offsets, black_offsets, white_canonical_ids, black_canonical_ids):
+                a.byteswap()
+
+        parts = [PACK_HEADER.pack(PACK_MAGIC, self.__source_hash, self.__fingerprint.encode("ascii"),
+                                  len(self.__deck_white_ids), num_white, num_black)]
+        for d in self.__deck_white_ids:
+            white_ids = self.__deck_white_ids[d]
+            black_ids = self.__deck_black_ids[d]
+            parts.append(PACK_DECK.pack(d, white_ids.start, white_ids.stop, black_ids.start, black_ids.stop))
+        parts += [white_offsets.tobytes(), black_offsets.tobytes(), white_canonical_ids.tobytes(),
+                  black_canonical_ids.tobytes(), bytes(self.__black_card_picks),
+                  self.__white_text[self.__white_base:self.__white_base + self.__white_offsets[-1]],
+                  self.__black_text[self.__black_base:self.__black_base + self.__black_offsets[-1]]]
+
+        # Written to the side and swapped in, so a process starting up never maps half a pack.
+        tmp_path = "%s.tmp" % pack_path
+        with open(tmp_path, "wb") as f:
+            for part in parts:
+                f.write(part)
+        os.replace(tmp_path, pack_path)
+
+    def get_white_card(self, i):
+        return self.__white_text[self.__white_base + self.__white_offsets[i]:
+                                 self.__white_base + self.__white_offsets[i + 1]].decode("utf-8")
+
+    def get_black_card(self, i):
+        # Returns (num cards to submit, text).
+        return self.__black_card_picks[i], self.__black_text[self.__black_base + self.__black_offsets[i]:
+                                                             self.__black_base + self.__black_offsets[i + 1]
+                                                             ].decode("utf-8")
+
+    def get_black_card_pick(self, i):
+        return self.__black_card_picks[i]
+
+    def get_deck_ids(self):
+        return list(self.__deck_names.keys())
+
+    def get_deck_name(self, deck):
+        return self.__deck_names[deck]
+
+    def has_deck(self, deck):
+        return deck in self.__deck_names
+
+    def get_deck_white_ids(self, deck):
+        return self.__deck_white_ids[deck]
+
+    def get_deck_black_ids(self, deck):
+        return self.__deck_black_ids[deck]
+
+    def get_canonical_white_ids(self, deck):
+        # Returns the deck's white cards with repeats of cards from other decks replaced by the first copy.
+        white_ids = self.__deck_white_ids[deck]
+        return self.__white_canonical_ids[white_ids.start:white_ids.stop]
+
+    def get_canonical_black_ids(self, deck):
+        black_ids = self.__deck_black_ids[deck]
+        return self.__black_canonical_ids[black_ids.start:black_ids.stop]
+
+    def get_card_ids(self, decks):
+        # Returns (white card IDs, black card IDs) for a game using these decks, each card once. The arrays are
+        # shared between games, so copy them before changing them.
+        return self.__unions.get(decks)
+
+    def find_white_card(self, text):
+        # Returns the canonical ID of the white card with this text, or None.
+        return self.__get_indices()[0].get(text)
+
+    def find_black_card(self, pick, text):
+        return self.__get_indices()[1].get((pick, text))
+
+    def __get_indices(self):
+        # Only uploaded decks look cards up by text, so the built-in text isn't decoded until one is played.
+        with self.__index_lock:
+            if self.__white_index is None:
+                self.__white_index = {}
+                for i in range(self.get_num_white_cards()):
+                    self.__white_index.setdefault(self.get_white_card(i), i)
+                self.__black_index = {}
+                for i in range(self.get_num_black_cards()):
+                    self.__black_index.setdefault(self.get_black_card(i), i)
+            return self.__white_index, self.__black_index
+
+    def get_void_black_card_id(self):
+        return self.__void_black_card_id
+
+    def get_fingerprint(self):
+        return self.__fingerprint
+
+    def get_memory_size(self):
+        return self.__memory_size
+
+    def get_num_white_cards(self):
+        return len(self.__white_offsets) - 1
+
+    def get_num_black_cards(self):
+        return len(self.__black_offsets) - 1
+
+
+_CORPUS = None
+
+
+def get_corpus():
+    global _CORPUS
+    if _CORPUS is None:
+        _CORPUS = CardCorpus()
+    return _CORPUS
+
+
+def build_pack(path=CARDS_PATH, pack_path=PACK_PATH):
+    corpus = CardCorpus(path, pack_path=None)
+    corpus.save_pack(pack_path)
+    return corpus
+
+
+if __name__ == "__main__":
+    corpus = build_pack()
+    print("Packed %d white and %d black cards into %s." % (corpus.get_num_white_cards(),
+                                                           corpus.get_num_black_cards(), PACK_PATH))
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from array import array
+
+import bisect
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from card_corpus import CARD_ID_TYPECODE, MAX_CARDS, MAX_PICK, UNION_CACHE_SIZE, DeckUnions
+from message_queue import TokenBucket
+
+# Uploaded decks are kept here, one file per deck named after its key.
+CUSTOM_DECKS_PATH = os.environ.get("CUSTOM_DECKS_PATH", "./custom_decks")
+
+# Limits on what can be uploaded. Every game's cards have to fit in MAX_CARDS IDs alongside the built-in decks.
+MAX_UPLOAD_BYTES = 256 * 1024
+MAX_DECK_NAME_LENGTH = 64
+MAX_CARD_LENGTH = 300
+MAX_WHITE_CARDS = 2000
+MAX_BLACK_CARDS = 1000
+MAX_CUSTOM_DECKS_PER_GAME = 5
+
+# How many uploaded decks are kept in memory, least recently used first out; the rest are read back from disk when a
+# game needs them. Past MAX_STORED_DECKS on disk, new uploads are refused.
+MAX_LOADED_DECKS = 256
+MAX_STORED_DECKS = 10000
+
+# Each user can upload this many decks at once, then one every UPLOAD_INTERVAL seconds. At most MAX_QUEUED_UPLOADS
+# downloads wait for the upload threads at a time.
+UPLOAD_BURST = 5
+UPLOAD_INTERVAL = 15 * 60
+MAX_QUEUED_UPLOADS = 16
+
+KEY_LENGTH = 12
+KEY_PATTERN = re.compile("^[0-9a-f]{%d}$" % KEY_LENGTH)
+
+ERROR_LOGGER = logging.getLogger("error_logger")
+
+
+class DeckError(ValueError):
+    # The message is shown to whoever uploaded the deck.
+    pass
+
+
+def is_custom_deck_key(deck):
+    return isinstance(deck, str) and KEY_PATTERN.match(deck) is not None
+
+
+def clean_card(text):
+    # Cards are shown on one line, so runs of whitespace (newlines included) become single spaces.
+    text = " ".join(str(text).split())
+    if len(text) > MAX_CARD_LENGTH:
+        raise DeckError("Cards can be at most %d characters long." % MAX_CARD_LENGTH)
+    return text
+
+
+def parse_custom_deck(data):
+    # Takes an uploaded file of the form {"name": ..., "white": [text, ...], "black": [{"text": ..., "pick": n}, ...]}
+    # and returns a CustomDeck. Empty and repeated cards are dropped.
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise DeckError("Decks can be at most %d KB." % (MAX_UPLOAD_BYTES // 1024))
+    try:
+        deck = json.loads(bytes(data).decode("utf-8"))
+    except (UnicodeDecodeError, ValueError):
+        raise DeckError("That isn't a JSON file.")
+    if not isinstance(deck, dict) or not isinstance(deck.get("white", []), list) or \
+            not isinstance(deck.get("black", []), list):
+        raise DeckError('A deck looks like {"name": "My Deck", "white": ["A card."], '
+                        '"black": [{"text": "Why ____?", "pick": 1}]}.')
+
+    name = clean_card(deck.get("name", ""))[:MAX_DECK_NAME_LENGTH] or "Custom Deck"
+
+    white_cards = []
+    seen = set()
+    for wc in deck.get("white", []):
+        wc = clean_card(wc)
+        if wc and wc not in seen:
+            seen.add(wc)
+            white_cards.append(wc)
+
+    black_cards = []
+    seen = set()
+    for bc in deck.get("black", []):
+        if not isinstance(bc, dict):
+            raise DeckError('Black cards look like {"text": "Why ____?", "pick": 1}.')
+        text = clean_card(bc.get("text", ""))
+        pick = bc.get("pick", 1)
+        if not isinstance(pick, int) or not 1 <= pick <= MAX_PICK:
+            raise DeckError("Black cards can ask for 1 to %d white cards." % MAX_PICK)
+        if text and (pick, text) not in seen:
+            seen.add((pick, text))
+            black_cards.append((pick, text))
+
+    if not white_cards and not black_cards:
+        raise DeckError("That deck has no cards.")
+    if len(white_cards) > MAX_WHITE_CARDS or len(black_cards) > MAX_BLACK_CARDS:
+        raise DeckError("Decks can have at most %d white and %d black cards." % (MAX_WHITE_CARDS, MAX_BLACK_CARDS))
+    return CustomDeck(name, white_cards, black_cards)
+
+
+class CustomDeck:
+    __slots__ = ("__key", "__name", "__white_cards", "__black_cards", "__black_card_picks")
+
+    def __init__(self, name, white_cards, black_cards):
+        # black_cards is a list of (num cards to submit, text).
+        self.__name = name
+        self.__white_cards = tuple(white_cards)
+        self.__black_cards = tuple(text for pick, text in black_cards)
+        self.__black_card_picks = bytes(pick for pick, text in black_cards)
+        # The key only depends on the cards, so the same deck uploaded under another name is still shared.
+        content = json.dumps([self.__white_cards, black_cards], ensure_ascii=False, separators=(",", ":"))
+        self.__key = hashlib.sha256(content.encode("utf-8")).hexdigest()[:KEY_LENGTH]
+
+    def get_key(self):
+        return self.__key
+
+    def get_name(self):
+        return self.__name
+
+    def get_white_card(self, i):
+        return self.__white_cards[i]
+
+    def get_black_card(self, i):
+        return self.__black_card_picks[i], self.__black_cards[i]
+
+    def get_black_card_pick(self, i):
+        return self.__black_card_picks[i]
+
+    def get_num_white_cards(self):
+        return len(self.__white_cards)
+
+    def get_num_black_cards(self):
+        return len(self.__black_cards)
+
+    def to_json(self):
+        return json.dumps({"name": self.__name, "white": list(self.__white_cards),
+                           "black": [{"text": text, "pick": pick}
+                                     for pick, text in zip(self.__black_card_picks, self.__black_cards)]},
+                          ensure_ascii=False)
+
+
+class CustomDeckStore:
+    # Every uploaded deck is parsed once and kept by key, so any number of chats playing it share one copy.
+    def __init__(self, path=CUSTOM_DECKS_PATH):
+        self.__path = path
+        self.__lock = threading.Lock()
+        # This is a dict of (key, CustomDeck), least recently used first.
+        self.__decks = collections.OrderedDict()
+        # How many decks are on disk, counted the first time one is added.
+        self.__num_stored = None
+        # This is a dict of (tuple of keys, CorpusUnion), least recently used first.
+        self.__unions = collections.OrderedDict()
+
+    def add(self, deck):
+        # Returns the stored deck, which is an earlier upload if someone already sent the same cards.
+        # Raises DeckError if no more decks can be stored.
+        key = deck.get_key()
+        with self.__lock:
+            existing = self.__decks.get(key)
+            if existing is not None:
+                self.__decks.move_to_end(key)
+                return existing
+        if not os.path.exists(self.__get_file(key)):
+            with self.__lock:
+                if self.__num_stored is None:
+                    self.__num_stored = self.__count_stored()
+                if self.__num_stored >= MAX_STORED_DECKS:
+                    raise DeckError("There's no room for more decks right now.")
+                self.__num_stored += 1
+            try:
+                os.makedirs(self.__path, exist_ok=True)
+                # Written to the side and swapped in, so a crash never leaves half a deck behind.
+                tmp_path = "%s.tmp" % self.__get_file(key)
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(deck.to_json())
+                os.replace(tmp_path, self.__get_file(key))
+            except OSError:
+                with self.__lock:
+                    self.__num_stored -= 1
+                raise
+        return self.__remember(key, deck)
+
+    def get(self, key):
+        # Returns None if there's no deck with this key.
+        if not is_custom_deck_key(key):
+            return None
+        with self.__lock:
+            deck = self.__decks.get(key)
+            if deck is not None:
+                self.__decks.move_to_end(key)
+                return deck
+
+        try:
+            with open(self.__get_file(key), "rb") as f:
+                deck = parse_custom_deck(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, DeckError) as e:
+            ERROR_LOGGER.warning("Failed to load custom deck %s: %s", key, e)
+            return None
+        return self.__remember(key, deck)
+
+    def __remember(self, key, deck):
+        with self.__lock:
+            deck = self.__decks.setdefault(key, deck)
+            self.__decks.move_to_end(key)
+            while len(self.__decks) > MAX_LOADED_DECKS:
+                self.__decks.popitem(last=False)
+            return deck
+
+    def __count_stored(self):
+        try:
+            return sum(1 for name in os.listdir(self.__path) if name.endswith(".json"))
+        except FileNotFoundError:
+            return 0
+
+    def get_union(self, corpus, keys):
+        # Returns a CorpusUnion of the corpus and these decks, shared by every game playing the same ones. Raises
+        # DeckError if a deck is missing.
+        keys = tuple(keys)
+        with self.__lock:
+            union = self.__unions.get(keys)
+            if union is not None:
+                self.__unions.move_to_end(keys)
+                return union
+
+        custom_decks = []
+        for key in keys:
+            deck = self.get(key)
+            if deck is None:
+                raise DeckError("Deck %s isn't available any more." % key)
+            custom_decks.append(deck)
+        union = CorpusUnion(corpus, custom_decks)
+
+        with self.__lock:
+            union = self.__unions.setdefault(keys, union)
+            self.__unions.move_to_end(keys)
+            if len(self.__unions) > UNION_CACHE_SIZE:
+                self.__unions.popitem(last=False)
+        return union
+
+    def get_num_decks(self):
+        return len(self.__decks)
+
+    def __get_file(self, key):
+        return "%s/%s.json" % (self.__path, key)
+
+
+class UploadLimiter:
+    # Keeps anyone from filling memory or disk with uploads: each user gets a few at once and then one every so
+    # often, and only so many downloads can be waiting at a time.
+    def __init__(self, burst=UPLOAD_BURST, interval=UPLOAD_INTERVAL, max_queued=MAX_QUEUED_UPLOADS):
+        self.__burst = burst
+        self.__interval = interval
+        self.__max_queued = max_queued
+        self.__lock = threading.Lock()
+        # This is a dict of (Telegram ID, TokenBucket) for users who have uploaded recently.
+        self.__buckets = {}
+        self.__num_queued = 0
+
+    def start(self, user_id):
+        # Raises DeckError if the user can't upload right now. Call finish once the upload is done.
+        now = time.monotonic()
+        with self.__lock:
+            if self.__num_queued >= self.__max_queued:
+                raise DeckError("Too many decks are being uploaded right now. Try again in a minute?")
+            bucket = self.__buckets.get(user_id)
+            if bucket is None:
+                bucket = TokenBucket(1 / self.__interval, self.__burst)
+                self.__buckets[user_id] = bucket
+            wait = bucket.get_wait(now)
+            if wait > 0:
+                raise DeckError("You can upload another deck in %d minutes." % (wait // 60 + 1))
+            bucket.consume(now)
+            self.__num_queued += 1
+            # Forget users whose allowance has grown back, so this only holds recent uploaders.
+            for other_id, other in list(self.__buckets.items()):
+                if other.is_full(now):
+                    del self.__buckets[other_id]
+
+    def finish(self):
+        with self.__lock:
+            self.__num_queued -= 1
+
+
+class CorpusUnion:
+    # Looks like a CardCorpus to a game, but with custom decks after the built-in cards. Custom card IDs are
+    # offsets past the built-in ones, in the order the decks are given.
+    def __init__(self, corpus, custom_decks):
+        self.__corpus = corpus
+        self.__custom_decks = custom_decks
+        # Where each custom deck's cards start.
+        self.__white_starts = []
+        self.__black_starts = []
+        # This is a dict of (key, index into custom_decks).
+        self.__indices = {}
+        # The canonical ID of each custom card, counted from the first custom card. Cards that are also built in,
+        # or in an earlier custom deck, map to that copy.
+        self.__white_canonical_ids = array(CARD_ID_TYPECODE)
+        self.__black_canonical_ids = array(CARD_ID_TYPECODE)
+
+        num_white = corpus.get_num_white_cards()
+        num_black = corpus.get_num_black_cards()
+        if num_white + sum(d.get_num_white_cards() for d in custom_decks) > MAX_CARDS or \
+                num_black + sum(d.get_num_black_cards() for d in custom_decks) > MAX_CARDS:
+            raise DeckError("Those decks have too many cards to play together.")
+
+        # These are dicts of (card text, ID) for the custom cards seen so far.
+        white_ids = {}
+        black_ids = {}
+        for i, deck in enumerate(custom_decks):
+            self.__indices[deck.get_key()] = i
+            self.__white_starts.append(num_white)
+            self.__black_starts.append(num_black)
+            for j in range(deck.get_num_white_cards()):
+                text = deck.get_white_card(j)
+                canonical_id = corpus.find_white_card(text)
+                if canonical_id is None:
+                    canonical_id = white_ids.setdefault(text, num_white + j)
+                self.__white_canonical_ids.append(canonical_id)
+            for j in range(deck.get_num_black_cards()):
+                card = deck.get_black_card(j)
+                canonical_id = corpus.find_black_card(*card)
+                if canonical_id is None:
+                    canonical_id = black_ids.setdefault(card, num_black + j)
+                self.__black_canonical_ids.append(canonical_id)
+            num_white += deck.get_num_white_cards()
+            num_black += deck.get_num_black_cards()
+        self.__num_white_cards = num_white
+        self.__num_black_cards = num_black
+        self.__unions = DeckUnions(self)
+
+    def __find(self, starts, i):
+        # Returns (custom deck, index within it) for a custom card ID.
+        j = bisect.bisect_right(starts, i) - 1
+        return self.__custom_decks[j], i - starts[j]
+
+    def get_white_card(self, i):
+        if i < self.__corpus.get_num_white_cards():
+            return self.__corpus.get_white_card(i)
+        deck, i = self.__find(self.__white_starts, i)
+        return deck.get_white_card(i)
+
+    def get_black_card(self, i):
+        if i < self.__corpus.get_num_black_cards():
+            return self.__corpus.get_black_card(i)
+        deck, i = self.__find(self.__black_starts, i)
+        return deck.get_black_card(i)
+
+    def get_black_card_pick(self, i):
+        if i < self.__corpus.get_num_black_cards():
+            return self.__corpus.get_black_card_pick(i)
+        deck, i = self.__find(self.__black_starts, i)
+        return deck.get_black_card_pick(i)
+
+    def get_deck_white_ids(self, deck):
+        if not is_custom_deck_key(deck):
+            return self.__corpus.get_deck_white_ids(deck)
+        i = self.__indices[deck]
+        start = self.__white_starts[i]
+        return range(start, start + self.__custom_decks[i].get_num_white_cards())
+
+    def get_deck_black_ids(self, deck):
+        if not is_custom_deck_key(deck):
+            return self.__corpus.get_deck_black_ids(deck)
+        i = self.__indices[deck]
+        start = self.__black_starts[i]
+        return range(start, start + self.__custom_decks[i].get_num_black_cards())
+
+    def get_canonical_white_ids(self, deck):
+        if not is_custom_deck_key(deck):
+            return self.__corpus.get_canonical_white_ids(deck)
+        white_ids = self.get_deck_white_ids(deck)
+        start = self.__corpus.get_num_white_cards()
+        return self.__white_canonical_ids[white_ids.start - start:white_ids.stop - start]
+
+    def get_canonical_black_ids(self, deck):
+        if not is_custom_deck_key(deck):
+            return self.__corpus.get_canonical_black_ids(deck)
+        black_ids = self.get_deck_black_ids(deck)
+        start = self.__corpus.get_num_black_cards()
+        return self.__black_canonical_ids[black_ids.start - start:black_ids.stop - start]
+
+    def get_card_ids(self, decks):
+        return self.__unions.get(decks)
+
+    def get_void_black_card_id(self):
+        return self.__corpus.get_void_black_card_id()
+
+    def get_fingerprint(self):
+        # Custom decks are named by their content, so only the built-in cards can change under a saved game.
+        return self.__corpus.get_fingerprint()
+
+    def get_num_white_cards(self):
+        return self.__num_white_cards
+
+    def get_num_black_cards(self):
+        return self.__num_black_cards
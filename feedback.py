@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import logging
+import threading
+import time
+
+# How long (in seconds) the writer waits to batch up feedback before hitting the disk.
+FLUSH_INTERVAL = 1
+
+ERROR_LOGGER = logging.getLogger("error_logger")
+
+
+class FeedbackLog:
+    # Appends one JSON object per line, so the file can be read back or shipped elsewhere line by line.
+    def __init__(self, path):
+        self.__path = path
+        self.__cond = threading.Condition()
+        # Serialized entries waiting to be written.
+        self.__pending = []
+        self.__stopped = False
+        self.__writer = None
+
+    def start(self):
+        if self.__writer is None:
+            self.__stopped = False
+            self.__writer = threading.Thread(target=self.__work, name="feedback_log", daemon=True)
+            self.__writer.start()
+
+    def stop(self):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
+        if self.__writer is not None:
+            self.__writer.join()
+            self.__writer = None
+
+    def add(self, user, chat_id, text):
+        entry = json.dumps({"time": time.time(), "user_id": user.id, "first_name": user.first_name,
+                            "username": user.username, "chat_id": chat_id, "text": text},
+                           ensure_ascii=False, separators=(",", ":"))
+        with self.__cond:
+            self.__pending.append(entry)
+            self.__cond.notify()
+
+    def flush(self):
+        with self.__cond:
+            pending = self.__pending
+            self.__pending = []
+        if not pending:
+            return
+
+        try:
+            with open(self.__path, "a", encoding="utf-8") as f:
+                f.write("\n".join(pending) + "\n")
+        except OSError as e:
+            ERROR_LOGGER.warning("Failed to write %d feedback entries: %s", len(pending), e)
+
+    def __work(self):
+        while True:
+            with self.__cond:
+                while not self.__pending and not self.__stopped:
+                    self.__cond.wait()
+                stopped = self.__stopped
+            if not stopped:
+                with self.__cond:
+                    self.__cond.wait_for(lambda: self.__stopped, FLUSH_INTERVAL)
+            self.flush()
+            if stopped:
+                return
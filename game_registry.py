@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+import time
+
+
+class ChatState:
+    __slots__ = ("chat_id", "is_game_pending", "is_game_starting", "pending_players", "game_obj", "decks", "hand_messages", "last_active",
+                 "deadline", "lock")
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.is_game_pending = False
+        # Set while /startgame waits to hear back from every player. The lobby is closed but the players still
+        # belong to it, so nothing may open a new lobby or join this one until the start finishes or fails.
+        self.is_game_starting = False
+        # Pending players is a dict of (Telegram ID, nickname).
+        self.pending_players = {}
+        self.game_obj = None
+        self.decks = []
+        # This is a dict of (Telegram ID, (future of the message showing their hand, card IDs it shows)), so hands
+        # are edited in place and only when they change.
+        self.hand_messages = {}
+        # Wall clock time of the last command for this chat, used to put idle games to sleep.
+        self.last_active = time.time()
+        # The game's pending round deadline as ((round, phase), ScheduledCall), or None.
+        self.deadline = None
+        # Held while anything reads or changes this chat's lobby or game. Chats never share a lock, so
+        # different games run fully in parallel.
+        self.lock = threading.RLock()
+
+    def reset(self):
+        self.is_game_pending = False
+        self.is_game_starting = False
+        self.pending_players = {}
+        self.game_obj = None
+        self.decks = []
+        self.hand_messages = {}
+        self.deadline = None
+
+
+class GameRegistry:
+    def __init__(self, listener=None):
+        # This is a dict of (chat ID, ChatState).
+        self.__chats = {}
+        # This is a dict of (Telegram ID, chat ID) for every pending or active player, hibernated games included.
+        self.__user_to_chat = {}
+        # Games that were idle long enough to be moved out of memory and into the game store, as a dict of
+        # (chat ID, (last active time, tuple of Telegram IDs)).
+        self.__hibernated = {}
+        # Only guards the two dicts above, never a game. Don't take a chat's lock while holding it.
+        self.__lock = threading.Lock()
+        # Called as listener(user ID, chat ID, joined) whenever a user joins or leaves a chat. It runs under the
+        # lock above, so it must not block or call back into the registry.
+        self.__listener = listener
+
+    def set_listener(self, listener):
+        self.__listener = listener
+
+    def get_chat(self, chat_id):
+        return self.__chats.get(chat_id)
+
+    def get_or_create_chat(self, chat_id):
+        with self.__lock:
+            chat = self.__chats.get(chat_id)
+            if chat is None:
+                chat = ChatState(chat_id)
+                self.__chats[chat_id] = chat
+            return chat
+
+    def get_game(self, chat_id):
+        chat = self.__chats.get(chat_id)
+        return None if chat is None else chat.game_obj
+
+    def get_chat_id_for_user(self, user_id):
+        return self.__user_to_chat.get(user_id)
+
+    def get_chat_for_user(self, user_id):
+        chat_id = self.__user_to_chat.get(user_id)
+        return None if chat_id is None else self.__chats.get(chat_id)
+
+    def add_user(self, chat_id, user_id):
+        # Returns False if the user is already playing in a different chat.
+        with self.__lock:
+            other_chat_id = self.__user_to_chat.get(user_id)
+            if other_chat_id is not None and other_chat_id != chat_id:
+                return False
+            if other_chat_id is None:
+                self.__user_to_chat[user_id] = chat_id
+                if self.__listener is not None:
+                    self.__listener(user_id, chat_id, True)
+            return True
+
+    def remove_user(self, chat_id, user_id):
+        with self.__lock:
+            self.__remove_user(chat_id, user_id)
+
+    def __remove_user(self, chat_id, user_id):
+        # Only drop the index entry if it still points at this chat.
+        if self.__user_to_chat.get(user_id) == chat_id:
+            del self.__user_to_chat[user_id]
+            if self.__listener is not None:
+                self.__listener(user_id, chat_id, False)
+
+    def reset_chat(self, chat_id):
+        with self.__lock:
+            chat = self.__chats.get(chat_id)
+            if chat is None:
+                return
+
+            user_ids = set(chat.pending_players.keys())
+            if chat.game_obj is not None:
+                user_ids.update(chat.game_obj.get_players().keys())
+            for user_id in user_ids:
+                self.__remove_user(chat_id, user_id)
+
+            del self.__chats[chat_id]
+
+    def hibernate_chat(self, chat_id):
+        # Drops a game from memory; its players stay indexed so their next command can wake it up.
+        with self.__lock:
+            chat = self.__chats.pop(chat_id, None)
+            if chat is not None:
+                user_ids = tuple(chat.game_obj.get_players().keys())
+                self.__hibernated[chat_id] = (chat.last_active, user_ids)
+
+    def add_hibernated(self, chat_id, last_active, user_ids):
+        # Registers a saved game without loading it, e.g. at startup.
+        for user_id in user_ids:
+            self.add_user(chat_id, user_id)
+        with self.__lock:
+            self.__hibernated[chat_id] = (last_active, tuple(user_ids))
+
+    def wake_chat(self, chat_id, restore):
+        # Returns False if the chat isn't hibernated. Otherwise calls restore(chat) with a fresh, locked ChatState that other commands can
+        # already find and will wait on. If restore returns False the game is dropped for good.
+        with self.__lock:
+            entry = self.__hibernated.pop(chat_id, None)
+            if entry is None:
+                return False
+            chat = ChatState(chat_id)
+            chat.last_active = entry[0]
+            # Nobody else can hold a lock that was just created, so this never waits.
+            chat.lock.acquire()
+            self.__chats[chat_id] = chat
+
+        restored = False
+        try:
+            restored = restore(chat)
+        finally:
+            if not restored:
+                with self.__lock:
+                    for user_id in entry[1]:
+                        self.__remove_user(chat_id, user_id)
+                    if self.__chats.get(chat_id) is chat:
+                        del self.__chats[chat_id]
+            chat.lock.release()
+        return True
+
+    def forget_hibernated(self, chat_id):
+        # Returns False if the chat wasn't hibernated (or was woken up in the meantime).
+        with self.__lock:
+            entry = self.__hibernated.pop(chat_id, None)
+            if entry is None:
+                return False
+            for user_id in entry[1]:
+                self.__remove_user(chat_id, user_id)
+            return True
+
+    def is_hibernated(self, chat_id):
+        return chat_id in self.__hibernated
+
+    def get_hibernated(self):
+        # Returns a list of (chat ID, last active time).
+        with self.__lock:
+            return [(chat_id, entry[0]) for chat_id, entry in self.__hibernated.items()]
+
+    def get_num_hibernated(self):
+        return len(self.__hibernated)
+
+    def get_chats(self):
+        with self.__lock:
+            return list(self.__chats.values())
+
+    def get_num_games(self):
+        return sum(1 for chat in self.get_chats() if chat.game_obj is not None)
+
+    def get_num_players(self):
+        return len(self.__user_to_chat)
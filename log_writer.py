@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+import logging
+import queue
+import sys
+import threading
+
+# Each log file is rotated once it reaches this many bytes, keeping this many old files.
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    # RotatingFileHandler flushes after every record; this one waits for the writer to finish a batch.
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class LogWriter:
+    # Handler threads only put records on a queue. One background thread formats them and writes them out in
+    # batches, so a slow disk never stalls a command.
+    def __init__(self):
+        self.__queue = queue.SimpleQueue()
+        self.__handlers = []
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def add_logger(self, name, log_file, level=logging.INFO):
+        handler = BufferedRotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                              encoding="utf-8")
+        handler.setFormatter(logging.Formatter(FORMAT))
+        # Records only reach the handler for the logger they were logged on.
+        handler.addFilter(lambda record: record.name == name)
+        self.__handlers.append(handler)
+
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.addHandler(QueueHandler(self.__queue))
+        return logger
+
+    def start(self):
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__work, name="log_writer", daemon=True)
+                self.__thread.start()
+
+    def stop(self):
+        # Everything logged before this call is written out first.
+        with self.__lock:
+            thread = self.__thread
+            self.__thread = None
+        if thread is not None:
+            self.__queue.put(None)
+            thread.join()
+        for handler in self.__handlers:
+            handler.close()
+
+    def __write(self, record):
+        for handler in self.__handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def __work(self):
+        while True:
+            records = [self.__queue.get()]
+            # Take whatever else has piled up so the whole batch costs one flush.
+            try:
+                while len(records) < 1000:
+                    records.append(self.__queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            stopped = False
+            for record in records:
+                if record is None:
+                    stopped = True
+                    continue
+                try:
+                    self.__write(record)
+                except Exception as e:
+                    print("Failed to write log record: %s" % e, file=sys.stderr)
+            for handler in self.__handlers:
+                handler.flush_batch()
+            if stopped:
+                return
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, TimedOut, Unauthorized
+
+from collections import deque
+from concurrent.futures import Future
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from metrics import METRICS
+
+# Lower numbers are sent first.
+PRIORITY_GAME = 0
+PRIORITY_CHATTER = 1
+
+# Telegram allows roughly 30 messages per second overall, about one per second to a single private chat and
+# 20 per minute to a group. The burst sizes let short flurries (e.g. a round starting) go out immediately.
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+PRIVATE_CHAT_RATE = 1
+PRIVATE_CHAT_BURST = 5
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 20
+
+MAX_RETRIES = 3
+NUM_WORKERS = 8
+
+ERROR_LOGGER = logging.getLogger("error_logger")
+
+# Shared with the async runtime; every attempt counts, retries included.
+API_REQUESTS = METRICS.counter("cah_api_requests_total", "Bot API requests made.", ["method"])
+API_ERRORS = METRICS.counter("cah_api_errors_total", "Bot API requests that failed.", ["method", "error"])
+API_SECONDS = METRICS.histogram("cah_api_request_seconds", "Bot API request latency.", ["method"])
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.__rate = rate
+        self.__capacity = capacity
+        self.__tokens = capacity
+        self.__last = time.monotonic()
+
+    def __refill(self, now):
+        self.__tokens = min(self.__capacity, self.__tokens + (now - self.__last) * self.__rate)
+        self.__last = now
+
+    def get_wait(self, now):
+        # How long until a token is available, without consuming one.
+        self.__refill(now)
+        if self.__tokens >= 1:
+            return 0
+        return (1 - self.__tokens) / self.__rate
+
+    def consume(self, now):
+        self.__refill(now)
+        self.__tokens -= 1
+
+    def is_full(self, now):
+        self.__refill(now)
+        return self.__tokens >= self.__capacity
+
+
+class OutboundMessage:
+    def __init__(self, method, kwargs, priority):
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.attempts = 0
+
+
+class MessageQueue:
+    def __init__(self, bot, num_workers=NUM_WORKERS):
+        self.__bot = bot
+        self.__num_workers = num_workers
+        self.__workers = []
+        self.__cond = threading.Condition()
+        self.__stopped = False
+        self.__seq = itertools.count()
+        self.__global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        # These are dicts of (chat ID, deque of OutboundMessage) and (chat ID, TokenBucket).
+        self.__chat_queues = {}
+        self.__chat_buckets = {}
+        # Chats that are waiting in a heap or have a message in flight. A chat is never in both heaps at once,
+        # and at most one of its messages is in flight, which keeps each chat's messages in order.
+        self.__scheduled = set()
+        # Heap of (priority, seq, chat ID) for chats that can send right now.
+        self.__ready = []
+        # Heap of (time ready, seq, chat ID) for chats held back by their rate limit or a RetryAfter.
+        self.__delayed = []
+
+    def start(self):
+        with self.__cond:
+            if self.__workers:
+                return
+            self.__stopped = False
+            for i in range(self.__num_workers):
+                worker = threading.Thread(target=self.__work, name="message_queue_%d" % i, daemon=True)
+                self.__workers.append(worker)
+                worker.start()
+
+    def stop(self, timeout=None):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify_all()
+        for worker in self.__workers:
+            worker.join(timeout)
+        self.__workers = []
+
+    def submit(self, method, chat_id, priority=PRIORITY_GAME, **kwargs):
+        if not self.__workers:
+            self.start()
+
+        kwargs["chat_id"] = chat_id
+        message = OutboundMessage(method, kwargs, priority)
+        with self.__cond:
+            self.__chat_queues.setdefault(chat_id, deque()).append(message)
+            if chat_id not in self.__scheduled:
+                self.__schedule(chat_id, time.monotonic())
+        return message.future
+
+    def send(self, chat_id, text, parse_mode=None, priority=PRIORITY_GAME, **kwargs):
+        return self.submit("send_message", chat_id, priority=priority, text=text, parse_mode=parse_mode, **kwargs)
+
+    def get_num_pending(self):
+        with self.__cond:
+            return sum(len(q) for q in self.__chat_queues.values())
+
+    def __get_chat_bucket(self, chat_id):
+        bucket = self.__chat_buckets.get(chat_id)
+        if bucket is None:
+            # Group chats have negative IDs.
+            if chat_id < 0:
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            self.__chat_buckets[chat_id] = bucket
+        return bucket
+
+    def __schedule(self, chat_id, now, delay=0):
+        # Must be called with the lock held.
+        self.__scheduled.add(chat_id)
+        wait = max(delay, self.__get_chat_bucket(chat_id).get_wait(now))
+        if wait > 0:
+            heapq.heappush(self.__delayed, (now + wait, next(self.__seq), chat_id))
+        else:
+            priority = self.__chat_queues[chat_id][0].priority
+            heapq.heappush(self.__ready, (priority, next(self.__seq), chat_id))
+        self.__cond.notify()
+
+    def __finish(self, chat_id, now, delay=0):
+        # Must be called with the lock held once a chat's in-flight message is done.
+        self.__scheduled.discard(chat_id)
+        if self.__chat_queues.get(chat_id):
+            self.__schedule(chat_id, now, delay)
+            return
+
+        self.__chat_queues.pop(chat_id, None)
+        # Forget idle chats once their bucket has refilled so memory stays bounded by active chats.
+        if self.__get_chat_bucket(chat_id).is_full(now):
+            del self.__chat_buckets[chat_id]
+
+    def __next_message(self):
+        # Blocks until a message may be sent. Returns (chat ID, message), or None once stopped and drained.
+        with self.__cond:
+            while True:
+                now = time.monotonic()
+                while self.__delayed and self.__delayed[0][0] <= now:
+                    ready_at, seq, chat_id = heapq.heappop(self.__delayed)
+                    priority = self.__chat_queues[chat_id][0].priority
+                    heapq.heappush(self.__ready, (priority, seq, chat_id))
+
+                if self.__ready:
+                    wait = self.__global_bucket.get_wait(now)
+                    if wait <= 0:
+                        priority, seq, chat_id = heapq.heappop(self.__ready)
+                        self.__global_bucket.consume(now)
+                        self.__get_chat_bucket(chat_id).consume(now)
+                        return chat_id, self.__chat_queues[chat_id].popleft()
+                elif self.__delayed:
+                    wait = self.__delayed[0][0] - now
+                elif self.__stopped:
+                    return None
+                else:
+                    wait = None
+                self.__cond.wait(wait)
+
+    def __work(self):
+        while True:
+            item = self.__next_message()
+            if item is None:
+                return
+            chat_id, message = item
+
+            delay = 0
+            try:
+                message.attempts += 1
+                result = self.__call(message)
+            except (BadRequest, Unauthorized, ChatMigrated) as e:
+                # Sending the same request again won't help. BadRequest is a NetworkError, so this comes first.
+                self.__fail(message, e)
+            except (RetryAfter, TimedOut, NetworkError) as e:
+                if message.attempts > MAX_RETRIES:
+                    self.__fail(message, e)
+                else:
+                    # Put the message back at the front so the chat's order is kept.
+                    delay = e.retry_after if isinstance(e, RetryAfter) else 2 ** message.attempts
+                    with self.__cond:
+                        self.__chat_queues[chat_id].appendleft(message)
+            except Exception as e:
+                self.__fail(message, e)
+            else:
+                message.future.set_result(result)
+
+            with self.__cond:
+                self.__finish(chat_id, time.monotonic(), delay)
+
+    def __call(self, message):
+        start = time.perf_counter()
+        API_REQUESTS.inc(message.method)
+        try:
+            return getattr(self.__bot, message.method)(**message.kwargs)
+        except Exception as e:
+            API_ERRORS.inc(message.method, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, message.method)
+
+    def __fail(self, message, e):
+        ERROR_LOGGER.warning("Failed to %s to %s: %s", message.method, message.kwargs.get("chat_id"), e)
+        message.future.set_exception(e)
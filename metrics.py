@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bisect
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+ERROR_LOGGER = logging.getLogger("error_logger")
+
+
+def format_labels(label_names, label_values, extra=""):
+    pairs = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, label_names=()):
+        self.__name = name
+        self.__help = help
+        self.__label_names = tuple(label_names)
+        self.__lock = threading.Lock()
+        # This is a dict of (tuple of label values, count).
+        self.__values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self.__lock:
+            self.__values[label_values] = self.__values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.__values.get(label_values, 0)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.__name, self.__help), "# TYPE %s counter" % self.__name]
+        with self.__lock:
+            values = sorted(self.__values.items())
+        for label_values, value in values:
+            lines.append("%s%s %s" % (self.__name, format_labels(self.__label_names, label_values),
+                                      format_value(value)))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.__name = name
+        self.__help = help
+        self.__label_names = tuple(label_names)
+        self.__buckets = tuple(buckets)
+        self.__lock = threading.Lock()
+        # This is a dict of (tuple of label values, [count per bucket plus one for +Inf, sum]).
+        self.__values = {}
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.__buckets, value)
+        with self.__lock:
+            entry = self.__values.get(label_values)
+            if entry is None:
+                entry = self.__values[label_values] = [[0] * (len(self.__buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def get_count(self, *label_values):
+        entry = self.__values.get(label_values)
+        return 0 if entry is None else sum(entry[0])
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.__name, self.__help), "# TYPE %s histogram" % self.__name]
+        with self.__lock:
+            values = sorted((label_values, (list(counts), total)) for label_values, (counts, total)
+                            in self.__values.items())
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.__buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.__name, format_labels(self.__label_names, label_values,
+                                                                             'le="%s"' % format_value(bound)),
+                                                  cumulative))
+            labels = format_labels(self.__label_names, label_values)
+            lines.append("%s_sum%s %s" % (self.__name, labels, format_value(total)))
+            lines.append("%s_count%s %d" % (self.__name, labels, cumulative))
+        return lines
+
+
+class Gauge:
+    # Read when scraped rather than kept up to date, so the hot path never pays for it.
+    def __init__(self, name, help, function, label_names=()):
+        self.__name = name
+        self.__help = help
+        # Returns the value, or a dict of (tuple of label values, value) if there are labels.
+        self.__function = function
+        self.__label_names = tuple(label_names)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.__name, self.__help), "# TYPE %s gauge" % self.__name]
+        try:
+            value = self.__function()
+        except Exception as e:
+            ERROR_LOGGER.warning("Failed to read gauge %s: %s", self.__name, e)
+            return lines
+        values = sorted(value.items()) if self.__label_names else [((), value)]
+        for label_values, value in values:
+            lines.append("%s%s %s" % (self.__name, format_labels(self.__label_names, label_values),
+                                      format_value(value)))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.__metrics = []
+
+    def counter(self, name, help, label_names=()):
+        return self.__register(Counter(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.__register(Histogram(name, help, label_names, buckets))
+
+    def gauge(self, name, help, function, label_names=()):
+        return self.__register(Gauge(name, help, function, label_names))
+
+    def __register(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.__metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+# Every metric in the process is registered here.
+METRICS = MetricsRegistry()
+
+
+class HandlerProfiler:
+    # cProfile only sees the thread it was enabled on, so while sampling each handler call gets its own profile
+    # and the results are merged afterwards.
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__until = 0
+        self.__stats = None
+
+    def start(self, seconds):
+        # Returns False if a sample is already being taken.
+        with self.__lock:
+            if self.is_active():
+                return False
+            self.__until = time.monotonic() + seconds
+            self.__stats = None
+            return True
+
+    def is_active(self):
+        return time.monotonic() < self.__until
+
+    def run(self, function, *args):
+        if not self.is_active():
+            return function(*args)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            with self.__lock:
+                if self.__stats is None:
+                    self.__stats = pstats.Stats(profile)
+                else:
+                    self.__stats.add(profile)
+
+    def get_report(self, limit=25):
+        with self.__lock:
+            stats = self.__stats
+            self.__stats = None
+        if stats is None:
+            return "No handlers ran while profiling."
+
+        out = io.StringIO()
+        stats.stream = out
+        stats.strip_dirs().sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+
+PROFILER = HandlerProfiler()
+
+
+class MetricsServer:
+    def __init__(self, listen, port, registry=METRICS):
+        self.__thread = None
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__httpd = ThreadingHTTPServer((listen, port), MetricsRequestHandler)
+        self.__httpd.daemon_threads = True
+
+    def get_port(self):
+        return self.__httpd.server_address[1]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__httpd.serve_forever, name="metrics_server", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+# How long (in seconds) the writer waits to batch up saves before hitting the disk.
+FLUSH_INTERVAL = 0.5
+
+ERROR_LOGGER = logging.getLogger("error_logger")
+
+
+class PendingSave:
+    __slots__ = ("replace", "snapshot", "events")
+
+    def __init__(self, replace):
+        # Set if the chat's saved moves belong to another game and have to be deleted first.
+        self.replace = replace
+        self.snapshot = None
+        # This is a list of (move number, serialized move) not yet written.
+        self.events = []
+
+
+class GameStore:
+    def __init__(self, path, corpus):
+        self.__path = path
+        self.__fingerprint = corpus.get_fingerprint()
+        self.__cond = threading.Condition()
+        # This is a dict of (chat ID, PendingSave or None to delete it) waiting to be written.
+        self.__pending = {}
+        # This is a dict of (chat ID, (seed, number of moves)) for the game each chat has in the database, or will
+        # once the pending saves are written, so a save only has to add the moves made since.
+        self.__saved = {}
+        # Held while writing, so a load never sees a save that has left pending but isn't in the database yet.
+        self.__flush_lock = threading.Lock()
+        self.__stopped = False
+        self.__writer = None
+
+        with self.__connect() as conn:
+            # A game's row holds how it started; its moves are rows of their own, so they're only written once.
+            conn.execute("CREATE TABLE IF NOT EXISTS games ("
+                         "chat_id INTEGER PRIMARY KEY, "
+                         "fingerprint TEXT NOT NULL, "
+                         "snapshot TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS game_events ("
+                         "chat_id INTEGER NOT NULL, "
+                         "seq INTEGER NOT NULL, "
+                         "event TEXT NOT NULL, "
+                         "PRIMARY KEY (chat_id, seq))")
+
+    def __connect(self):
+        conn = sqlite3.connect(self.__path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def start(self):
+        if self.__writer is None:
+            self.__stopped = False
+            self.__writer = threading.Thread(target=self.__work, name="game_store", daemon=True)
+            self.__writer.start()
+
+    def stop(self):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
+        if self.__writer is not None:
+            self.__writer.join()
+            self.__writer = None
+
+    def save(self, chat):
+        # Serialized on the caller's thread so it's consistent; only the disk write is deferred. The game's start
+        # is written again each time since it's small and holds the activity time, but each move only once, so
+        # saving costs the same however long the game has run.
+        log = chat.game_obj.to_log()
+        events = log["events"]
+        start = {key: value for key, value in log.items() if key != "events"}
+        snapshot = json.dumps({"decks": chat.decks, "game": start, "last_active": chat.last_active},
+                              separators=(",", ":"))
+        with self.__cond:
+            seed, num_saved = self.__saved.get(chat.chat_id, (None, None))
+            # A different game in the same chat replaces the saved one outright.
+            replace = seed != log["seed"] or num_saved > len(events)
+            if replace:
+                num_saved = 0
+            pending = self.__pending.get(chat.chat_id)
+            if pending is None:
+                pending = PendingSave(replace)
+                self.__pending[chat.chat_id] = pending
+            elif replace:
+                pending.replace = True
+                pending.events = []
+            pending.snapshot = snapshot
+            pending.events.extend((i, json.dumps(events[i], separators=(",", ":")))
+                                  for i in range(num_saved, len(events)))
+            self.__saved[chat.chat_id] = (log["seed"], len(events))
+            self.__cond.notify()
+
+    def delete(self, chat_id):
+        with self.__cond:
+            self.__pending[chat_id] = None
+            self.__saved.pop(chat_id, None)
+            self.__cond.notify()
+
+    def load(self, chat_id):
+        # Returns (decks, saved game, last active time) for one game, or None if it isn't saved.
+        with self.__flush_lock:
+            with self.__cond:
+                pending = self.__pending.get(chat_id, False)
+            if pending is None:
+                return None
+
+            with self.__connect() as conn:
+                row = conn.execute("SELECT fingerprint, snapshot FROM games WHERE chat_id = ?",
+                                   (chat_id,)).fetchone()
+                events = [] if row is None else self.__load_events(conn, chat_id)
+        if pending:
+            if pending.replace:
+                events = []
+            events += [event for seq, event in pending.events]
+            row = (self.__fingerprint, pending.snapshot)
+        if row is None or row[0] != self.__fingerprint:
+            return None
+        return self.__parse(chat_id, row[1], events)
+
+    def load_all(self):
+        # Returns a list of (chat ID, decks, saved game, last active time) for every game saved against the
+        # current corpus. Saved games are rebuilt with cah.Game.from_saved.
+        games = []
+        with self.__connect() as conn:
+            rows = conn.execute("SELECT chat_id, fingerprint, snapshot FROM games").fetchall()
+            for chat_id, fingerprint, snapshot in rows:
+                if fingerprint != self.__fingerprint:
+                    ERROR_LOGGER.warning("Dropping saved game for %s; the decks changed since it was saved.", chat_id)
+                    continue
+                games.append((chat_id,) + self.__parse(chat_id, snapshot, self.__load_events(conn, chat_id)))
+        return games
+
+    def __load_events(self, conn, chat_id):
+        return [event for event, in conn.execute("SELECT event FROM game_events WHERE chat_id = ? ORDER BY seq",
+                                                 (chat_id,))]
+
+    def __parse(self, chat_id, snapshot, events):
+        data = json.loads(snapshot)
+        game = data["game"]
+        # Games saved as a whole, moves included, or as snapshots by older versions are rewritten in full the next
+        # time they're saved.
+        if "seed" in game and "events" not in game:
+            game["events"] = [json.loads(event) for event in events]
+            with self.__cond:
+                if chat_id not in self.__pending:
+                    self.__saved[chat_id] = (game["seed"], len(events))
+        # Games saved before activity was tracked count as active now.
+        return data["decks"], game, data.get("last_active", time.time())
+
+    def flush(self):
+        with self.__flush_lock:
+            with self.__cond:
+                pending = self.__pending
+                self.__pending = {}
+            if not pending:
+                return
+
+            saves = [(chat_id, self.__fingerprint, save.snapshot) for chat_id, save in pending.items()
+                     if save is not None]
+            replaced = [(chat_id,) for chat_id, save in pending.items() if save is None or save.replace]
+            deletes = [(chat_id,) for chat_id, save in pending.items() if save is None]
+            events = [(chat_id, seq, event) for chat_id, save in pending.items() if save is not None
+                      for seq, event in save.events]
+            try:
+                with self.__connect() as conn:
+                    conn.executemany("DELETE FROM game_events WHERE chat_id = ?", replaced)
+                    conn.executemany("INSERT OR REPLACE INTO games (chat_id, fingerprint, snapshot) VALUES (?, ?, ?)",
+                                     saves)
+                    conn.executemany("INSERT OR REPLACE INTO game_events (chat_id, seq, event) VALUES (?, ?, ?)",
+                                     events)
+                    conn.executemany("DELETE FROM games WHERE chat_id = ?", deletes)
+            except sqlite3.Error as e:
+                ERROR_LOGGER.warning("Failed to write %d games: %s", len(pending), e)
+                # Put everything back in front of whatever was saved since, to try again on the next flush.
+                with self.__cond:
+                    for chat_id, save in pending.items():
+                        if chat_id not in self.__pending:
+                            self.__pending[chat_id] = save
+                        elif save is not None and self.__pending[chat_id] is not None and \
+                                not self.__pending[chat_id].replace:
+                            self.__pending[chat_id].replace = save.replace
+                            self.__pending[chat_id].events[:0] = save.events
+
+    def __work(self):
+        while True:
+            with self.__cond:
+                while not self.__pending and not self.__stopped:
+                    self.__cond.wait()
+                stopped = self.__stopped
+            if not stopped:
+                # Let more saves pile up so a burst of moves becomes a single transaction.
+                with self.__cond:
+                    self.__cond.wait_for(lambda: self.__stopped, FLUSH_INTERVAL)
+            self.flush()
+            if stopped:
+                return
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+from __future__ import unicode_literals
+
+import argparse
+import json
+
+import cah
+import card_corpus
+from deck_registry import CustomDeckStore, is_custom_deck_key
+from persistence import GameStore
+from telegram_interaction import GAMES_DB_PATH
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a game move by move, printing every message it sends.")
+    parser.add_argument("chat_id", type=int, nargs="?", help="replay this chat's saved game")
+    parser.add_argument("--log", help="replay a game log copied from the error log instead")
+    parser.add_argument("--db", default=GAMES_DB_PATH, help="the game store to read the saved game from")
+    options = parser.parse_args()
+
+    corpus = card_corpus.get_corpus()
+    if options.log is not None:
+        with open(options.log, encoding="utf-8") as f:
+            log = json.load(f)
+        decks = log.get("decks", [])
+    elif options.chat_id is not None:
+        loaded = GameStore(options.db, corpus).load(options.chat_id)
+        if loaded is None:
+            parser.error("There's no game saved for %d." % options.chat_id)
+        decks, log, last_active = loaded
+    else:
+        parser.error("Give a chat ID or --log.")
+
+    if "events" not in log:
+        parser.error("That game was saved before games kept logs.")
+
+    keys = sorted(d for d in decks if is_custom_deck_key(d))
+    if keys:
+        corpus = CustomDeckStore().get_union(corpus, keys)
+
+    for game, event, messages in cah.Game.replay(log, corpus):
+        print("=== %s" % ("start (seed %s)" % log["seed"] if event is None else " ".join(str(e) for e in event)))
+        for message in messages:
+            print("--> %s: %s" % (message.chat_id, message.text))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import threading
+
+RESPONSES_PATH = "./static_responses"
+
+
+class ResponseCatalog:
+    def __init__(self, path=RESPONSES_PATH):
+        self.__path = path
+        self.__lock = threading.Lock()
+        # This is a dict of (response name, text).
+        self.__responses = {}
+        # This is a dict of (response name, mtime of the file it was loaded from).
+        self.__mtimes = {}
+        self.reload()
+
+    def __scan(self):
+        files = {}
+        for filename in os.listdir(self.__path):
+            name, ext = os.path.splitext(filename)
+            full_path = os.path.join(self.__path, filename)
+            if ext == ".txt" and os.path.isfile(full_path):
+                files[name] = full_path
+        return files
+
+    def reload(self):
+        responses = {}
+        mtimes = {}
+        for name, full_path in self.__scan().items():
+            with open(full_path, "r", encoding="utf-8") as f:
+                responses[name] = f.read()
+            mtimes[name] = os.path.getmtime(full_path)
+
+        # Swap the whole catalog at once so readers never see a half-loaded one.
+        with self.__lock:
+            self.__responses = responses
+            self.__mtimes = mtimes
+        return len(responses)
+
+    def reload_if_changed(self):
+        files = self.__scan()
+        if files.keys() != self.__mtimes.keys() or \
+                any(os.path.getmtime(full_path) != self.__mtimes[name] for name, full_path in files.items()):
+            self.reload()
+            return True
+        return False
+
+    def get(self, name):
+        return self.__responses[name]
+
+    def get_names(self):
+        return list(self.__responses.keys())
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+ERROR_LOGGER = logging.getLogger("error_logger")
+
+
+class ScheduledCall:
+    __slots__ = ("when", "callback", "args", "cancelled")
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # Cancelled calls stay in the heap until they come due; they're just skipped.
+        self.cancelled = True
+
+
+class Scheduler:
+    # One thread runs every timer in the process, however many games are waiting on one.
+    def __init__(self):
+        self.__cond = threading.Condition()
+        # A heap of (due time, seq, ScheduledCall).
+        self.__heap = []
+        self.__seq = itertools.count()
+        self.__stopped = False
+        self.__thread = None
+
+    def start(self):
+        with self.__cond:
+            if self.__thread is not None:
+                return
+            self.__stopped = False
+            self.__thread = threading.Thread(target=self.__work, name="scheduler", daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        # Calls that haven't come due yet are dropped.
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
+            thread = self.__thread
+            self.__thread = None
+        if thread is not None:
+            thread.join()
+
+    def call_later(self, delay, callback, *args):
+        # Runs callback(*args) on the scheduler thread after delay seconds. Returns a ScheduledCall to cancel it.
+        if self.__thread is None:
+            self.start()
+
+        call = ScheduledCall(time.monotonic() + delay, callback, args)
+        with self.__cond:
+            heapq.heappush(self.__heap, (call.when, next(self.__seq), call))
+            # Only wake the thread if this is now the first call due.
+            if self.__heap[0][2] is call:
+                self.__cond.notify()
+        return call
+
+    def get_num_pending(self):
+        with self.__cond:
+            return sum(1 for when, seq, call in self.__heap if not call.cancelled)
+
+    def __next_call(self):
+        # Blocks until a call is due. Returns None once stopped.
+        with self.__cond:
+            while not self.__stopped:
+                now = time.monotonic()
+                if self.__heap and self.__heap[0][0] <= now:
+                    when, seq, call = heapq.heappop(self.__heap)
+                    if not call.cancelled:
+                        return call
+                    continue
+                self.__cond.wait(self.__heap[0][0] - now if self.__heap else None)
+            return None
+
+    def __work(self):
+        while True:
+            call = self.__next_call()
+            if call is None:
+                return
+            try:
+                call.callback(*call.args)
+            except Exception as e:
+                ERROR_LOGGER.warning("Scheduled call %s failed: %s", call.callback.__name__, e)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+from __future__ import unicode_literals
+
+import telegram
+from telegram.ext import Updater, TypeHandler
+
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+
+import card_corpus
+import message_queue
+import async_runtime
+import telegram_interaction
+
+# How many worker processes own games. Each one runs its own dispatcher, message queue and job queue.
+NUM_SHARDS = int(os.environ.get("NUM_SHARDS", str(os.cpu_count() or 1)))
+
+INFO_LOGGER = logging.getLogger("info_logger")
+
+
+def get_shard_for_chat(chat_id, num_shards):
+    # Python's modulo is never negative, so group chat IDs map the same way as private ones.
+    return chat_id % num_shards
+
+
+class ShardRouter:
+    # Runs in the front end and sends every update to the worker that owns its game.
+    def __init__(self, queues):
+        self.__queues = queues
+        # This is a dict of (Telegram ID, shard) for every pending or active player, reported by the workers.
+        self.__user_to_shard = {}
+        self.__lock = threading.Lock()
+
+    def get_shard(self, update):
+        # Buttons carry the chat of the game they belong to, which may not be the game the user joined last.
+        if update.callback_query is not None and update.callback_query.data:
+            try:
+                action, values = telegram_interaction.parse_callback_data(update.callback_query.data)
+            except ValueError:
+                values = []
+            if values:
+                return get_shard_for_chat(values[0], len(self.__queues))
+
+        chat = update.effective_chat
+        user = update.effective_user
+        if chat is None:
+            return 0 if user is None else get_shard_for_chat(user.id, len(self.__queues))
+
+        # Commands typed in a private chat go to whichever game the user joined last.
+        if chat.type == telegram.Chat.PRIVATE:
+            with self.__lock:
+                shard = self.__user_to_shard.get(chat.id)
+            if shard is not None:
+                return shard
+        return get_shard_for_chat(chat.id, len(self.__queues))
+
+    def route(self, update, context):
+        self.__queues[self.get_shard(update)].put(update.to_dict())
+
+    def update_user(self, user_id, shard, joined):
+        with self.__lock:
+            if joined:
+                self.__user_to_shard[user_id] = shard
+            # A late leave from an older game mustn't unmap the user from the game they're in now.
+            elif self.__user_to_shard.get(user_id) == shard:
+                del self.__user_to_shard[user_id]
+
+    def listen(self, ownership_queue):
+        while True:
+            change = ownership_queue.get()
+            if change is None:
+                return
+            self.update_user(*change)
+
+
+def run_worker(token, shard, num_shards, update_queue, ownership_queue):
+    # The front end decides when to stop and tells us through update_queue.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # Telegram's global rate limit is per bot, not per process.
+    for module in (message_queue, async_runtime):
+        module.GLOBAL_RATE /= num_shards
+        module.GLOBAL_BURST = max(1, module.GLOBAL_BURST // num_shards)
+
+    # The one-game-per-user rule is only enforced within a shard. Private commands go to whichever game the user
+    # joined last.
+    telegram_interaction.REGISTRY.set_listener(
+        lambda user_id, chat_id, joined: ownership_queue.put((user_id, shard, joined)))
+
+    updater = telegram_interaction.create_updater(token)
+    dispatcher = updater.dispatcher
+    if telegram_interaction.USE_ASYNC:
+        outbox = async_runtime.AsyncRuntime(async_runtime.AsyncBotClient(token), dispatcher, updater.bot)
+        updates = outbox
+    else:
+        outbox = message_queue.MessageQueue(updater.bot)
+        updates = dispatcher.update_queue
+    telegram_interaction.init_app(outbox, telegram_interaction.GAMES_DB_PATH, file_suffix=".shard%d" % shard)
+
+    telegram_interaction.load_games(lambda chat_id: get_shard_for_chat(chat_id, num_shards) == shard)
+    telegram_interaction.STORE.start()
+    telegram_interaction.FEEDBACK.start()
+    outbox.start()
+    telegram_interaction.SCHEDULER.start()
+    # Every shard has its own metrics, served on consecutive ports.
+    metrics_server = None
+    if telegram_interaction.METRICS_PORT > 0:
+        metrics_server = telegram_interaction.start_metrics_server(telegram_interaction.METRICS_PORT + shard)
+
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name="dispatcher")
+    dispatcher_thread.start()
+    updater.job_queue.start()
+    INFO_LOGGER.info("Shard %d of %d started.", shard, num_shards)
+
+    while True:
+        data = update_queue.get()
+        if data is None:
+            break
+        updates.put(telegram.Update.de_json(data, updater.bot))
+
+    updater.job_queue.stop()
+    dispatcher.stop()
+    dispatcher_thread.join()
+    if metrics_server is not None:
+        metrics_server.stop()
+    telegram_interaction.SCHEDULER.stop()
+    telegram_interaction.STORE.stop()
+    telegram_interaction.FEEDBACK.stop()
+    telegram_interaction.UPLOADS.shutdown()
+    outbox.stop()
+    if telegram_interaction.LOG_WRITER is not None:
+        telegram_interaction.LOG_WRITER.stop()
+
+
+def run(token, num_shards=NUM_SHARDS):
+    # Checked before any worker is forked, so a bad config doesn't leave them waiting for updates.
+    telegram_interaction.check_webhook_config()
+    # Workers are forked so they share the card corpus the front end has already loaded.
+    card_corpus.get_corpus()
+    context = multiprocessing.get_context("fork")
+
+    queues = [context.Queue() for _ in range(num_shards)]
+    ownership_queue = context.Queue()
+    workers = [context.Process(target=run_worker, args=(token, shard, num_shards, queues[shard], ownership_queue),
+                               name="shard-%d" % shard)
+               for shard in range(num_shards)]
+    for worker in workers:
+        worker.start()
+
+    router = ShardRouter(queues)
+    listener = threading.Thread(target=router.listen, args=(ownership_queue,), name="shard_router", daemon=True)
+    listener.start()
+
+    # The front end only routes; it never handles a command itself.
+    updater = Updater(token=token, use_context=True)
+    updater.dispatcher.add_handler(TypeHandler(telegram.Update, router.route))
+
+    if telegram_interaction.USE_WEBHOOK:
+        telegram_interaction.run_webhook(updater, updater.dispatcher.update_queue)
+    else:
+        updater.start_polling()
+        updater.idle()
+
+    for queue in queues:
+        queue.put(None)
+    for worker in workers:
+        worker.join()
+    ownership_queue.put(None)
+    listener.join()
+
+
+if __name__ == "__main__":
+    run(telegram_interaction.read_token())
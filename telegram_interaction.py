@@ -3,119 +3,598 @@
 from __future__ import unicode_literals
 
 import telegram
-from telegram.ext import Updater, CommandHandler, MessageHandler
-from telegram.error import TelegramError, Unauthorized
+from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
+from telegram.ext.dispatcher import run_async
+from telegram.error import TelegramError, Unauthorized, BadRequest
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+
+import functools
+import html
 import os
+import re
+import signal
 import sys
+import threading
+import time
 import traceback
 import logging
 import inspect
+import ipaddress
+import json
 
 import cah
+import card_corpus
+
+from deck_registry import CustomDeckStore, DeckError, UploadLimiter, parse_custom_deck, is_custom_deck_key
+from deck_registry import MAX_CUSTOM_DECKS_PER_GAME, MAX_UPLOAD_BYTES
+from game_registry import GameRegistry
+from responses import ResponseCatalog
+from message_queue import MessageQueue, PRIORITY_GAME, PRIORITY_CHATTER
+from persistence import GameStore
+from scheduler import Scheduler
+from feedback import FeedbackLog
+from log_writer import LogWriter
+from metrics import METRICS, PROFILER, MetricsServer
+from webhook_server import WebhookServer
+from async_runtime import AsyncBotClient, AsyncRuntime
 
-from deck_enums import DeckEnums, DECK_NAMES
+PORT = int(os.environ.get("PORT", "8443"))
 
-with open("api_key.txt", 'r', encoding="utf-8") as f:
-    TOKEN = f.read().rstrip()
+# Set USE_WEBHOOK to receive updates on a local HTTP server instead of long polling. The webhook is only
+# registered with Telegram if WEBHOOK_URL (the public base URL) is set, so it can also be fed updates offline.
+# Without WEBHOOK_SECRET anyone who can reach the server could post forged updates to it, so the server only
+# listens on loopback and the webhook can't be registered.
+USE_WEBHOOK = bool(os.environ.get("USE_WEBHOOK"))
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0" if WEBHOOK_SECRET else "127.0.0.1")
 
-PORT = int(os.environ.get("PORT", "8443"))
+# Set USE_ASYNC to send messages (and, in webhook mode, process updates) on a single asyncio event loop.
+USE_ASYNC = bool(os.environ.get("USE_ASYNC"))
 
 # Format is mmddyyyy
 PATCHNUMBER = "03252020"
 
 MIN_PLAYERS = 3
 
-def setup_logger(name, log_file, level=logging.INFO):
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler = logging.FileHandler(log_file)
-    handler.setFormatter(formatter)
+# How long (in seconds) everyone else gets to submit once a round's first card is played, before the round closes
+# without them, and how long the judge gets before a card is picked at random. Set either to 0 to wait forever.
+SUBMISSION_DEADLINE = int(os.environ.get("SUBMISSION_DEADLINE", "90"))
+JUDGING_DEADLINE = int(os.environ.get("JUDGING_DEADLINE", "120"))
+
+# Running games are saved here so they survive restarts.
+GAMES_DB_PATH = os.environ.get("GAMES_DB_PATH", "games.db")
+# Set GAME_SEED to make every game's shuffles depend only on it, the chat ID and how many games the chat has started
+# since the bot did, e.g. to rerun a workload exactly.
+GAME_SEED = os.environ.get("GAME_SEED")
+# This is a dict of (chat ID, number of games started), only kept while GAME_SEED is set.
+GAMES_STARTED = {}
+
+# /feedback is appended here as JSON lines.
+FEEDBACK_PATH = os.environ.get("FEEDBACK_PATH", "feedback.jsonl")
+
+# Telegram IDs allowed to use admin commands, e.g. ADMIN_IDS="1234,5678".
+ADMIN_IDS = {int(i) for i in os.environ.get("ADMIN_IDS", "").split(",") if i.strip()}
+
+# How often (in seconds) to check static_responses for edits. Set to 0 to disable hot reloading.
+RESPONSES_RELOAD_INTERVAL = int(os.environ.get("RESPONSES_RELOAD_INTERVAL", "0"))
+
+# How often (in seconds) to look for idle chats. Set to 0 to keep every chat in memory forever.
+IDLE_SWEEP_INTERVAL = int(os.environ.get("IDLE_SWEEP_INTERVAL", "60"))
+# Games idle this long (in seconds) are moved to the game store until their next command.
+HIBERNATE_AFTER = int(os.environ.get("HIBERNATE_AFTER", "1800"))
+# Lobbies idle this long are closed, and games idle this long are ended, hibernated or not.
+LOBBY_IDLE_TIMEOUT = int(os.environ.get("LOBBY_IDLE_TIMEOUT", "3600"))
+GAME_IDLE_TIMEOUT = int(os.environ.get("GAME_IDLE_TIMEOUT", str(7 * 24 * 3600)))
+
+# Set METRICS_PORT to serve Prometheus metrics at /metrics. Keep it on localhost unless it's firewalled.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+
+# How long (in seconds) /profile samples handlers for by default, and at most.
+PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 300
+
+ERROR_LOGGER = logging.getLogger("error_logger")
+INFO_LOGGER = logging.getLogger("info_logger")
+
+# These are built by init_app so importing this module doesn't touch the disk or the network.
+RESPONSES = None
+# Every outgoing message goes through this so handlers never block on Telegram.
+MESSAGE_QUEUE = None
+# None means games aren't persisted.
+STORE = None
+# Runs every round deadline in the process on a single thread.
+SCHEDULER = None
+# Writes the log files in the background; None when logging to files is off.
+LOG_WRITER = None
+# Collects /feedback in the background.
+FEEDBACK = None
+# Every deck uploaded to any chat, by key.
+CUSTOM_DECKS = None
+# Downloads and parses uploaded decks off the threads handling updates, a couple at a time.
+UPLOADS = None
+UPLOAD_WORKERS = 2
+UPLOAD_LIMITER = None
+
+# Holds every pending lobby and running game, keyed by chat ID.
+REGISTRY = GameRegistry()
+
+HANDLER_SECONDS = METRICS.histogram("cah_handler_seconds", "Time spent handling each command.", ["command"])
+METRICS.gauge("cah_games", "Games in memory.", lambda: REGISTRY.get_num_games())
+METRICS.gauge("cah_hibernated_games", "Games saved to disk until their next command.",
+              lambda: REGISTRY.get_num_hibernated())
+METRICS.gauge("cah_players", "Players in a lobby or game, hibernated games included.",
+              lambda: REGISTRY.get_num_players())
+METRICS.gauge("cah_pending_messages", "Outgoing messages waiting to be sent.",
+              lambda: 0 if MESSAGE_QUEUE is None else MESSAGE_QUEUE.get_num_pending())
+METRICS.gauge("cah_pending_deadlines", "Round deadlines waiting to expire.",
+              lambda: 0 if SCHEDULER is None else SCHEDULER.get_num_pending())
+METRICS.gauge("cah_corpus_cards", "Cards loaded, by colour.",
+              lambda: {("white",): card_corpus.get_corpus().get_num_white_cards(),
+                       ("black",): card_corpus.get_corpus().get_num_black_cards()}, ["colour"])
+METRICS.gauge("cah_corpus_bytes", "Approximate memory held by the card corpus.",
+              lambda: card_corpus.get_corpus().get_memory_size())
+METRICS.gauge("cah_custom_decks", "Uploaded decks in memory.",
+              lambda: 0 if CUSTOM_DECKS is None else CUSTOM_DECKS.get_num_decks())
+
+
+def read_token(path="api_key.txt"):
+    with open(path, 'r', encoding="utf-8") as f:
+        return f.read().rstrip()
+
+
+def init_app(message_queue, games_db_path=None, log_to_files=True, file_suffix=""):
+    # Builds everything the handlers need. Anything set up here before forking is shared by worker processes.
+    # Processes running side by side pass different file suffixes, since rotating a log out from under another
+    # process loses its records.
+    global RESPONSES, MESSAGE_QUEUE, STORE, SCHEDULER, LOG_WRITER, FEEDBACK, CUSTOM_DECKS, UPLOADS, UPLOAD_LIMITER
+
+    if log_to_files and not ERROR_LOGGER.handlers:
+        LOG_WRITER = LogWriter()
+        LOG_WRITER.add_logger("error_logger", "error_logs%s.log" % file_suffix)
+        LOG_WRITER.add_logger("info_logger", "info_logs%s.log" % file_suffix)
+        LOG_WRITER.start()
+
+    # Load every deck once up front so starting a game never touches the disk.
+    corpus = card_corpus.get_corpus()
+    RESPONSES = ResponseCatalog()
+    MESSAGE_QUEUE = message_queue
+    SCHEDULER = Scheduler()
+    feedback_path, ext = os.path.splitext(FEEDBACK_PATH)
+    FEEDBACK = FeedbackLog("%s%s%s" % (feedback_path, file_suffix, ext))
+    CUSTOM_DECKS = CustomDeckStore()
+    UPLOADS = ThreadPoolExecutor(UPLOAD_WORKERS, thread_name_prefix="deck_upload")
+    UPLOAD_LIMITER = UploadLimiter()
+    if games_db_path is not None:
+        STORE = GameStore(games_db_path, corpus)
+
+def send_message(chat_id, text, parse_mode=None, priority=PRIORITY_CHATTER, reply_markup=None):
+    return MESSAGE_QUEUE.send(chat_id, text, parse_mode=parse_mode, priority=priority, reply_markup=reply_markup)
+
+
+def send_game_messages(game):
+    for message in game.pop_messages():
+        send_message(message.chat_id, message.text, parse_mode=message.parse_mode, priority=PRIORITY_GAME,
+                     reply_markup=message.reply_markup)
+
+
+def when_all_done(futures, callback):
+    # Calls callback(futures) once every future has finished, without blocking the caller.
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def on_done(future):
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            callback(futures)
+
+    for future in futures:
+        future.add_done_callback(on_done)
 
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
-    logger.addHandler(handler)
 
-    return logger
+def static_handler(command):
+    return CommandHandler(command,
+        lambda update, context: send_message(chat_id=update.message.chat.id, text=RESPONSES.get(command)))
 
-ERROR_LOGGER = setup_logger("error_logger", "error_logs.log")
-INFO_LOGGER = setup_logger("info_logger", "info_logs.log")
 
-bot = telegram.Bot(token=TOKEN)
+def is_admin(user_id):
+    return user_id in ADMIN_IDS
 
-def static_handler(command):
-    text = open("static_responses/{}.txt".format(command), "r", encoding="utf-8").read()
 
-    return CommandHandler(command,
-        lambda update, context: bot.send_message(chat_id=update.message.chat.id, text=text))
+def reload_responses_handler(update, context):
+    chat_id = update.message.chat_id
+
+    if not is_admin(update.message.from_user.id):
+        return
+
+    count = RESPONSES.reload()
+    send_message(chat_id=chat_id, text="Reloaded %d responses." % count)
+
+
+def profile_handler(update, context):
+    chat_id = update.message.chat_id
+
+    if not is_admin(update.message.from_user.id):
+        return
+
+    seconds = PROFILE_SECONDS
+    if len(context.args) > 0:
+        try:
+            seconds = min(MAX_PROFILE_SECONDS, max(1, int(context.args[0])))
+        except ValueError:
+            send_message(chat_id=chat_id, text="Usage: /profile [seconds]")
+            return
+
+    if not PROFILER.start(seconds):
+        send_message(chat_id=chat_id, text="Already profiling.")
+        return
+
+    send_message(chat_id=chat_id, text="Profiling handlers for %d seconds." % seconds)
+    SCHEDULER.call_later(seconds, send_profile_report, chat_id)
+
+
+def send_profile_report(chat_id):
+    report = PROFILER.get_report()[:cah.MAX_MESSAGE_LENGTH - 100]
+    send_message(chat_id=chat_id, text="<pre>%s</pre>" % html.escape(report), parse_mode=telegram.ParseMode.HTML)
+
+
+def start_metrics_server(port=METRICS_PORT):
+    if port <= 0:
+        return None
+    server = MetricsServer(METRICS_LISTEN, port)
+    server.start()
+    INFO_LOGGER.info("Serving metrics on port %d.", server.get_port())
+    return server
+
+
+def timed(command, handler):
+    # Records how long each call takes and, while /profile is sampling, profiles it.
+    @functools.wraps(handler)
+    def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return PROFILER.run(handler, update, context)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, command)
+
+    return wrapper
+
+
+def check_responses_job(context):
+    if RESPONSES.reload_if_changed():
+        INFO_LOGGER.info("Static responses changed on disk and were reloaded.")
+
+
+def parse_callback_data(data):
+    # Callback data looks like "play:{chat ID}:{card}" or "choose:{chat ID}:{round}:{candidate}".
+    action, *values = data.split(":")
+    return action, [int(v) for v in values]
+
+
+def get_game_chat_id(update):
+    if update.callback_query is not None:
+        # Buttons carry the game's chat ID, wherever they were pressed.
+        action, values = parse_callback_data(update.callback_query.data)
+        return values[0]
+
+    chat = update.message.chat
+    # Commands sent in a private chat act on whichever game the user is in.
+    if chat.type == telegram.Chat.PRIVATE:
+        return REGISTRY.get_chat_id_for_user(update.message.from_user.id)
+    return chat.id
+
+
+def get_game_chat(update):
+    chat_id = get_game_chat_id(update)
+    return None if chat_id is None else REGISTRY.get_chat(chat_id)
+
+
+def get_game_corpus(decks):
+    # Games that only use built-in decks play straight from the corpus. Raises DeckError if a custom deck is gone.
+    corpus = card_corpus.get_corpus()
+    keys = sorted(d for d in decks if is_custom_deck_key(d))
+    if not keys:
+        return corpus
+    return CUSTOM_DECKS.get_union(corpus, keys)
+
+
+def get_deck_name(deck):
+    if is_custom_deck_key(deck):
+        custom_deck = CUSTOM_DECKS.get(deck)
+        return "(missing)" if custom_deck is None else custom_deck.get_name()
+    return card_corpus.get_corpus().get_deck_name(deck)
+
+
+def parse_deck_id(arg):
+    # Returns a built-in deck's number or a custom deck's key, or None if there's no such deck.
+    # Keys are checked first, since one can be all digits.
+    deck = arg.lower()
+    if is_custom_deck_key(deck):
+        return deck if CUSTOM_DECKS.get(deck) is not None else None
+    try:
+        deck = int(arg)
+    except ValueError:
+        return None
+    return deck if card_corpus.get_corpus().has_deck(deck) else None
+
+
+def wake_chat(chat_id):
+    # Brings a hibernated game back into memory before a command looks at it.
+    def restore(chat):
+        loaded = STORE.load(chat_id)
+        if loaded is None:
+            ERROR_LOGGER.warning("Hibernated game for %s is missing from the game store.", chat_id)
+            return False
+        chat.decks, saved, last_active = loaded
+        try:
+            chat.game_obj = cah.Game.from_saved(saved, get_game_corpus(chat.decks))
+        except ValueError as e:
+            ERROR_LOGGER.warning("Can't restore the game for %s: %s", chat_id, e)
+            return False
+        schedule_deadline(chat)
+        return True
+
+    # Returns True if the chat was hibernated, whether or not its game could be restored.
+    return STORE is not None and REGISTRY.is_hibernated(chat_id) and REGISTRY.wake_chat(chat_id, restore)
+
+
+def with_chat_lock(handler):
+    # Runs the handler while holding the lock of the chat it acts on, so no two commands for the same game
+    # interleave while commands for other games carry on in parallel.
+    @functools.wraps(handler)
+    def wrapper(update, context):
+        while True:
+            chat_id = get_game_chat_id(update)
+            chat = None if chat_id is None else REGISTRY.get_chat(chat_id)
+            if chat is None:
+                if chat_id is not None and wake_chat(chat_id):
+                    continue
+                return handler(update, context)
+            with chat.lock:
+                # The chat may have been ended (and possibly recreated) while we were waiting for its lock.
+                if REGISTRY.get_chat(chat.chat_id) is chat:
+                    chat.last_active = time.time()
+                    return handler(update, context)
+
+    return wrapper
+
+
+def save_game(chat):
+    if STORE is not None:
+        STORE.save(chat)
+
+
+def load_games(owns_chat=None):
+    # owns_chat lets a shard restore only the games it's responsible for.
+    now = time.time()
+    for chat_id, decks, saved, last_active in STORE.load_all():
+        if owns_chat is not None and not owns_chat(chat_id):
+            continue
+        # Games that were already idle stay on disk until someone uses them.
+        if IDLE_SWEEP_INTERVAL > 0 and now - last_active > HIBERNATE_AFTER:
+            REGISTRY.add_hibernated(chat_id, last_active, cah.get_saved_player_ids(saved))
+            continue
+        try:
+            game = cah.Game.from_saved(saved, get_game_corpus(decks))
+        except ValueError as e:
+            ERROR_LOGGER.warning("Can't restore the game for %s: %s", chat_id, e)
+            continue
+        chat = REGISTRY.get_or_create_chat(chat_id)
+        chat.decks = decks
+        chat.game_obj = game
+        chat.last_active = last_active
+        for user_id in chat.game_obj.get_players().keys():
+            REGISTRY.add_user(chat_id, user_id)
+        schedule_deadline(chat)
+    INFO_LOGGER.info("Restored %d games and %d hibernated games.", REGISTRY.get_num_games(),
+                     REGISTRY.get_num_hibernated())
+
+
+def sweep_idle_chats_job(context):
+    now = time.time()
+    for chat in REGISTRY.get_chats():
+        with chat.lock:
+            if REGISTRY.get_chat(chat.chat_id) is not chat:
+                continue
+
+            idle = now - chat.last_active
+            if chat.game_obj is None:
+                # A chat that is starting a game is left alone; the start either creates the game or reopens the
+                # lobby.
+                if chat.is_game_pending and idle > LOBBY_IDLE_TIMEOUT:
+                    REGISTRY.reset_chat(chat.chat_id)
+                    send_message(chat_id=chat.chat_id, text=RESPONSES.get("idle_lobby_closed"))
+            elif idle > GAME_IDLE_TIMEOUT:
+                end_idle_game(chat.chat_id)
+            elif STORE is not None and idle > HIBERNATE_AFTER:
+                cancel_deadline(chat)
+                STORE.save(chat)
+                REGISTRY.hibernate_chat(chat.chat_id)
+
+    for chat_id, last_active in REGISTRY.get_hibernated():
+        if now - last_active > GAME_IDLE_TIMEOUT and REGISTRY.forget_hibernated(chat_id):
+            end_idle_game(chat_id)
+
+
+def end_idle_game(chat_id):
+    cancel_deadline(REGISTRY.get_chat(chat_id))
+    REGISTRY.reset_chat(chat_id)
+    if STORE is not None:
+        STORE.delete(chat_id)
+    send_message(chat_id=chat_id, text=RESPONSES.get("idle_game_ended"))
+
+
+def schedule_deadline(chat):
+    # Called after anything that may move a game on. Submissions close a while after the round's first card is
+    # played and the judge gets a while to pick; a round nobody plays in just waits, so abandoned games go quiet.
+    game = chat.game_obj
+    if game is None:
+        return
+
+    if game.check_if_ready_for_choice():
+        phase, delay = "choose", JUDGING_DEADLINE
+    elif game.get_num_submissions() > 0:
+        phase, delay = "submit", SUBMISSION_DEADLINE
+    else:
+        phase, delay = None, 0
+    key = (game.get_round(), phase)
+
+    if chat.deadline is not None:
+        if chat.deadline[0] == key:
+            return
+        cancel_deadline(chat)
+    if delay > 0:
+        chat.deadline = (key, SCHEDULER.call_later(delay, deadline_expired, chat, key))
+
+
+def cancel_deadline(chat):
+    if chat is not None and chat.deadline is not None:
+        chat.deadline[1].cancel()
+        chat.deadline = None
 
 
-def reset_chat_data(context):
-    context.bot_data["is_game_pending"] = False
-    context.bot_data["pending_players"] = {}
-    context.bot_data["game_obj"] = None
-    context.bot_data["decks"] = []
+def deadline_expired(chat, key):
+    with chat.lock:
+        game = chat.game_obj
+
+        # The game may have ended, been hibernated or moved on since this was scheduled.
+        if REGISTRY.get_chat(chat.chat_id) is not chat or game is None or chat.deadline is None or \
+                chat.deadline[0] != key:
+            return
+        chat.deadline = None
+
+        round, phase = key
+        if phase == "submit":
+            if not game.close_submissions():
+                game.next_turn()
+            send_game_messages(game)
+            save_game(chat)
+            schedule_deadline(chat)
+        else:
+            game.choose_randomly()
+            send_game_messages(game)
+            finish_round(chat)
 
 
 def check_game_existence(game, chat_id):
     if game is None:
-        text = open("static_responses/game_dne_failure.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+        text = RESPONSES.get("game_dne_failure")
+        send_message(chat_id=chat_id, text=text)
         return False
 
     return True
 
 
-def send_hand(chat_id, game, user_id):
-    hand = game.get_players().get(user_id).get_formatted_hand()
+def make_hand_keyboard(chat_id, hand):
+    # Buttons name the card rather than its slot, so a press that races an edit can't play the wrong card.
+    return cah.make_keyboard([(str(i), "play:%s:%s" % (chat_id, card)) for i, card in enumerate(hand)])
 
-    bot.send_message(chat_id=user_id,
-                     text=hand + "\n",
-                     parse_mode = telegram.ParseMode.HTML)
 
+def send_hand(chat, user_id):
+    game = chat.game_obj
+    player = game.get_players().get(user_id)
+    hand = tuple(player.get_hand())
+    hand_messages = chat.hand_messages
 
-def send_hands(chat_id, game, players):
-    for user_id, nickname in players.items():
-        send_hand(chat_id, game, user_id)
+    entry = hand_messages.get(user_id)
+    # Nothing to do if the message already shows this hand, e.g. after a rejected play.
+    if entry is not None and entry[1] == hand:
+        return
 
+    text = player.get_formatted_hand(game.get_corpus()) + "\n"
+    keyboard = make_hand_keyboard(chat.chat_id, hand)
 
-def newgame_handler(update, context):
-    game = context.bot_data.get("game_obj")
-    chat_id = update.message.chat.id
+    def forget(sent, error):
+        # The message may have been deleted or never arrived; send a fresh one next time.
+        if isinstance(error, (BadRequest, Unauthorized)) and hand_messages.get(user_id, (None,))[0] is sent:
+            hand_messages.pop(user_id, None)
 
-    if game is None and not context.bot_data.get("is_game_pending", False):
-        reset_chat_data(context)
-        context.bot_data["is_game_pending"] = True
-        text = open("static_responses/new_game.txt", "r", encoding="utf-8").read()
-    elif game is not None:
-        text = open("static_responses/game_ongoing.txt", "r", encoding="utf-8").read()
-    elif context.bot_data.get("is_game_pending", False):
-        text = open("static_responses/game_pending.txt", "r", encoding="utf-8").read()
+    def edit(sent):
+        # Runs once the hand's first message has gone out, which it usually already has.
+        if sent.exception() is not None:
+            return
+        future = MESSAGE_QUEUE.submit("edit_message_text", user_id, message_id=sent.result().message_id,
+                                      text=text, parse_mode=telegram.ParseMode.HTML, reply_markup=keyboard)
+        future.add_done_callback(lambda future: forget(sent, future.exception()))
+
+    if entry is None:
+        sent = send_message(chat_id=user_id,
+                            text=text,
+                            parse_mode=telegram.ParseMode.HTML,
+                            priority=PRIORITY_GAME,
+                            reply_markup=keyboard)
+        hand_messages[user_id] = (sent, hand)
+        sent.add_done_callback(lambda sent: forget(sent, sent.exception()))
     else:
-        text = "Something has gone horribly wrong!"
+        sent = entry[0]
+        hand_messages[user_id] = (sent, hand)
+        sent.add_done_callback(edit)
 
-    bot.send_message(chat_id=chat_id, text=text)
 
+def send_hands(chat, players):
+    for user_id, nickname in players.items():
+        send_hand(chat, user_id)
+
+
+def newgame_handler(update, context):
+    chat_id = update.message.chat.id
 
-def is_nickname_valid(name, user_id, context):
-    if user_id in context.bot_data.get("pending_players", {}):
-        if name.lower() == context.bot_data["pending_players"][user_id].lower():
+    while True:
+        wake_chat(chat_id)
+        chat = REGISTRY.get_or_create_chat(chat_id)
+        with chat.lock:
+            if REGISTRY.get_chat(chat_id) is not chat:
+                continue
+            chat.last_active = time.time()
+
+            if chat.game_obj is None and not chat.is_game_pending and not chat.is_game_starting:
+                chat.reset()
+                chat.is_game_pending = True
+                text = RESPONSES.get("new_game")
+            elif chat.game_obj is not None:
+                text = RESPONSES.get("game_ongoing")
+            elif chat.is_game_pending:
+                text = RESPONSES.get("game_pending")
+            elif chat.is_game_starting:
+                text = RESPONSES.get("game_starting")
+            else:
+                text = "Something has gone horribly wrong!"
+            break
+
+    send_message(chat_id=chat_id, text=text)
+
+
+def is_nickname_valid(name, user_id, chat):
+    if user_id in chat.pending_players:
+        if name.lower() == chat.pending_players[user_id].lower():
             return True
 
-    for id, user_name in context.bot_data.get("pending_players", {}).items():
+    for id, user_name in chat.pending_players.items():
         if name.lower() == user_name.lower():
             return False
 
     return True
 
 
+@with_chat_lock
 def join_handler(update, context):
     chat_id = update.message.chat.id
     user_id = update.message.from_user.id
+    chat = REGISTRY.get_chat(chat_id)
 
-    if not context.bot_data.get("is_game_pending", False):
-        text = open("static_responses/join_game_not_pending.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+    if chat is not None and chat.is_game_starting:
+        send_message(chat_id=chat_id, text=RESPONSES.get("game_starting"))
+        return
+
+    if chat is None or not chat.is_game_pending:
+        text = RESPONSES.get("join_game_not_pending")
+        send_message(chat_id=chat_id, text=text)
         return
 
     if context.args:
@@ -123,191 +602,307 @@ def join_handler(update, context):
     else:
         nickname = update.message.from_user.first_name
 
-    if is_nickname_valid(nickname, user_id, context):
-        context.bot_data["pending_players"][user_id] = nickname
-        bot.send_message(chat_id=update.message.chat_id,
+    if is_nickname_valid(nickname, user_id, chat):
+        if not REGISTRY.add_user(chat_id, user_id):
+            send_message(chat_id=chat_id, text="You're already in a game in another chat!")
+            return
+        chat.pending_players[user_id] = nickname
+        send_message(chat_id=update.message.chat_id,
                          text="Joined with nickname %s!" % nickname)
-        bot.send_message(chat_id=update.message.chat_id,
-                         text="Current player count: %d" % len(context.bot_data.get("pending_players", {})))
+        send_message(chat_id=update.message.chat_id,
+                         text="Current player count: %d" % len(chat.pending_players))
     else:
-        text = open("static_responses/invalid_nickname.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+        text = RESPONSES.get("invalid_nickname")
+        send_message(chat_id=chat_id, text=text)
 
 
+@with_chat_lock
 def leave_handler(update, context):
     chat_id = update.message.chat_id
     user_id = update.message.from_user.id
+    chat = REGISTRY.get_chat(chat_id)
 
-    if not context.bot_data.get("is_game_pending", False):
-        text = open("static_responses/leave_game_not_pending_failure.txt", "r", encoding="utf-8").read()
-    elif user_id not in context.bot_data.get("pending_players", {}):
-        text = open("static_responses/leave_id_missing_failure.txt", "r", encoding="utf-8").read()
+    if chat is None or not chat.is_game_pending:
+        text = RESPONSES.get("leave_game_not_pending_failure")
+    elif user_id not in chat.pending_players:
+        text = RESPONSES.get("leave_id_missing_failure")
     else:
         text = "You have left the current game."
-        del context.bot_data["pending_players"][update.message.from_user.id]
+        del chat.pending_players[user_id]
+        REGISTRY.remove_user(chat_id, user_id)
 
-    bot.send_message(chat_id=chat_id, text=text)
+    send_message(chat_id=chat_id, text=text)
 
 
+@with_chat_lock
 def listplayers_handler(update, context):
     chat_id = update.message.chat_id
     text = "List of players: \n"
-    game = context.bot_data.get("game_obj")
+    chat = REGISTRY.get_chat(chat_id)
 
-    if context.bot_data.get("is_game_pending", False):
-        for user_id, name in context.bot_data.get("pending_players", {}).items():
+    if chat is not None and (chat.is_game_pending or chat.is_game_starting):
+        for user_id, name in chat.pending_players.items():
             text += "%s\n" % name
-    elif game is not None:
-        for player in game.get_players().values():
+    elif chat is not None and chat.game_obj is not None:
+        for player in chat.game_obj.get_players().values():
             text += "%s\n" % player.get_name()
     else:
-        text = open("static_responses/listplayers_failure.txt", "r", encoding="utf-8").read()
+        text = RESPONSES.get("listplayers_failure")
 
-    bot.send_message(chat_id=chat_id, text=text)
+    send_message(chat_id=chat_id, text=text)
 
 
 def feedback_handler(update, context):
     if context.args and len(context.args) > 0:
-        feedback = open("feedback.txt\n", "a+", encoding="utf-8")
-        feedback.write(update.message.from_user.first_name + "\n")
-        feedback.write(str(update.message.from_user.id) + "\n")
-        feedback.write(" ".join(context.args) + "\n")
-        feedback.close()
-        bot.send_message(chat_id=update.message.chat_id, text="Thanks for the feedback!")
+        FEEDBACK.add(update.message.from_user, update.message.chat_id, " ".join(context.args))
+        send_message(chat_id=update.message.chat_id, text="Thanks for the feedback!")
     else:
-        bot.send_message(chat_id=update.message.chat_id, text="Usage: /feedback [feedback]")
+        send_message(chat_id=update.message.chat_id, text="Usage: /feedback [feedback]")
 
 
+@with_chat_lock
 def startgame_handler(update, context):
     chat_id = update.message.chat_id
     user_id = update.message.from_user.id
-    pending_players = context.bot_data.get("pending_players", {})
+    chat = REGISTRY.get_chat(chat_id)
 
-    if not context.bot_data.get("is_game_pending", False):
-        text = open("static_responses/start_game_not_pending.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+    if chat is None or not chat.is_game_pending:
+        text = RESPONSES.get("start_game_not_pending")
+        send_message(chat_id=chat_id, text=text)
         return
 
-    if user_id not in context.bot_data.get("pending_players", {}).keys():
-        text = open("static_responses/start_game_id_missing_failure.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+    # Taken now so the game starts with exactly the players who were pinged.
+    pending_players = dict(chat.pending_players)
+
+    if user_id not in pending_players.keys():
+        text = RESPONSES.get("start_game_id_missing_failure")
+        send_message(chat_id=chat_id, text=text)
         return
 
     if len(pending_players) < MIN_PLAYERS:
-        text = open("static_responses/start_game_min_threshold.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+        text = RESPONSES.get("start_game_min_threshold")
+        send_message(chat_id=chat_id, text=text)
+        return
+
+    # The lobby is closed while every player is pinged in parallel; anyone who hasn't messaged the bot yet
+    # will come back Unauthorized. The game is only created once all the pings have finished.
+    chat.is_game_pending = False
+    chat.is_game_starting = True
+    futures = [send_message(chat_id=user_id, text="Trying to start game!", priority=PRIORITY_GAME)
+               for user_id in pending_players.keys()]
+    when_all_done(futures, lambda futures: finish_startgame(chat, pending_players, futures))
+
+
+def finish_startgame(chat, pending_players, futures):
+    with chat.lock:
+        # The lobby may have been ended while the pings were in flight.
+        if REGISTRY.get_chat(chat.chat_id) is chat and chat.is_game_starting:
+            chat.is_game_starting = False
+            start_game(chat, pending_players, futures)
+
+
+def start_game(chat, pending_players, futures):
+    chat_id = chat.chat_id
+
+    if any(isinstance(f.exception(), Unauthorized) for f in futures):
+        chat.is_game_pending = True
+        text = RESPONSES.get("start_game_failure")
+        send_message(chat_id=chat_id, text=text)
         return
 
+    decks = [0] if len(chat.decks) == 0 else chat.decks
     try:
-        for user_id, nickname in pending_players.items():
-            bot.send_message(chat_id=user_id, text="Trying to start game!")
-    except Unauthorized as u:
-        text = open("static_responses/start_game_failure.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+        corpus = get_game_corpus(decks)
+    except DeckError as e:
+        chat.is_game_pending = True
+        send_message(chat_id=chat_id, text="%s Remove it with /rd and try again." % e)
         return
 
-    text = open("static_responses/start_game.txt", "r", encoding="utf-8").read()
-    bot.send_message(chat_id=chat_id, text=text)
+    min_white_cards = cah.get_min_white_cards(len(pending_players))
+    num_white_cards = len(corpus.get_card_ids(decks)[0])
+    if num_white_cards < min_white_cards:
+        chat.is_game_pending = True
+        send_message(chat_id=chat_id, text="Those decks only have %d white cards, but %d players need at least %d. "
+                                           "Add more with /ad and try again."
+                                           % (num_white_cards, len(pending_players), min_white_cards))
+        return
 
-    chat_id = update.message.chat_id
-    pending_players = context.bot_data.get("pending_players", {})
-    context.bot_data["is_game_pending"] = False
-    decks = [0] if len(context.bot_data["decks"]) == 0 else context.bot_data["decks"]
-    context.bot_data["game_obj"] = cah.Game(chat_id, pending_players, decks)
-    game = context.bot_data["game_obj"]
+    text = RESPONSES.get("start_game")
+    send_message(chat_id=chat_id, text=text)
+
+    chat.game_obj = cah.Game(chat_id, pending_players, decks, corpus, make_game_seed(chat_id))
+    send_game_messages(chat.game_obj)
+    save_game(chat)
+
+    send_hands(chat, pending_players)
+
+
+def make_game_seed(chat_id):
+    # None lets the game pick a random seed.
+    if GAME_SEED is None:
+        return None
+    # Only called under the chat's lock, so no other thread touches this chat's count.
+    num_games = GAMES_STARTED.get(chat_id, 0)
+    GAMES_STARTED[chat_id] = num_games + 1
+    return "%s:%s:%d" % (GAME_SEED, chat_id, num_games)
 
-    send_hands(chat_id, game, pending_players)
 
+def end_game(chat_id):
+    cancel_deadline(REGISTRY.get_chat(chat_id))
+    REGISTRY.reset_chat(chat_id)
+    if STORE is not None:
+        STORE.delete(chat_id)
+    text = RESPONSES.get("end_game")
+    send_message(chat_id=chat_id, text=text)
 
+
+@with_chat_lock
 def endgame_handler(update, context):
     chat_id = update.message.chat.id
     user_id = update.message.from_user.id
-    game = context.bot_data.get("game_obj")
+    chat = REGISTRY.get_chat(chat_id)
 
-    if context.bot_data.get("is_game_pending", False):
-        context.bot_data["is_game_pending"] = False
-        text = open("static_responses/end_game.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+    if chat is not None and (chat.is_game_pending or chat.is_game_starting):
+        end_game(chat_id)
         return
 
-    if game is None:
-        text = open("static_responses/game_dne_failure.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+    if chat is None or chat.game_obj is None:
+        text = RESPONSES.get("game_dne_failure")
+        send_message(chat_id=chat_id, text=text)
         return
 
-    if user_id not in game.get_players():
-        text = open("static_responses/end_game_id_missing_failure.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+    if user_id not in chat.game_obj.get_players():
+        text = RESPONSES.get("end_game_id_missing_failure")
+        send_message(chat_id=chat_id, text=text)
         return
 
-    reset_chat_data(context)
-    text = open("static_responses/end_game.txt", "r", encoding="utf-8").read()
-    bot.send_message(chat_id=chat_id, text=text)
+    end_game(chat_id)
 
 
+@with_chat_lock
 def play_handler(update, context):
     chat_id = update.message.chat.id
     user_id = update.message.from_user.id
-    game = context.bot_data.get("game_obj")
+    chat = get_game_chat(update)
+    game = None if chat is None else chat.game_obj
 
     if not check_game_existence(game, chat_id):
         return
 
     if len(context.args) < 1:
-        bot.send_message(chat_id=chat_id, text="Usage: /play {card ID 1} {card ID 2} ...")
+        send_message(chat_id=chat_id, text="Usage: /play {card ID 1} {card ID 2} ...")
         return
 
-    num_cards_to_submit = game.get_current_black_card()[0]
+    num_cards_to_submit = game.get_current_pick()
     if len(context.args) > num_cards_to_submit:
-        bot.send_message(chat_id=chat_id, text="You submitted more cards that necessary (%s)!" % num_cards_to_submit)
+        send_message(chat_id=chat_id, text="You submitted more cards that necessary (%s)!" % num_cards_to_submit)
         return
 
     card_ids = [int(c) for c in context.args]
 
     if any(card_id < 0 or card_id > game.get_deck().get_hand_size() for card_id in card_ids):
-        bot.send_message(chat_id=chat_id, text="That's not a valid card ID.")
+        send_message(chat_id=chat_id, text="That's not a valid card ID.")
         return
 
+    play_cards(chat, user_id, card_ids)
+
+
+def play_cards(chat, user_id, card_ids):
+    game = chat.game_obj
     game.play(user_id, card_ids)
-    send_hand(chat_id, game, user_id)
+    send_game_messages(game)
+    save_game(chat)
+    schedule_deadline(chat)
+    if user_id in game.get_players():
+        send_hand(chat, user_id)
 
 
+@with_chat_lock
 def choose_handler(update, context):
     chat_id = update.message.chat.id
     user_id = update.message.from_user.id
-    game = context.bot_data.get("game_obj")
+    chat = get_game_chat(update)
+    game = None if chat is None else chat.game_obj
 
     if not check_game_existence(game, chat_id):
         return
 
     if len(context.args) != 1:
-        bot.send_message(chat_id=chat_id, text="Usage: /choose {ID}")
+        send_message(chat_id=chat_id, text="Usage: /choose {ID}")
         return
 
     id = int(context.args[0])
 
-    if game.choose(user_id, id):
-        winner = game.check_for_win()
-        if not winner:
-            game.next_turn()
+    choose_card(chat, user_id, id)
+
+
+def choose_card(chat, user_id, id):
+    game = chat.game_obj
+    chosen = game.choose(user_id, id)
+    send_game_messages(game)
+    if chosen:
+        finish_round(chat)
+    return chosen
+
+
+def finish_round(chat):
+    game = chat.game_obj
+    winner = game.check_for_win()
+    if not winner:
+        game.next_turn()
+        send_game_messages(game)
+        save_game(chat)
+        schedule_deadline(chat)
+    else:
+        send_message(chat_id=chat.chat_id, text="%s has won!" % winner, priority=PRIORITY_GAME)
+        end_game(chat.chat_id)
+
+
+@with_chat_lock
+def callback_query_handler(update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    action, values = parse_callback_data(query.data)
+    chat = REGISTRY.get_chat(values[0])
+    game = None if chat is None else chat.game_obj
+    # Shown to the user as a small popup; None just stops the button's spinner.
+    answer = None
+
+    if game is None:
+        answer = RESPONSES.get("game_dne_failure")
+    elif action == "play":
+        player = game.get_players().get(user_id)
+        card = values[1]
+        if player is None or card not in player.get_hand():
+            answer = "That card isn't in your hand anymore."
         else:
-            bot.send_message(chat_id=chat_id, text="%s has won!" % winner)
-            endgame_handler(update, context)
+            play_cards(chat, user_id, [player.get_hand().index(card)])
+    elif action == "choose":
+        round, id = values[1:]
+        if game.get_round() != round:
+            answer = "That round is already over."
+        elif choose_card(chat, user_id, id):
+            # Take the buttons off so nobody picks from a finished round.
+            MESSAGE_QUEUE.submit("edit_message_reply_markup", query.message.chat.id,
+                                 message_id=query.message.message_id)
+
+    MESSAGE_QUEUE.submit("answer_callback_query", user_id, callback_query_id=query.id, text=answer)
 
 
+@with_chat_lock
 def blame_handler(update, context):
     chat_id = update.message.chat_id
-    game = context.bot_data.get("game_obj")
+    game = REGISTRY.get_game(chat_id)
 
     if game is None:
-        text = open("static_responses/game_dne_failure.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+        text = RESPONSES.get("game_dne_failure")
+        send_message(chat_id=chat_id, text=text)
         return
 
     if game.check_if_ready_for_choice():
         for telegram_id, player in game.get_players().items():
             if game.get_current_turn_player() == player:
-                bot.send_message(chat_id=chat_id, text="[{}](tg://user?id={})".format(player.get_name(), telegram_id),
+                send_message(chat_id=chat_id, text="[{}](tg://user?id={})".format(player.get_name(), telegram_id),
                                  parse_mode=telegram.ParseMode.MARKDOWN)
                 return
 
@@ -315,87 +910,173 @@ def blame_handler(update, context):
     for telegram_id, player in game.get_players().items():
         if game.get_current_turn_player() != player and not game.player_submitted_correct_num_cards(telegram_id):
             text += "[{}](tg://user?id={})\n".format(player.get_name(), telegram_id)
-    bot.send_message(chat_id=chat_id, text=text, parse_mode=telegram.ParseMode.MARKDOWN)
+    send_message(chat_id=chat_id, text=text, parse_mode=telegram.ParseMode.MARKDOWN)
 
 
 
+@with_chat_lock
 def add_deck_handler(update, context):
     chat_id = update.message.chat_id
+    chat = REGISTRY.get_chat(chat_id)
 
-    if not context.bot_data.get("is_game_pending", False):
-        text = open("static_responses/add_deck_not_pending.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+    if chat is None or not chat.is_game_pending:
+        text = RESPONSES.get("add_deck_not_pending")
+        send_message(chat_id=chat_id, text=text)
         return
 
     if len(context.args) < 1:
-        bot.send_message(chat_id=chat_id, text="Usage: /ad {deck IDs from /decks}")
+        send_message(chat_id=chat_id, text="Usage: /ad {deck IDs from /decks}")
         return
 
-    try:
-        decks = [int(d) for d in context.args]
-    except ValueError:
-        bot.send_message(chat_id=chat_id, text="That is not a valid integer.")
+    decks = [parse_deck_id(d) for d in context.args]
+    if None in decks:
+        send_message(chat_id=chat_id, text="There's no deck %s! See /decks."
+                     % context.args[decks.index(None)])
         return
 
-    max_deck = max(list(map(int, DeckEnums)))
-    if any(deck < 0 or deck > max_deck for deck in decks):
-        bot.send_message(chat_id=chat_id, text="That deck is not in the range [0, %s]!" % max_deck)
+    try:
+        add_decks(chat, decks)
+    except DeckError as e:
+        send_message(chat_id=chat_id, text=str(e))
         return
+    send_message(chat_id=chat_id, text="Added deck(s) %s!" % ", ".join(str(d) for d in decks))
 
-    if context.bot_data.get("decks") is None:
-        context.bot_data["decks"] = decks
-    else:
-        context.bot_data["decks"] = list(set(context.bot_data["decks"]).union(set(decks)))
-    bot.send_message(chat_id=chat_id, text="Added deck(s) %s!" % decks)
+
+def add_decks(chat, decks):
+    custom_decks = {d for d in chat.decks + decks if is_custom_deck_key(d)}
+    if len(custom_decks) > MAX_CUSTOM_DECKS_PER_GAME:
+        raise DeckError("A game can use at most %d uploaded decks." % MAX_CUSTOM_DECKS_PER_GAME)
+
+    chat.decks = list(set(chat.decks).union(set(decks)))
 
 
+@with_chat_lock
 def remove_deck_handler(update, context):
     chat_id = update.message.chat_id
+    chat = REGISTRY.get_chat(chat_id)
 
-    if not context.bot_data.get("is_game_pending", False):
-        text = open("static_responses/remove_deck_not_pending.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+    if chat is None or not chat.is_game_pending:
+        text = RESPONSES.get("remove_deck_not_pending")
+        send_message(chat_id=chat_id, text=text)
         return
 
     if len(context.args) != 1:
-        bot.send_message(chat_id=chat_id, text="Usage: /rd {deck ID from /decks}")
-        return
-
-    try:
-        deck = int(context.args[0])
-    except ValueError:
-        bot.send_message(chat_id=chat_id, text="That is not a valid integer.")
+        send_message(chat_id=chat_id, text="Usage: /rd {deck ID from /decks}")
         return
 
-    max_deck = max(list(map(int, DeckEnums)))
-    if deck < 0 or deck > max_deck:
-        bot.send_message(chat_id=chat_id, text="That deck is not in the range [0, %s]!" % max_deck)
-        return
+    # Uploaded decks can be removed even if their file has since gone missing.
+    deck = context.args[0].lower()
+    if not is_custom_deck_key(deck):
+        deck = parse_deck_id(deck)
+        if deck is None:
+            send_message(chat_id=chat_id, text="There's no deck %s! See /decks." % context.args[0])
+            return
 
-    if context.bot_data.get("decks") is None:
-        bot.send_message(chat_id=chat_id, text="No decks have been added yet! You can't remove one.")
+    if len(chat.decks) == 0:
+        send_message(chat_id=chat_id, text="No decks have been added yet! You can't remove one.")
         return
     else:
-        if deck not in context.bot_data["decks"]:
-            bot.send_message(chat_id=chat_id, text="That deck has not been added!")
+        if deck not in chat.decks:
+            send_message(chat_id=chat_id, text="That deck has not been added!")
             return
-        context.bot_data["decks"].remove(deck)
-    bot.send_message(chat_id=chat_id, text="Removed deck %s!" % deck)
+        chat.decks.remove(deck)
+    send_message(chat_id=chat_id, text="Removed deck %s!" % deck)
 
 
+@with_chat_lock
 def current_decks_handler(update, context):
     chat_id = update.message.chat_id
-    game = context.bot_data.get("game_obj")
+    chat = REGISTRY.get_chat(chat_id)
 
-    if not context.bot_data.get("is_game_pending", False) and game is None:
-        text = open("static_responses/current_decks_not_pending.txt", "r", encoding="utf-8").read()
-        bot.send_message(chat_id=chat_id, text=text)
+    if chat is None or (not chat.is_game_pending and chat.game_obj is None):
+        text = RESPONSES.get("current_decks_not_pending")
+        send_message(chat_id=chat_id, text=text)
         return
 
     text = "Current Decks:\n\n"
-    for i in context.bot_data["decks"]:
-        text += "(%s) %s\n" % (i, DECK_NAMES[i])
-    bot.send_message(chat_id=chat_id, text=text)
+    for i in chat.decks:
+        text += "(%s) %s\n" % (i, get_deck_name(i))
+    send_message(chat_id=chat_id, text=text)
+
+
+def decks_handler(update, context):
+    corpus = card_corpus.get_corpus()
+    text = "The following decks are available to play with: (black cards/white cards)\n\n"
+    for d in corpus.get_deck_ids():
+        text += "(%s) %s (%d/%d)\n" % (d, corpus.get_deck_name(d), len(corpus.get_deck_black_ids(d)),
+                                        len(corpus.get_deck_white_ids(d)))
+    text += ("\nIf no deck is specified, only the base deck will be used. "
+             "To play your own deck, send it as a file with /uploaddeck as the caption.")
+    send_message(chat_id=update.message.chat_id, text=text)
+
+
+# Only documents captioned with the upload command are taken as decks.
+UPLOAD_DECK_CAPTION = re.compile(r"^/(uploaddeck|ud)(@\w+)?(\s|$)")
+
+
+def upload_deck_handler(update, context):
+    message = update.message
+    chat_id = message.chat_id
+
+    document = message.document
+    if document is not None:
+        if not UPLOAD_DECK_CAPTION.match(message.caption or ""):
+            return
+    elif message.reply_to_message is not None:
+        document = message.reply_to_message.document
+    if document is None:
+        send_message(chat_id=chat_id, text="Usage: send a deck file with /uploaddeck as its caption, or reply "
+                                           "/uploaddeck to one. A deck looks like {\"name\": \"My Deck\", "
+                                           "\"white\": [\"A card.\"], \"black\": [{\"text\": \"Why ____?\", "
+                                           "\"pick\": 1}]}.")
+        return
+
+    chat = REGISTRY.get_chat(chat_id)
+    if chat is None or not chat.is_game_pending:
+        text = RESPONSES.get("add_deck_not_pending")
+        send_message(chat_id=chat_id, text=text)
+        return
+
+    if document.file_size is not None and document.file_size > MAX_UPLOAD_BYTES:
+        send_message(chat_id=chat_id, text="Decks can be at most %d KB." % (MAX_UPLOAD_BYTES // 1024))
+        return
+
+    try:
+        UPLOAD_LIMITER.start(message.from_user.id)
+    except DeckError as e:
+        send_message(chat_id=chat_id, text="Couldn't add that deck. %s" % e)
+        return
+
+    # Downloading can take a while, so it happens off the thread handling updates and without the chat's lock.
+    UPLOADS.submit(receive_deck, context.bot, chat_id, document.file_id)
+
+
+def receive_deck(bot, chat_id, file_id):
+    try:
+        deck = CUSTOM_DECKS.add(parse_custom_deck(bot.get_file(file_id).download_as_bytearray()))
+    except DeckError as e:
+        send_message(chat_id=chat_id, text="Couldn't add that deck. %s" % e)
+        return
+    except (TelegramError, OSError) as e:
+        ERROR_LOGGER.warning("Failed to receive a deck for %s: %s", chat_id, e)
+        send_message(chat_id=chat_id, text="Couldn't download that deck. Try sending it again?")
+        return
+    finally:
+        UPLOAD_LIMITER.finish()
+
+    chat = REGISTRY.get_chat(chat_id)
+    if chat is None:
+        return
+    with chat.lock:
+        if REGISTRY.get_chat(chat_id) is not chat or not chat.is_game_pending:
+            return
+        try:
+            add_decks(chat, [deck.get_key()])
+        except DeckError as e:
+            send_message(chat_id=chat_id, text="Couldn't add that deck. %s" % e)
+            return
+    send_message(chat_id=chat_id, text="Added %s (%d black and %d white cards)!\n\nOther chats can add it with /ad %s"
+                 % (deck.get_name(), deck.get_num_black_cards(), deck.get_num_white_cards(), deck.get_key()))
 
 
 def log_action(update, func_name):
@@ -405,19 +1086,72 @@ def log_action(update, func_name):
     INFO_LOGGER.info("%s called %s in %s.", user_id, func_name, chat_id)
 
 
+def check_webhook_config():
+    if not USE_WEBHOOK or WEBHOOK_SECRET:
+        return
+    if WEBHOOK_URL:
+        raise RuntimeError("Refusing to register a webhook without WEBHOOK_SECRET.")
+    if not is_loopback(WEBHOOK_LISTEN):
+        raise RuntimeError("Refusing to listen for webhook updates on %s without WEBHOOK_SECRET." % WEBHOOK_LISTEN)
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def run_webhook(updater, update_queue=None):
+    check_webhook_config()
+    dispatcher = updater.dispatcher
+    if update_queue is None:
+        # The async runtime takes updates straight from the server and passes them to the dispatcher.
+        update_queue = MESSAGE_QUEUE if USE_ASYNC else dispatcher.update_queue
+    server = WebhookServer(updater.bot, update_queue, WEBHOOK_LISTEN, PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop_event.set())
+
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name="dispatcher")
+    dispatcher_thread.start()
+    updater.job_queue.start()
+    server.start()
+
+    if WEBHOOK_URL:
+        updater.bot.set_webhook(url="%s/%s" % (WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH),
+                                secret_token=WEBHOOK_SECRET or None)
+    INFO_LOGGER.info("Listening for webhook updates on port %d.", server.get_port())
+
+    stop_event.wait()
+
+    server.stop()
+    updater.job_queue.stop()
+    dispatcher.stop()
+    dispatcher_thread.join()
+
+
 def handle_error(update, context):
     trace = "".join(traceback.format_tb(sys.exc_info()[2]))
     ERROR_LOGGER.warning("Telegram Error! %s with context error %s caused by this update: %s", trace, context.error, update)
 
+    # The game's log is enough to replay it up to the failure with replay.py.
+    try:
+        chat = None if update is None else get_game_chat(update)
+    except Exception:
+        chat = None
+    if chat is not None and chat.game_obj is not None:
+        ERROR_LOGGER.warning("Game log for %s: %s", chat.chat_id,
+                             json.dumps(chat.game_obj.to_log(), separators=(",", ":")))
 
-if __name__ == "__main__":
-    # Set up the bot
-    updater = Updater(token=TOKEN, use_context=True)
-    dispatcher = updater.dispatcher
 
+def register_handlers(dispatcher, job_queue):
     # Static command handlers
 
-    static_commands = ["start", "rules", "help", "decks"]
+    static_commands = ["start", "rules", "help"]
     for c in static_commands:
         dispatcher.add_handler(static_handler(c))
 
@@ -436,6 +1170,10 @@ if __name__ == "__main__":
     remove_deck_aliases = ["removedeck", "rd"]
     blame_aliases = ["blame", "blam"]
     current_decks_aliases = ["currentdecks", "cd"]
+    reload_responses_aliases = ["reloadresponses"]
+    profile_aliases = ["profile"]
+    decks_aliases = ["decks"]
+    upload_deck_aliases = ["uploaddeck", "ud"]
 
     commands = [("feedback", feedback_aliases),
                 ("newgame", newgame_aliases),
@@ -449,14 +1187,81 @@ if __name__ == "__main__":
                 ("add_deck", add_deck_aliases),
                 ("remove_deck", remove_deck_aliases),
                 ("blame", blame_aliases),
-                ("current_decks", current_decks_aliases)]
+                ("current_decks", current_decks_aliases),
+                ("reload_responses", reload_responses_aliases),
+                ("profile", profile_aliases),
+                ("decks", decks_aliases),
+                ("upload_deck", upload_deck_aliases)]
     for base_name, aliases in commands:
-        func = locals()[base_name + "_handler"]
+        func = timed(base_name, globals()[base_name + "_handler"])
+        # Handlers lock their own chat, so the updater's worker threads can run commands for different games
+        # at the same time. In async mode this also keeps the runtime's event loop free for network I/O.
+        func = run_async(func)
         dispatcher.add_handler(CommandHandler(aliases, func))
-    
+
+    # Inline keyboard handlers
+
+    func = timed("callback_query", callback_query_handler)
+    func = run_async(func)
+    dispatcher.add_handler(CallbackQueryHandler(func, pattern="^(play|choose):"))
+
+    # Deck files
+
+    func = timed("upload_deck", upload_deck_handler)
+    func = run_async(func)
+    dispatcher.add_handler(MessageHandler(Filters.document & Filters.caption, func))
+
     # Error handlers
 
     dispatcher.add_error_handler(handle_error)
 
-    updater.start_polling()
-    updater.idle()
\ No newline at end of file
+    if RESPONSES_RELOAD_INTERVAL > 0:
+        job_queue.run_repeating(check_responses_job, interval=RESPONSES_RELOAD_INTERVAL)
+
+    if IDLE_SWEEP_INTERVAL > 0:
+        job_queue.run_repeating(sweep_idle_chats_job, interval=IDLE_SWEEP_INTERVAL)
+
+
+def create_updater(token):
+    updater = Updater(token=token, use_context=True)
+    register_handlers(updater.dispatcher, updater.job_queue)
+    return updater
+
+
+def main():
+    check_webhook_config()
+    token = read_token()
+    updater = create_updater(token)
+
+    if USE_ASYNC:
+        message_queue = AsyncRuntime(AsyncBotClient(token), updater.dispatcher, updater.bot)
+    else:
+        message_queue = MessageQueue(updater.bot)
+    init_app(message_queue, GAMES_DB_PATH)
+
+    load_games()
+    STORE.start()
+    FEEDBACK.start()
+    MESSAGE_QUEUE.start()
+    SCHEDULER.start()
+    metrics_server = start_metrics_server()
+
+    if USE_WEBHOOK:
+        run_webhook(updater)
+    else:
+        updater.start_polling()
+        updater.idle()
+
+    if metrics_server is not None:
+        metrics_server.stop()
+    SCHEDULER.stop()
+    STORE.stop()
+    FEEDBACK.stop()
+    UPLOADS.shutdown()
+    MESSAGE_QUEUE.stop()
+    if LOG_WRITER is not None:
+        LOG_WRITER.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from array import array
+
+import os
+import random
+import unittest
+
+from cah import MAX_SWAPS, CardBitset, Deck, DrawPile
+from card_corpus import CARD_ID_TYPECODE, CardCorpus
+
+CARDS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static_responses")
+
+
+class DrawPileTest(unittest.TestCase):
+    def test_deals_each_card_once(self):
+        source = array(CARD_ID_TYPECODE, range(100, 200))
+        pile = DrawPile(source, True)
+        rng = random.Random(1)
+        dealt = [pile.draw(rng) for i in range(len(source))]
+        self.assertEqual(sorted(dealt), list(source))
+        self.assertEqual(len(pile), 0)
+        # The shared source is never changed.
+        self.assertEqual(list(source), list(range(100, 200)))
+
+    def test_order_depends_on_the_generator(self):
+        a = DrawPile(array(CARD_ID_TYPECODE, range(50)))
+        b = DrawPile(array(CARD_ID_TYPECODE, range(50)), True)
+        rng_a = random.Random(2)
+        rng_b = random.Random(2)
+        self.assertEqual([a.draw(rng_a) for i in range(50)], [b.draw(rng_b) for i in range(50)])
+
+    def test_snapshot_resumes_the_deal(self):
+        source = array(CARD_ID_TYPECODE, range(40))
+        pile = DrawPile(source, True)
+        rng = random.Random(3)
+        dealt = [pile.draw(rng) for i in range(15)]
+
+        restored = DrawPile.from_snapshot(pile.to_snapshot(), source)
+        state = rng.getstate()
+        rest = [pile.draw(rng) for i in range(25)]
+        rng.setstate(state)
+        self.assertEqual([restored.draw(rng) for i in range(25)], rest)
+        self.assertEqual(sorted(dealt + rest), list(source))
+
+    def test_copies_a_shared_source_once_it_has_many_swaps(self):
+        source = array(CARD_ID_TYPECODE, range(1000))
+        pile = DrawPile(source, True)
+        rng = random.Random(4)
+        dealt = [pile.draw(rng) for i in range(MAX_SWAPS * 4)]
+        snapshot = pile.to_snapshot()
+        self.assertEqual(snapshot["swaps"], [])
+        self.assertEqual(len(snapshot["source"]), len(pile))
+        dealt += [pile.draw(rng) for i in range(len(pile))]
+        self.assertEqual(sorted(dealt), list(source))
+        self.assertEqual(list(source), list(range(1000)))
+
+    def test_loads_snapshots_with_swaps_on_unshared_piles(self):
+        pile = DrawPile.from_snapshot({"source": [5, 6, 7, 8], "remaining": 3, "swaps": [[1, 8]]}, None)
+        self.assertEqual(sorted(pile.draw(random) for i in range(3)), [5, 7, 8])
+
+    def test_unshared_snapshot_keeps_its_cards(self):
+        pile = DrawPile(array(CARD_ID_TYPECODE, [5, 6, 7]))
+        snapshot = pile.to_snapshot()
+        self.assertEqual(snapshot["source"], [5, 6, 7])
+        restored = DrawPile.from_snapshot(snapshot, None)
+        self.assertEqual(sorted(restored.draw(random) for i in range(3)), [5, 6, 7])
+
+
+class CardBitsetTest(unittest.TestCase):
+    def test_pop_all_returns_each_card_once(self):
+        bitset = CardBitset(100)
+        for card in [3, 99, 0, 42, 8]:
+            bitset.add(card)
+        self.assertEqual(len(bitset), 5)
+        self.assertEqual(sorted(bitset.pop_all()), [0, 3, 8, 42, 99])
+        self.assertEqual(len(bitset), 0)
+        self.assertEqual(list(bitset.pop_all()), [])
+
+    def test_snapshot(self):
+        bitset = CardBitset(20)
+        for card in [1, 2, 19]:
+            bitset.add(card)
+        restored = CardBitset.from_snapshot(bitset.to_snapshot())
+        self.assertEqual(len(restored), 3)
+        self.assertEqual(sorted(restored.pop_all()), [1, 2, 19])
+
+
+class DeckTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus = CardCorpus(CARDS_PATH, pack_path=None)
+
+    def test_deals_each_card_once_across_decks(self):
+        decks = [0, 1]
+        white_cards, black_cards = self.corpus.get_card_ids(decks)
+        deck = Deck(decks, self.corpus, random.Random(4))
+        dealt = [deck.draw_white_card() for i in range(len(white_cards))]
+        self.assertEqual(len(set(dealt)), len(dealt))
+        self.assertEqual(sorted(dealt), sorted(white_cards))
+
+    def test_reshuffles_discards(self):
+        deck = Deck([0], self.corpus, random.Random(5))
+        white_cards, black_cards = self.corpus.get_card_ids([0])
+        dealt = [deck.draw_white_card() for i in range(len(white_cards))]
+        deck.discard_white_cards(dealt[:10])
+        redealt = [deck.draw_white_card() for i in range(10)]
+        self.assertEqual(sorted(redealt), sorted(dealt[:10]))
+
+    def test_black_cards_run_out_to_the_void_card(self):
+        deck = Deck([0], self.corpus, random.Random(6))
+        white_cards, black_cards = self.corpus.get_card_ids([0])
+        for i in range(len(black_cards)):
+            deck.draw_black_card()
+        self.assertEqual(deck.draw_black_card(), self.corpus.get_void_black_card_id())
+
+    def test_snapshot_resumes_the_deal(self):
+        deck = Deck([0], self.corpus, random.Random(7))
+        hand = deck.draw_hand()
+        deck.discard_white_cards(hand[:3])
+        rng = random.Random(8)
+        restored = Deck.from_snapshot(deck.to_snapshot(), self.corpus, rng)
+        self.assertEqual(restored.to_snapshot(), deck.to_snapshot())
+
+
+if __name__ == "__main__":
+    unittest.main()
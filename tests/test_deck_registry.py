@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from unittest import mock
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import cah
+import deck_registry
+from card_corpus import CardCorpus
+from deck_registry import CustomDeckStore, DeckError, UploadLimiter, parse_custom_deck
+
+CARDS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static_responses")
+
+
+def make_deck(white, black=(), name="Deck"):
+    return json.dumps({"name": name, "white": list(white),
+                       "black": [{"text": text, "pick": 1} for text in black]}).encode("utf-8")
+
+
+class ParseCustomDeckTest(unittest.TestCase):
+    def test_drops_empty_and_repeated_cards(self):
+        deck = parse_custom_deck(make_deck(["A.", " A. ", "", "B\nC."], ["Why ____?", "Why ____?"]))
+        self.assertEqual([deck.get_white_card(i) for i in range(deck.get_num_white_cards())], ["A.", "B C."])
+        self.assertEqual(deck.get_num_black_cards(), 1)
+
+    def test_key_only_depends_on_the_cards(self):
+        a = parse_custom_deck(make_deck(["A."], name="One"))
+        b = parse_custom_deck(make_deck(["A."], name="Two"))
+        self.assertEqual(a.get_key(), b.get_key())
+        self.assertTrue(deck_registry.is_custom_deck_key(a.get_key()))
+
+    def test_rejects_bad_decks(self):
+        for data in [b"nope", b"[]", make_deck([]), make_deck(["x" * (deck_registry.MAX_CARD_LENGTH + 1)]),
+                     json.dumps({"black": [{"text": "Why?", "pick": 9}]}).encode("utf-8")]:
+            with self.assertRaises(DeckError):
+                parse_custom_deck(data)
+
+
+class CustomDeckStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_reloads_evicted_decks_from_disk(self):
+        store = CustomDeckStore(self.path)
+        decks = [store.add(parse_custom_deck(make_deck(["Card %d." % i]))) for i in range(3)]
+        with mock.patch.object(deck_registry, "MAX_LOADED_DECKS", 2):
+            store.add(parse_custom_deck(make_deck(["Card 3."])))
+            self.assertEqual(store.get_num_decks(), 2)
+            reloaded = store.get(decks[0].get_key())
+        self.assertIsNot(reloaded, decks[0])
+        self.assertEqual(reloaded.get_white_card(0), "Card 0.")
+
+    def test_refuses_uploads_once_full(self):
+        with mock.patch.object(deck_registry, "MAX_STORED_DECKS", 2):
+            store = CustomDeckStore(self.path)
+            first = store.add(parse_custom_deck(make_deck(["A."])))
+            store.add(parse_custom_deck(make_deck(["B."])))
+            with self.assertRaises(DeckError):
+                store.add(parse_custom_deck(make_deck(["C."])))
+            # Decks that are already stored can still be added.
+            self.assertEqual(store.add(parse_custom_deck(make_deck(["A."]))).get_key(), first.get_key())
+            self.assertEqual(len(os.listdir(self.path)), 2)
+
+
+class UploadLimiterTest(unittest.TestCase):
+    def test_limits_each_user(self):
+        limiter = UploadLimiter(burst=2, interval=3600)
+        limiter.start(1)
+        limiter.start(1)
+        with self.assertRaises(DeckError):
+            limiter.start(1)
+        limiter.start(2)
+
+    def test_limits_queued_uploads(self):
+        limiter = UploadLimiter(burst=5, interval=3600, max_queued=2)
+        limiter.start(1)
+        limiter.start(2)
+        with self.assertRaises(DeckError):
+            limiter.start(3)
+        limiter.finish()
+        limiter.start(3)
+
+
+class CustomCardTextTest(unittest.TestCase):
+    def test_card_text_is_escaped(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        store = CustomDeckStore(path)
+        deck = store.add(parse_custom_deck(make_deck(["<3"] + ["Card %d." % i for i in range(40)], ["<b>Why ____?"])))
+        corpus = store.get_union(CardCorpus(CARDS_PATH, pack_path=None), [deck.get_key()])
+        game = cah.Game(-1, {1: "<i>", 2: "Bob", 3: "Cy"}, [deck.get_key()], corpus, 1)
+        texts = [m.text for m in game.pop_messages()]
+        self.assertIn("&lt;i&gt; has been added to the game.\n", texts)
+        self.assertIn("&lt;b&gt;Why ____?", texts[-1])
+        hands = "".join(p.get_formatted_hand(corpus) for p in game.get_players().values())
+        self.assertIn("&lt;3", hands)
+        self.assertNotIn("<3", hands)
+
+
+if __name__ == "__main__":
+    unittest.main()
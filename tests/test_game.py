@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+import cah
+from card_corpus import CardCorpus
+
+CARDS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static_responses")
+
+PLAYERS = {1: "Ann", 2: "Bob", 3: "Cy"}
+
+
+class GameTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus = CardCorpus(CARDS_PATH, pack_path=None)
+
+    def new_game(self, seed=1, players=PLAYERS):
+        game = cah.Game(-1, players, [0], self.corpus, seed)
+        game.pop_messages()
+        return game
+
+    def get_judge(self, game):
+        return [telegram_id for telegram_id, p in game.get_players().items()
+                if p is game.get_current_turn_player()][0]
+
+    def play_all(self, game):
+        judge = self.get_judge(game)
+        for telegram_id in game.get_players():
+            if telegram_id != judge:
+                game.play(telegram_id, list(range(game.get_current_pick())))
+        return judge
+
+
+class GameTest(GameTestCase):
+    def test_start_deals_hands_and_announces_players(self):
+        game = cah.Game(-1, PLAYERS, [0], self.corpus, 1)
+        texts = [m.text for m in game.pop_messages()]
+        for name in PLAYERS.values():
+            self.assertIn("%s has been added to the game.\n" % name, texts)
+        for p in game.get_players().values():
+            self.assertEqual(len(p.get_hand()), cah.HAND_SIZE)
+        self.assertEqual(game.pop_messages(), [])
+
+    def test_judge_cant_play(self):
+        game = self.new_game()
+        judge = self.get_judge(game)
+        game.play(judge, [0])
+        self.assertEqual([m.text for m in game.pop_messages()], ["You can't play a white card on your turn!"])
+        self.assertEqual(game.get_num_submissions(), 0)
+
+    def test_round_closes_once_everyone_plays(self):
+        game = self.new_game()
+        judge = self.play_all(game)
+        self.assertTrue(game.check_if_ready_for_choice())
+        messages = game.pop_messages()
+        self.assertIn("<b>White Cards Submitted:</b>", messages[-1].text)
+        self.assertIsNotNone(messages[-1].reply_markup)
+        for telegram_id, p in game.get_players().items():
+            self.assertEqual(len(p.get_hand()), cah.HAND_SIZE)
+
+        self.assertTrue(game.choose(judge, 0))
+        texts = [m.text for m in game.pop_messages()]
+        self.assertTrue(texts[0].startswith("That card belonged to "))
+        self.assertEqual(sum(p.get_score() for p in game.get_players().values()), 1)
+
+    def test_choose_before_round_closes(self):
+        game = self.new_game()
+        self.assertFalse(game.choose(self.get_judge(game), 0))
+        self.assertEqual([m.text for m in game.pop_messages()], ["Not all white cards have been submitted yet!"])
+
+    def test_close_submissions_without_plays(self):
+        game = self.new_game()
+        self.assertFalse(game.close_submissions())
+        self.assertEqual([m.text for m in game.pop_messages()],
+                         ["Nobody submitted their white cards in time, skipping this round!"])
+        self.assertFalse(game.choose_randomly())
+
+    def test_close_submissions_early(self):
+        game = self.new_game()
+        judge = self.get_judge(game)
+        player = [telegram_id for telegram_id in PLAYERS if telegram_id != judge][0]
+        game.play(player, list(range(game.get_current_pick())))
+        game.pop_messages()
+        self.assertTrue(game.close_submissions())
+        self.assertTrue(game.choose_randomly())
+        self.assertEqual(game.get_players()[player].get_score(), 1)
+
+    def test_next_turn_moves_the_judge(self):
+        game = self.new_game()
+        judge = self.play_all(game)
+        game.choose(judge, 0)
+        game.pop_messages()
+        game.next_turn()
+        self.assertNotEqual(self.get_judge(game), judge)
+        self.assertEqual(game.get_round(), 1)
+        self.assertEqual(game.get_num_submissions(), 0)
+        self.assertFalse(game.check_if_ready_for_choice())
+        self.assertIn("<b>Current Turn:</b>", game.pop_messages()[-1].text)
+
+
+if __name__ == "__main__":
+    unittest.main()
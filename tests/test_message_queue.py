@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from telegram.error import BadRequest, RetryAfter, Unauthorized
+from unittest import mock
+
+import threading
+import time
+import unittest
+
+import message_queue
+from message_queue import MAX_RETRIES, PRIORITY_CHATTER, PRIORITY_GAME, MessageQueue
+
+NO_RATE_LIMITS = {name: float("inf") for name in ["GLOBAL_RATE", "GLOBAL_BURST", "PRIVATE_CHAT_RATE",
+                                                  "PRIVATE_CHAT_BURST", "GROUP_CHAT_RATE", "GROUP_CHAT_BURST"]}
+TIMEOUT = 5
+
+
+class FakeBot:
+    def __init__(self, errors=None):
+        # errors is a dict of (text, list of exceptions to raise on its first sends).
+        self.calls = []
+        self.errors = errors or {}
+        self.gate = threading.Event()
+        self.gate.set()
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.gate.wait(TIMEOUT)
+        with self.lock:
+            self.calls.append((chat_id, text))
+            errors = self.errors.get(text)
+            if errors:
+                raise errors.pop(0)
+        return text
+
+
+class MessageQueueTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple(message_queue, **NO_RATE_LIMITS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start_queue(self, bot, num_workers=4):
+        queue = MessageQueue(bot, num_workers)
+        queue.start()
+        self.addCleanup(queue.stop, TIMEOUT)
+        return queue
+
+    def test_keeps_each_chats_order(self):
+        bot = FakeBot()
+        queue = self.start_queue(bot)
+        futures = [queue.send(chat_id, "%d" % i) for i in range(50) for chat_id in (1, 2, -3)]
+        for future in futures:
+            future.result(TIMEOUT)
+        for chat_id in (1, 2, -3):
+            self.assertEqual([text for c, text in bot.calls if c == chat_id], ["%d" % i for i in range(50)])
+
+    def test_game_messages_go_first(self):
+        bot = FakeBot()
+        bot.gate.clear()
+        queue = self.start_queue(bot, 1)
+        first = queue.send(1, "first")
+        # Wait for the only worker to be busy with the first message.
+        while not queue.get_num_pending() == 0:
+            time.sleep(0.01)
+        chatter = queue.send(2, "chatter", priority=PRIORITY_CHATTER)
+        game = queue.send(3, "game", priority=PRIORITY_GAME)
+        bot.gate.set()
+        for future in (first, chatter, game):
+            future.result(TIMEOUT)
+        self.assertEqual([text for chat_id, text in bot.calls], ["first", "game", "chatter"])
+
+    def test_bad_requests_fail_without_retrying(self):
+        for error in (BadRequest("Can't parse entities"), Unauthorized("Forbidden")):
+            bot = FakeBot({"bad": [error]})
+            queue = self.start_queue(bot)
+            failed = queue.send(1, "bad")
+            sent = queue.send(1, "next")
+            self.assertIs(failed.exception(TIMEOUT), error)
+            self.assertEqual(sent.result(TIMEOUT), "next")
+            self.assertEqual(bot.calls, [(1, "bad"), (1, "next")])
+
+    def test_retry_after_is_retried_in_order(self):
+        bot = FakeBot({"busy": [RetryAfter(0), RetryAfter(0)]})
+        queue = self.start_queue(bot)
+        retried = queue.send(1, "busy")
+        after = queue.send(1, "after")
+        self.assertEqual(retried.result(TIMEOUT), "busy")
+        self.assertEqual(after.result(TIMEOUT), "after")
+        self.assertEqual(bot.calls, [(1, "busy")] * 3 + [(1, "after")])
+
+    def test_gives_up_after_max_retries(self):
+        bot = FakeBot({"busy": [RetryAfter(0) for i in range(MAX_RETRIES + 1)]})
+        queue = self.start_queue(bot)
+        self.assertIsInstance(queue.send(1, "busy").exception(TIMEOUT), RetryAfter)
+        self.assertEqual(len(bot.calls), MAX_RETRIES + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from types import SimpleNamespace
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import cah
+from card_corpus import CardCorpus
+from persistence import GameStore
+
+CARDS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static_responses")
+
+PLAYERS = {1: "Ann", 2: "Bob", 3: "Cy"}
+
+
+class GameStoreTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus = CardCorpus(CARDS_PATH, pack_path=None)
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "games.db")
+        self.store = GameStore(self.path, self.corpus)
+        self.chat = SimpleNamespace(chat_id=-1, decks=[0], last_active=1.0,
+                                    game_obj=cah.Game(-1, PLAYERS, [0], self.corpus, 1))
+
+    def play_round(self, game):
+        judge = [telegram_id for telegram_id, p in game.get_players().items()
+                 if p is game.get_current_turn_player()][0]
+        for telegram_id in game.get_players():
+            if telegram_id != judge:
+                game.play(telegram_id, list(range(game.get_current_pick())))
+        game.choose(judge, 0)
+        game.next_turn()
+
+    def count_events(self):
+        return sqlite3.connect(self.path).execute("SELECT COUNT(*) FROM game_events").fetchone()[0]
+
+    def assertSaved(self, store=None):
+        decks, saved, last_active = (store or self.store).load(self.chat.chat_id)
+        self.assertEqual(saved, self.chat.game_obj.to_log())
+        self.assertEqual(cah.Game.from_saved(saved, self.corpus).to_snapshot(), self.chat.game_obj.to_snapshot())
+
+    def test_saves_each_move_once(self):
+        for i in range(4):
+            self.play_round(self.chat.game_obj)
+            self.store.save(self.chat)
+            if i % 2:
+                self.store.flush()
+        # Saves that haven't been written yet are loaded too.
+        self.assertSaved()
+        self.store.flush()
+        self.assertSaved()
+        self.assertEqual(self.count_events(), len(self.chat.game_obj.to_log()["events"]))
+
+    def test_keeps_appending_after_a_restart(self):
+        self.play_round(self.chat.game_obj)
+        self.store.save(self.chat)
+        self.store.flush()
+
+        store = GameStore(self.path, self.corpus)
+        (chat_id, decks, saved, last_active), = store.load_all()
+        self.chat.game_obj = cah.Game.from_saved(saved, self.corpus)
+        self.play_round(self.chat.game_obj)
+        store.save(self.chat)
+        store.flush()
+        self.assertSaved(store)
+        self.assertEqual(self.count_events(), len(self.chat.game_obj.to_log()["events"]))
+
+    def test_a_new_game_replaces_the_old_one(self):
+        for i in range(3):
+            self.play_round(self.chat.game_obj)
+        self.store.save(self.chat)
+        self.store.flush()
+
+        self.chat.game_obj = cah.Game(-1, PLAYERS, [0], self.corpus, 2)
+        self.play_round(self.chat.game_obj)
+        self.store.save(self.chat)
+        self.store.flush()
+        self.assertSaved()
+        self.assertEqual(self.count_events(), len(self.chat.game_obj.to_log()["events"]))
+
+    def test_delete(self):
+        self.store.save(self.chat)
+        self.store.flush()
+        self.store.delete(self.chat.chat_id)
+        self.assertIsNone(self.store.load(self.chat.chat_id))
+        self.store.flush()
+        self.assertIsNone(self.store.load(self.chat.chat_id))
+        self.assertEqual(self.count_events(), 0)
+
+    def test_loads_whole_logs_from_older_versions(self):
+        self.play_round(self.chat.game_obj)
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("INSERT INTO games (chat_id, fingerprint, snapshot) VALUES (?, ?, ?)",
+                         (-1, self.corpus.get_fingerprint(),
+                          json.dumps({"decks": [0], "game": self.chat.game_obj.to_log(), "last_active": 1})))
+        self.assertSaved()
+
+        self.play_round(self.chat.game_obj)
+        self.store.save(self.chat)
+        self.store.flush()
+        self.assertSaved()
+
+
+if __name__ == "__main__":
+    unittest.main()
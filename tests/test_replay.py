@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import unittest
+
+import cah
+
+from tests.test_game import GameTestCase
+
+
+class GameLogTest(GameTestCase):
+    def play_rounds(self, game, num_rounds):
+        # Returns the game's snapshot after every move.
+        snapshots = []
+        for i in range(num_rounds):
+            judge = self.play_all(game)
+            snapshots.append(game.to_snapshot())
+            if i % 2:
+                game.choose(judge, 0)
+            else:
+                game.choose_randomly()
+            snapshots.append(game.to_snapshot())
+            game.next_turn()
+            snapshots.append(game.to_snapshot())
+        return snapshots
+
+    def test_from_log_rebuilds_the_game(self):
+        game = self.new_game(3)
+        self.play_rounds(game, 4)
+        replayed = cah.Game.from_log(game.to_log(), self.corpus)
+        self.assertEqual(replayed.to_snapshot(), game.to_snapshot())
+        self.assertEqual(replayed.to_log(), game.to_log())
+
+    def test_replay_matches_every_move(self):
+        game = self.new_game(4)
+        snapshots = self.play_rounds(game, 3)
+        replayed = [g.to_snapshot() for g, event, messages in cah.Game.replay(game.to_log(), self.corpus)]
+        # Plays between snapshots are skipped over; every snapshot taken must show up in the replay in order.
+        i = 0
+        for snapshot in replayed:
+            if i < len(snapshots) and snapshot == snapshots[i]:
+                i += 1
+        self.assertEqual(i, len(snapshots))
+
+    def test_rejected_moves_are_not_logged(self):
+        game = self.new_game()
+        game.play(self.get_judge(game), [0])
+        self.assertEqual(game.to_log()["events"], [])
+
+    def test_replay_detects_divergence(self):
+        game = self.new_game(5)
+        judge = self.play_all(game)
+        log = game.to_log()
+        log["events"].append(["choose", judge, 99])
+        with self.assertRaises(ValueError):
+            cah.Game.from_log(log, self.corpus)
+
+    def test_snapshots_from_older_versions_load(self):
+        game = self.new_game(6)
+        self.play_all(game)
+        restored = cah.Game.from_saved(game.to_snapshot(), self.corpus)
+        self.assertEqual(restored.to_snapshot(), game.to_snapshot())
+        self.assertEqual(cah.get_saved_player_ids(restored.to_log()), list(restored.get_players()))
+
+    def test_same_seed_deals_the_same_game(self):
+        a = self.new_game(7)
+        b = self.new_game(7)
+        self.assertEqual(a.to_snapshot(), b.to_snapshot())
+        self.assertNotEqual(a.to_snapshot(), self.new_game(8).to_snapshot())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+from __future__ import unicode_literals
+
+import telegram
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import hmac
+import json
+import logging
+import sys
+import threading
+import urllib.request
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Telegram never sends updates anywhere near this big; anything larger is rejected unread.
+MAX_BODY_SIZE = 1 << 20
+
+ERROR_LOGGER = logging.getLogger("error_logger")
+
+
+class WebhookServer:
+    def __init__(self, bot, update_queue, listen, port, url_path, secret_token):
+        self.__bot = bot
+        self.__update_queue = update_queue
+        self.__url_path = "/" + url_path.lstrip("/")
+        self.__secret_token = secret_token
+        self.__thread = None
+        self.__httpd = ThreadingHTTPServer((listen, port), self.__make_request_handler())
+        self.__httpd.daemon_threads = True
+
+    def __make_request_handler(self):
+        server = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.send_response(server.handle_post(self.path, self.headers, self.rfile))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                # Every update would otherwise be printed to stderr.
+                pass
+
+        return WebhookRequestHandler
+
+    def handle_post(self, path, headers, body):
+        # Returns the HTTP status code to reply with.
+        if path != self.__url_path:
+            return 404
+
+        if self.__secret_token and \
+                not hmac.compare_digest(headers.get(SECRET_TOKEN_HEADER, ""), self.__secret_token):
+            return 403
+
+        length = int(headers.get("Content-Length", 0))
+        if length <= 0 or length > MAX_BODY_SIZE:
+            return 400
+
+        try:
+            data = json.loads(body.read(length).decode("utf-8"))
+            update = telegram.Update.de_json(data, self.__bot)
+        except (ValueError, KeyError, TypeError) as e:
+            ERROR_LOGGER.warning("Rejected a malformed webhook update: %s", e)
+            return 400
+
+        self.__update_queue.put(update)
+        return 200
+
+    def get_port(self):
+        return self.__httpd.server_address[1]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__httpd.serve_forever, name="webhook_server", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+
+def post_updates(url, updates, secret_token=None):
+    # Posts recorded updates to a running webhook server, e.g. to replay traffic offline.
+    statuses = []
+    for update in updates:
+        request = urllib.request.Request(url, data=json.dumps(update).encode("utf-8"), method="POST",
+                                         headers={"Content-Type": "application/json"})
+        if secret_token:
+            request.add_header(SECRET_TOKEN_HEADER, secret_token)
+        with urllib.request.urlopen(request) as response:
+            statuses.append(response.status)
+    return statuses
+
+
+if __name__ == "__main__":
+    # Usage: webhook_server.py {file of update JSON, one per line} {webhook URL} [secret token]
+    if len(sys.argv) < 3:
+        print("Usage: %s {updates.jsonl} {url} [secret token]" % sys.argv[0])
+        sys.exit(1)
+
+    with open(sys.argv[1], "r", encoding="utf-8") as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    print(post_updates(sys.argv[2], recorded, sys.argv[3] if len(sys.argv) > 3 else None))